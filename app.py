@@ -1,103 +1,159 @@
-import time
-from queue import Queue, Empty
-from datetime import datetime, timedelta
-from enum import Enum
-from typing import Optional, List
-
-from fastapi import FastAPI
-from pydantic import BaseModel
-
-import pigpio
-import math
-import json
-import random
-
-from threading import Event, Timer, Thread
-from gpiozero import RotaryEncoder, Button
+from functools import partial
+from typing import Annotated, Dict, List, Literal, Optional, Union
+from weakref import WeakValueDictionary
+
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, Field
+
+import os
+
+from gpiozero import Device, RotaryEncoder, Button
+from gpiozero.pins.mock import MockFactory
+
+from aurora import AuroraInfeasible
+from fixtures import GROUP_ALL, Fixture, FadeScheduler, loadFixtures
+from ingest import IngestFull, TaskIngest
+from inputs import InputScheduler
+from knob import HOLD_TIME, KnobController
+from metrics import REGISTRY, CollectedMetric
+from persistence import loadStateFile
+from remote import RemotePi
+from sim import SimulatedDaemons
+from snapshot import SNAPSHOT_PATH
+from stream import DUTY_EVENT, STATE_EVENT, StateBroadcaster, watchFixture
+from reducer import NUM_PRESETS, Colour, State, Task, Adjustment, ChangePreset, Switch, StateChange, Aurora, bound, getStateChange, getTaskSampler
+from timeline import InvalidTimeline, Timeline, compileTimeline
 
 app = FastAPI()
 
-pi = pigpio.pi()
-
-MINIMUM_DIM_POWER = 2
-HOLD_TIME = 0.5
-DOUBLE_CLICK_TIME = 0.4
 RED_GPIO = 26
 GREEN_GPIO = 19
 BLUE_GPIO = 13
 WHITE_GPIO = 6
+CHANNEL_GPIOS = (RED_GPIO, GREEN_GPIO, BLUE_GPIO, WHITE_GPIO)
 
 SW_GPIO = 2
 DT_GPIO = 3
 CLK_GPIO = 4
 
-class KnobState(Enum):
-    DEFAULT = 1
-    MOD_RED = 2
-    MOD_GREEN = 3
-    MOD_BLUE = 4
-    MOD_WHITE = 5
-
-NUM_PRESETS = 3
-COL_MOD_FADE_TIME = 0.15
-COL_MOD_DELAY_TIME = 0.15
 FADE_TIME = 0.75
-KNOB_TIMEOUT_SECONDS = 10
-INTERVALS = 300
-R = max((INTERVALS * math.log(2,10)) / math.log(255,10), 0.1)
-
-knobTimeout = datetime.utcnow()
-knobState = KnobState.DEFAULT
-isHeld = False
-singlePress = False
-
-class Colour(BaseModel):
+# Selects how fades are timed, "tick" writes each frame from python and "script" hands the fade to pigpiod
+FADE_BACKEND = os.environ.get("RGBW_FADE_BACKEND", "tick")
+# Lists the fixtures to drive, without it there is a single fixture on the local pins
+FIXTURES_PATH = os.environ.get("RGBW_FIXTURES", "./fixtures.json")
+# Runs without any hardware, fixtures talk to in-process fake daemons and the knob and button to mock pins
+SIMULATE = os.environ.get("RGBW_SIMULATE") == "1"
+
+# Set up when the app starts rather than on import, so importing it never touches any hardware
+daemons: Optional[SimulatedDaemons] = None
+fixtures: Dict[str, Fixture] = {}
+# The knob and button always control the first fixture
+defaultFixture: Optional[Fixture] = None
+# Fixtures on the same daemon share its connection
+connections: Dict[str, RemotePi] = {}
+scheduler: Optional[FadeScheduler] = None
+ingest: Optional[TaskIngest] = None
+inputs: Optional[InputScheduler] = None
+knob: Optional[KnobController] = None
+button: Optional[Button] = None
+rotor: Optional[RotaryEncoder] = None
+# Pushes state changes and live duty cycles to /stream subscribers
+broadcaster = StateBroadcaster()
+# Timelines that can still be cancelled, they drop out once no fixture is playing them
+timelines: "WeakValueDictionary[str, Timeline]" = WeakValueDictionary()
+
+REGISTRY.register(CollectedMetric(
+    "rgbw_queue_depth", "Tasks waiting to be started", "gauge", ("fixture",),
+    lambda: (((fixture.name,), fixture.queue.qsize()) for fixture in fixtures.values())))
+REGISTRY.register(CollectedMetric(
+    "rgbw_tasks_coalesced_total", "Queued tasks folded into an earlier task's fade", "counter", ("fixture",),
+    lambda: (((fixture.name,), fixture.queue.coalesced) for fixture in fixtures.values())))
+REGISTRY.register(CollectedMetric(
+    "rgbw_stream_subscribers", "Clients connected to a state stream", "gauge", (),
+    lambda: (((), broadcaster.subscribers),)))
+REGISTRY.register(CollectedMetric(
+    "rgbw_pigpio_writes_total", "PWM writes and script runs sent to a pigpio daemon", "counter", ("host",),
+    lambda: (((address,), pi.metrics.writes) for address, pi in connections.items())))
+REGISTRY.register(CollectedMetric(
+    "rgbw_pigpio_errors_total", "Failed pigpio daemon calls", "counter", ("host",),
+    lambda: (((address,), pi.metrics.errors) for address, pi in connections.items())))
+REGISTRY.register(CollectedMetric(
+    "rgbw_pigpio_reconnects_total", "Times the connection to a pigpio daemon was re-established", "counter", ("host",),
+    lambda: (((address,), pi.metrics.reconnects) for address, pi in connections.items())))
+REGISTRY.register(CollectedMetric(
+    "rgbw_pigpio_connected", "Whether the pigpio daemon is currently reachable", "gauge", ("host",),
+    lambda: (((address,), int(pi.connected)) for address, pi in connections.items())))
+
+class ColourModel(BaseModel):
     red: float = 0
     green: float = 0
     blue: float = 0
     white: float = 0
 
-class AuroraSettings(BaseModel):
-    storedColour: Colour = Colour()
-    minColour: Colour = Colour()
-    maxColour: Colour = Colour()
+    def toColour(self) -> Colour:
+        return Colour(self.red, self.green, self.blue, self.white)
+
+class AuroraSettingsModel(BaseModel):
+    storedColour: ColourModel = ColourModel()
+    minColour: ColourModel = ColourModel()
+    maxColour: ColourModel = ColourModel()
     minColourDist: float = 0.4
 
-class State(BaseModel):
+class StateModel(BaseModel):
     on: bool = True
     power: int = 100
-    presets: List[Colour] = [Colour(white=100)] * NUM_PRESETS
+    presets: List[ColourModel] = [ColourModel(white=100)] * NUM_PRESETS
     presetIdx: int = 0
-    aurora: Optional[AuroraSettings] = None
+    aurora: Optional[AuroraSettingsModel] = None
 
-    def duplicate(self) -> 'State':
+    def toState(self) -> State:
         return State(
-            presets=self.presets.copy(),
-            presetIdx=self.presetIdx,
             on=self.on,
             power=self.power,
-            aurora=self.aurora
+            presets=[colour.toColour() for colour in self.presets],
+            presetIdx=self.presetIdx
         )
 
-class Task(BaseModel):
-    fadeTime: float = 0
-    postDelay: float = 0
+class TaskModel(BaseModel):
+    fadeTime: float = Field(0, ge=0, allow_inf_nan=False)
+    postDelay: float = Field(0, ge=0, allow_inf_nan=False)
     flash: bool = False
 
-class Power(Task):
-    value: int
-
-class Adjustment(Task):
+class AdjustmentModel(TaskModel):
     power: int = 0
-    colour: Colour = Colour()
+    colour: ColourModel = ColourModel()
+
+    def toTask(self) -> Adjustment:
+        return Adjustment(power=self.power, colour=self.colour.toColour(), fadeTime=self.fadeTime, postDelay=self.postDelay, flash=self.flash)
+
+class AuroraModel(TaskModel):
+    minColour: ColourModel = ColourModel()
+    maxColour: ColourModel = ColourModel()
+    minColourDist: float = 0.4
+
+    def toTask(self) -> Aurora:
+        return Aurora(
+            minColour=self.minColour.toColour(),
+            maxColour=self.maxColour.toColour(),
+            minColourDist=self.minColourDist,
+            fadeTime=self.fadeTime,
+            postDelay=self.postDelay,
+            flash=self.flash
+        )
 
-class ChangePreset(Task):
-    pass
+def fixturesFor(name: str) -> List[Fixture]:
+    if name == GROUP_ALL:
+        return list(fixtures.values())
+    if name not in fixtures:
+        raise HTTPException(status_code=404, detail="Unknown fixture {0}".format(name))
+    return [fixtures[name]]
 
-class Switch(Task):
-    pass
+# Timeline steps, a step without an offset starts once the previous one's fade and post delay are over
 
-class StateChange(State, Task):
+class StateChangeStepModel(TaskModel):
+    type: Literal["state_change"]
+    at: Optional[float] = Field(None, ge=0, allow_inf_nan=False)
     red: Optional[float] = None
     green: Optional[float] = None
     blue: Optional[float] = None
@@ -105,445 +161,252 @@ class StateChange(State, Task):
     on: Optional[bool] = None
     power: Optional[int] = None
 
-class Aurora(Task):
-    minColour: Colour = Colour()
-    maxColour: Colour = Colour()
-    minColourDist: float = 0.4
-
-def getEffectivePower(state: State) -> int:
-    return state.power if state.on else 0
-
-def getPwmColour(maxColourVal: float, effectivePower: int, colourVal: float) -> int:
-    effectiveColour = 0 if maxColourVal == 0 else colourVal / maxColourVal * 100
-    return bound(0, 255, (effectiveColour * effectivePower * 255) / 10000)
-
-def normalizeColour(colour: Colour) -> Colour:
-    vector = [colour.red, colour.green, colour.blue, colour.white]
-    magnitude = math.sqrt(sum(component**2 for component in vector))
-    if magnitude == 0:
-        return colour
-    normalizedVec = [component / magnitude for component in vector]
-    return Colour(
-        red=normalizedVec[0],
-        green=normalizedVec[1],
-        blue=normalizedVec[2],
-        white=normalizedVec[3],
-    )
-
-unitWhite = normalizeColour(Colour(red=1, green=1, blue=1, white=0))
-
-def colourDist(c1: Colour, c2: Colour) -> float:
-    return math.sqrt(
-        (c1.red - c2.red) ** 2 +
-        (c1.green - c2.green) ** 2 +
-        (c1.blue - c2.blue) ** 2 +
-        (c1.white - c2.white) ** 2
-    )
-
-def applyTask(task: Task, currentTarget: State) -> State:
-    targetState = currentTarget.duplicate()
-
-    # If we are exiting the Aurora mode then make sure to return the preset to its original value
-    if not isinstance(task, Aurora) and targetState.aurora is not None:
-        targetState.presets[targetState.presetIdx] = targetState.aurora.storedColour
-        targetState.aurora = None
-
-    if isinstance(task, Adjustment):
-        newColour = targetState.presets[targetState.presetIdx]
-        if currentTarget.on or all(value <= 0 for value in vars(task.colour).values()):
-            newColour.red = bound(0, 100, newColour.red + task.colour.red)
-            newColour.green = bound(0, 100, newColour.green + task.colour.green)
-            newColour.blue = bound(0, 100, newColour.blue + task.colour.blue)
-            newColour.white = bound(0, 100, newColour.white + task.colour.white)
-        else:
-            # Set target to the adjustment if we are currently off and have increased a colour
-            newColour = task.colour
-        targetState.presets[targetState.presetIdx] = newColour
-        targetState.on = True
-        if currentTarget.on:
-            targetState.power = bound(0, 100, currentTarget.power + task.power)
-            # Have a final minimum power level before going to zero or up from zero
-            if currentTarget.power > MINIMUM_DIM_POWER and targetState.power == 0:
-                # Started above the minimum dim and went to zero
-                targetState.power = MINIMUM_DIM_POWER
-            elif currentTarget.power == 0 and targetState.power > 0:
-                # Started at zero and went up
-                targetState.power = MINIMUM_DIM_POWER
-        elif task.power > 0:
-            # Light was off and went up
-            targetState.power = MINIMUM_DIM_POWER
-        else:
-            targetState.power = bound(0, 100, task.power)
-
-    elif isinstance(task, Switch):
-        if targetState.power == 0:
-            # Default to full power when pressing the switch after dimming to zero
-            targetState.power = 100
-            targetState.on = True
-        else:
-            targetState.on = not targetState.on
-
-    elif isinstance(task, StateChange):
-        # StateChange
-        newColour = Colour(
-            red=currentTarget.presets[currentTarget.presetIdx].red if task.red is None else bound(0, 100, task.red),
-            green=currentTarget.presets[currentTarget.presetIdx].green if task.green is None else bound(0, 100, task.green),
-            blue=currentTarget.presets[currentTarget.presetIdx].blue if task.blue is None else bound(0, 100, task.blue),
-            white=currentTarget.presets[currentTarget.presetIdx].white if task.white is None else bound(0, 100, task.white),
-        )
-        targetState.presets[targetState.presetIdx] = newColour
-        targetState.power = currentTarget.power if task.power is None else bound(0, 100, task.power)
-        targetState.on = currentTarget.on if task.on is None else task.on
-    elif isinstance(task, ChangePreset):
-        targetState.presetIdx = (targetState.presetIdx + 1) % NUM_PRESETS
-    elif isinstance(task, Aurora):
-        # If a new aurora is pushed to the queue, make sure to keep the storedColour from the first one
-        if currentTarget.aurora is None:
-            storedColour = currentTarget.presets[currentTarget.presetIdx]
-        else:
-            storedColour = currentTarget.aurora.storedColour
-        targetState.aurora = AuroraSettings(
-            storedColour=storedColour,
-            minColour = task.minColour,
-            maxColour = task.maxColour
+    def toTask(self) -> StateChange:
+        return StateChange(
+            red=self.red, green=self.green, blue=self.blue, white=self.white, on=self.on, power=self.power,
+            fadeTime=self.fadeTime, postDelay=self.postDelay, flash=self.flash
         )
 
-        validVec = False
-        newColour = Colour()
+class AdjustmentStepModel(AdjustmentModel):
+    type: Literal["adjustment"]
+    at: Optional[float] = Field(None, ge=0, allow_inf_nan=False)
 
-        while not validVec:
-            newColour = Colour(
-                red=random.randint(int(task.minColour.red), int(task.maxColour.red)),
-                green=random.randint(int(task.minColour.green), int(task.maxColour.green)),
-                blue=random.randint(int(task.minColour.blue), int(task.maxColour.blue)),
-                white=random.randint(int(task.minColour.white), int(task.maxColour.white))
-            )
+class AuroraStepModel(AuroraModel):
+    type: Literal["aurora"]
+    at: Optional[float] = Field(None, ge=0, allow_inf_nan=False)
 
-            normalizedCol = normalizeColour(newColour)
-            normColMinusWhite = normalizeColour(Colour(red=newColour.red, green=newColour.green, blue=newColour.blue))
-            distToWhite = colourDist(normColMinusWhite, unitWhite)
-            distToOldTarget = colourDist(normalizedCol, normalizeColour(currentTarget.presets[currentTarget.presetIdx]))
-            isOff = all(value == 0 for value in vars(newColour).values())
+class SwitchStepModel(TaskModel):
+    type: Literal["switch"]
+    at: Optional[float] = Field(None, ge=0, allow_inf_nan=False)
 
-            validVec = distToWhite >= task.minColourDist and distToOldTarget >= task.minColourDist and not isOff
+    def toTask(self) -> Switch:
+        return Switch(fadeTime=self.fadeTime, postDelay=self.postDelay, flash=self.flash)
 
-        targetState.presets[targetState.presetIdx] = newColour
-    else:
-        print("Unknown task type")
-    return targetState
-
-def bound(low: int, high: int, value: float) -> int:
-    return int(max(low, min(high, value)))
-
-def lerp(A: float, B: float, C: float) -> float:
-    return A + C * (B - A)
-
-def loadState() -> State:
-    with open('./state.json', 'r') as f:
-        stateJson = json.load(f)
-        presets = [Colour(**preset) for preset in stateJson["presets"]]
-        state = State(
-            presets=presets,
-            presetIdx=stateJson["presetIdx"],
-            on=stateJson["on"],
-            power=stateJson["power"]
-        )
-        return state
-
-def getStateChange(state: State = State(), task: Task = Task()) -> StateChange:
-    activeColour = state.presets[state.presetIdx]
-    return StateChange(
-        red=activeColour.red,
-        green=activeColour.green,
-        blue=activeColour.blue,
-        white=activeColour.white,
-        on=state.on,
-        power=state.power,
-        flash=task.flash,
-        fadeTime=task.fadeTime,
-        postDelay=task.postDelay
-    )
-
-def saveState(state: State):
-    with open('./state.json', 'w') as f:
-        stateDict = {
-            "on": state.on,
-            "power": state.power,
-            "presets": [colour.dict() for colour in state.presets],
-            "presetIdx": state.presetIdx,
-        }
-        json.dump(stateDict, f)
+class ChangePresetStepModel(TaskModel):
+    type: Literal["change_preset"]
+    at: Optional[float] = Field(None, ge=0, allow_inf_nan=False)
 
-@app.post('/change_preset', status_code=200)
-async def change_preset():
-    global q
-    q.put(ChangePreset(fadeTime=0.25))
+    def toTask(self) -> ChangePreset:
+        return ChangePreset(fadeTime=self.fadeTime, postDelay=self.postDelay, flash=self.flash)
 
-@app.post('/switch', status_code=200)
-async def switch():
-    global q
-    isOn = (pi.get_PWM_dutycycle(RED_GPIO) +
-            pi.get_PWM_dutycycle(GREEN_GPIO) +
-            pi.get_PWM_dutycycle(BLUE_GPIO) +
-            pi.get_PWM_dutycycle(WHITE_GPIO)) > 0
-    q.put(Switch(fadeTime=FADE_TIME))
-    # FIXME: This can be incorrect if switched on and off quickly
+TimelineStepModel = Annotated[
+    Union[StateChangeStepModel, AdjustmentStepModel, AuroraStepModel, SwitchStepModel, ChangePresetStepModel],
+    Field(discriminator="type")
+]
+
+class TimelineModel(BaseModel):
+    steps: List[TimelineStepModel]
+
+async def submitToAll(name: str, task: Union[Task, Timeline], wait: bool = False) -> Optional[Dict[str, str]]:
+    # Every addressed fixture picks the task up in the same scheduler frame
+    try:
+        return await ingest.submit([(fixture, task) for fixture in fixturesFor(name)], wait)
+    except IngestFull as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+def getStateString(fixture: Fixture) -> str:
+    version, state = fixture.stateStore.snapshot()
+    if state is None:
+        # The scheduler hasn't published the initial state yet
+        state = loadStateFile(fixture.statePath)
+    powerString = "{0}% power".format(state.power) if state.on else "OFF"
+    colour = state.presets[state.presetIdx]
+    return "{0} (r:{1}%, g:{2}%, b:{3}%, w:{4}%)".format(powerString, *(float(value) for value in colour))
+
+# Routes that queue a task take ?wait=true to respond only once the fade has reached its target
+
+@app.get('/fixtures')
+async def list_fixtures():
+    return list(fixtures)
+
+@app.post('/fixtures/{name}/change_preset', status_code=200)
+async def fixture_change_preset(name: str, wait: bool = False):
+    return await submitToAll(name, ChangePreset(fadeTime=0.25), wait)
+
+@app.post('/fixtures/{name}/switch', status_code=200)
+async def fixture_switch(name: str, wait: bool = False):
+    # The shadow target is where the light is heading, so a toggle mid-fade is answered correctly
+    isOn = any(any(fixture.writer.shadow.target()) for fixture in fixturesFor(name))
+    # An explicit on or off rather than a toggle, two quick presses both see the old target and would cancel out
+    # A group that is partly lit is switched off as a whole, so its fixtures stay in step
+    await submitToAll(name, StateChange(on=not isOn, fadeTime=FADE_TIME), wait)
     return "ON" if not isOn else "OFF"
 
-@app.post('/tweak_state', status_code=200)
-async def tweak_state(adjustment: Adjustment):
-    global q
+@app.post('/fixtures/{name}/on', status_code=200)
+async def fixture_on(name: str, wait: bool = False):
+    return await submitToAll(name, StateChange(on=True, fadeTime=FADE_TIME), wait)
+
+@app.post('/fixtures/{name}/off', status_code=200)
+async def fixture_off(name: str, wait: bool = False):
+    return await submitToAll(name, StateChange(on=False, fadeTime=FADE_TIME), wait)
+
+@app.post('/fixtures/{name}/tweak_state', status_code=200)
+async def fixture_tweak_state(name: str, adjustment: AdjustmentModel, wait: bool = False):
     adjustment.colour.red = bound(-100, 100, adjustment.colour.red)
     adjustment.colour.green = bound(-100, 100, adjustment.colour.green)
     adjustment.colour.blue = bound(-100, 100, adjustment.colour.blue)
     adjustment.colour.white = bound(-100, 100, adjustment.colour.white)
 
-    q.put(adjustment)
+    return await submitToAll(name, adjustment.toTask(), wait)
+
+@app.get('/fixtures/{name}/get_state')
+async def fixture_get_state(name: str):
+    if name == GROUP_ALL:
+        return {fixture.name: getStateString(fixture) for fixture in fixtures.values()}
+    return getStateString(fixturesFor(name)[0])
+
+@app.post('/fixtures/{name}/set_state', status_code=200)
+async def fixture_set_state(name: str, newState: StateModel, wait: bool = False):
+    await submitToAll(name, getStateChange(newState.toState()), wait)
+    return newState
+
+@app.post('/fixtures/{name}/aurora', status_code=200)
+async def fixture_aurora(name: str, aurora: AuroraModel, wait: bool = False):
+    task = aurora.toTask()
+    try:
+        # Builds and caches the sampler, so settings that can never produce a colour are rejected here
+        getTaskSampler(task)
+    except AuroraInfeasible as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    # Waiting on an aurora returns once its first colour is reached
+    return await submitToAll(name, task, wait)
+
+@app.post('/fixtures/{name}/timeline', status_code=200)
+async def fixture_timeline(name: str, timelineModel: TimelineModel, wait: bool = False):
+    try:
+        # Validated and compiled once, then queued as a single item and played by the scheduler
+        timeline = compileTimeline([(step.at, step.toTask()) for step in timelineModel.steps])
+    except (InvalidTimeline, AuroraInfeasible) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    timelines[timeline.id] = timeline
+    response = {"id": timeline.id, "duration": timeline.duration}
+    results = await submitToAll(name, timeline, wait)
+    if results is not None:
+        response["results"] = results
+    return response
+
+@app.delete('/timelines/{timelineId}', status_code=200)
+async def cancel_timeline(timelineId: str):
+    # Stops every fixture playing the timeline before its next step, fades under way still finish
+    timeline = timelines.get(timelineId)
+    if timeline is None:
+        raise HTTPException(status_code=404, detail="Unknown or finished timeline {0}".format(timelineId))
+    timeline.cancel()
+    scheduler.wake()
+
+# The original single fixture routes address the default fixture
+
+@app.post('/change_preset', status_code=200)
+async def change_preset(wait: bool = False):
+    return await fixture_change_preset(defaultFixture.name, wait)
+
+@app.post('/switch', status_code=200)
+async def switch(wait: bool = False):
+    return await fixture_switch(defaultFixture.name, wait)
+
+@app.post('/tweak_state', status_code=200)
+async def tweak_state(adjustment: AdjustmentModel, wait: bool = False):
+    return await fixture_tweak_state(defaultFixture.name, adjustment, wait)
 
 @app.get('/get_state')
 async def get_state():
-    state = loadState()
-    powerString = "{0}% power".format(state.power) if state.on else "OFF"
-    colour = state.presets[state.presetIdx]
-    return "{0} (r:{1}%, g:{2}%, b:{3}%, w:{4}%)".format(powerString, colour.red, colour.green, colour.blue, colour.white)
+    return await fixture_get_state(defaultFixture.name)
 
 @app.post('/set_state', status_code=200)
-async def set_state(newState: State):
-    global q
-    state = newState
-    q.put(getStateChange(state))
-    return newState
+async def set_state(newState: StateModel, wait: bool = False):
+    return await fixture_set_state(defaultFixture.name, newState, wait)
 
 @app.post('/aurora', status_code=200)
-async def aurora(aurora: Aurora):
-    global q
-    q.put(aurora)
+async def aurora(aurora: AuroraModel, wait: bool = False):
+    return await fixture_aurora(defaultFixture.name, aurora, wait)
+
+@app.post('/timeline', status_code=200)
+async def timeline(timelineModel: TimelineModel, wait: bool = False):
+    return await fixture_timeline(defaultFixture.name, timelineModel, wait)
+
+@app.get('/fixtures/{name}/stream')
+async def fixture_stream(name: str, duty: bool = False):
+    # Server-sent events, a state event whenever the target changes and with ?duty=true the live duty cycles
+    fixtureNames = {fixture.name for fixture in fixturesFor(name)}
+    kinds = (STATE_EVENT, DUTY_EVENT) if duty else (STATE_EVENT,)
+    return StreamingResponse(broadcaster.subscribe(fixtureNames, kinds), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@app.get('/stream')
+async def stream(duty: bool = False):
+    return await fixture_stream(GROUP_ALL, duty)
+
+@app.get('/latency')
+async def latency():
+    return {fixture.name: fixture.taskLatency.summary() for fixture in fixtures.values()}
+
+@app.get('/hosts')
+async def hosts():
+    # Round trip times and connection health for each pigpio daemon
+    return {address: dict(pi.metrics.summary(), connected=pi.connected) for address, pi in connections.items()}
+
+@app.get('/metrics', response_class=PlainTextResponse)
+async def metrics():
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+@app.on_event("startup")
+async def startup():
+    global daemons, fixtures, defaultFixture, connections, scheduler, ingest, inputs, knob, button, rotor
+    if SIMULATE:
+        daemons = SimulatedDaemons()
+        Device.pin_factory = MockFactory()
+    if daemons is None:
+        fixtures = loadFixtures(FIXTURES_PATH, CHANNEL_GPIOS, FADE_BACKEND)
+    else:
+        fixtures = loadFixtures(FIXTURES_PATH, CHANNEL_GPIOS, FADE_BACKEND, daemons, dataDir=daemons.workDir)
+    defaultFixture = next(iter(fixtures.values()))
+    connections = {fixture.pi.address: fixture.pi for fixture in fixtures.values()}
+    for fixture in fixtures.values():
+        watchFixture(broadcaster, fixture)
+    # A simulated run mustn't overwrite the real fixtures' snapshot
+    scheduler = FadeScheduler(fixtures.values(), snapshotPath=None if SIMULATE else SNAPSHOT_PATH)
+    scheduler.start()
+    ingest = TaskIngest(scheduler)
+    await ingest.start()
+    await broadcaster.start()
+
+    inputs = InputScheduler()
+    knob = KnobController(inputs, defaultFixture.queue.put, FADE_TIME)
+    inputs.start()
+    button = Button(SW_GPIO)
+    rotor = RotaryEncoder(CLK_GPIO, DT_GPIO)
+    button.hold_time = HOLD_TIME
+    button.when_held = button_held
+    button.when_released = button_released
+    rotor.when_rotated_clockwise = clockwise_rotation
+    rotor.when_rotated_counter_clockwise = counter_clockwise_rotation
 
 @app.on_event("shutdown")
 def shutdown():
-    global fadeThread
-    fadeThread.stop()
-    fadeThread.join()
-
-class Fade(Thread):
-    def __init__(self):
-        Thread.__init__(self)
-        self._stop_event = Event()
-
-    def stop(self):
-        print("Received stop")
-        self._stop_event.set()
-
-    def stopped(self) -> bool:
-        return self._stop_event.is_set()
-
-    def run(self):
-        # Make sure PWM dutycycle is always set at least once
-        targetState = loadState()
-        initialColour = targetState.presets[targetState.presetIdx]
-        maxColourVal = max(initialColour.red, initialColour.green, initialColour.blue, initialColour.white)
-        effectivePower = getEffectivePower(targetState)
-        pi.set_PWM_dutycycle(RED_GPIO, getPwmColour(maxColourVal, effectivePower, initialColour.red))
-        pi.set_PWM_dutycycle(GREEN_GPIO, getPwmColour(maxColourVal, effectivePower, initialColour.green))
-        pi.set_PWM_dutycycle(BLUE_GPIO, getPwmColour(maxColourVal, effectivePower, initialColour.blue))
-        pi.set_PWM_dutycycle(WHITE_GPIO, getPwmColour(maxColourVal, effectivePower, initialColour.white))
-
-        while True:
-            if self.stopped():
-                print("Stopping fade thread")
-                # If we are stopping the loop, make sure to disable the aurora effect properly
-                if targetState.aurora is not None:
-                    targetState.presets[targetState.presetIdx] = targetState.aurora.storedColour
-                    targetState.aurora = None
-                return
-            try:
-                if q.qsize() > 1:
-                    print("This queue has multiple things in it")
-                task = q.get_nowait()
-
-                startRed = pi.get_PWM_dutycycle(RED_GPIO)
-                startGreen = pi.get_PWM_dutycycle(GREEN_GPIO)
-                startBlue = pi.get_PWM_dutycycle(BLUE_GPIO)
-                startWhite = pi.get_PWM_dutycycle(WHITE_GPIO)
-
-                initialState = targetState.duplicate()
-                targetState = applyTask(task, targetState)
-                targetColour = targetState.presets[targetState.presetIdx]
-                maxColourVal = max(targetColour.red, targetColour.green, targetColour.blue, targetColour.white)
-                effectivePower = getEffectivePower(targetState)
-                targetRed = getPwmColour(maxColourVal, effectivePower, targetColour.red)
-                targetGreen = getPwmColour(maxColourVal, effectivePower, targetColour.green)
-                targetBlue = getPwmColour(maxColourVal, effectivePower, targetColour.blue)
-                targetWhite = getPwmColour(maxColourVal, effectivePower, targetColour.white)
-            except Empty:
-                time.sleep(0.05)
-                continue
-
-            startTime = time.monotonic()
-            dt = 0
-            brokeEarly = False
-            while dt <= task.fadeTime:
-                if self.stopped() or not q.empty():
-                    print("Broke early")
-                    brokeEarly = True
-                    break
-
-                dt = time.monotonic() - startTime
-                currentInterval = INTERVALS if task.fadeTime == 0 else math.floor(min(1.0, dt / task.fadeTime) * INTERVALS)
-
-                increasingC = (2.0 ** (currentInterval / R) - 1) / 255.0
-                decreasingC = 1.0 - ((2.0 ** ((INTERVALS - currentInterval) / R) - 1) / 255.0)
-
-                redC = increasingC if targetRed > startRed else decreasingC
-                greenC = increasingC if targetGreen > startGreen else decreasingC
-                blueC = increasingC if targetBlue > startBlue else decreasingC
-                whiteC = increasingC if targetWhite > startWhite else decreasingC
-
-                pi.set_PWM_dutycycle(RED_GPIO, lerp(startRed, targetRed, redC))
-                pi.set_PWM_dutycycle(GREEN_GPIO, lerp(startGreen, targetGreen, greenC))
-                pi.set_PWM_dutycycle(BLUE_GPIO, lerp(startBlue, targetBlue, blueC))
-                pi.set_PWM_dutycycle(WHITE_GPIO, lerp(startWhite, targetWhite, whiteC))
-
-                time.sleep(0.01)  # Adjust sleep time as needed
-
-            if brokeEarly:
-                continue
-
-            # task.fadeTime has elapsed, ensure target is reached
-            pi.set_PWM_dutycycle(RED_GPIO, targetRed)
-            pi.set_PWM_dutycycle(GREEN_GPIO, targetGreen)
-            pi.set_PWM_dutycycle(BLUE_GPIO, targetBlue)
-            pi.set_PWM_dutycycle(WHITE_GPIO, targetWhite)
-            time.sleep(task.postDelay)
-
-            if targetState.aurora is not None and q.empty():
-                # Aurora mode is enabled, do another aurora cycle
-                if not q.empty():
-                    print("This is a strange situation")
-                q.put(task)
-                continue
-
-            if task.flash:
-                q.put(getStateChange(initialState, Task(fadeTime=task.fadeTime)))
-            else:
-                saveState(targetState)
-
-def check_knob_timeout():
-    global knobTimeout
-    global knobState
-    global q
-    now = datetime.utcnow()
-    if knobTimeout <= now:
-        if knobState != KnobState.DEFAULT:
-            knobState = KnobState.DEFAULT
-            q.put(StateChange(power=10, flash=True, fadeTime=COL_MOD_FADE_TIME))
-    else:
-        Timer((knobTimeout - now).total_seconds(), check_knob_timeout).start()
-
-def check_double_click():
-    global knobState
-    global knobTimeout
-    global singlePress
-    global q
-
-    if singlePress:
-        singlePress = False
-        if knobState == KnobState.DEFAULT:
-            q.put(Switch(fadeTime=FADE_TIME))
-        else:
-            if knobState == KnobState.MOD_RED:
-                q.put(StateChange(red=0, green=100, blue=0, white=0, flash=True, postDelay=COL_MOD_DELAY_TIME, fadeTime=COL_MOD_FADE_TIME))
-                knobState = KnobState.MOD_GREEN
-            elif knobState == KnobState.MOD_GREEN:
-                q.put(StateChange(red=0, green=0, blue=100, white=0, flash=True, postDelay=COL_MOD_DELAY_TIME, fadeTime=COL_MOD_FADE_TIME))
-                knobState = KnobState.MOD_BLUE
-            elif knobState == KnobState.MOD_BLUE:
-                q.put(StateChange(red=0, green=0, blue=0, white=100, flash=True, postDelay=COL_MOD_DELAY_TIME, fadeTime=COL_MOD_FADE_TIME))
-                knobState = KnobState.MOD_WHITE
-            else:
-                q.put(StateChange(red=100, green=0, blue=0, white=0, flash=True, postDelay=COL_MOD_DELAY_TIME, fadeTime=COL_MOD_FADE_TIME))
-                knobState = KnobState.MOD_RED
-            knobTimeout = datetime.utcnow() + timedelta(seconds=KNOB_TIMEOUT_SECONDS)
+    if button is not None:
+        button.close()
+        rotor.close()
+    if inputs is not None:
+        inputs.stop()
+        inputs.join()
+    if ingest is not None:
+        ingest.stop()
+    if scheduler is not None:
+        scheduler.stop()
+        scheduler.join()
+        scheduler.close()
+    if daemons is not None:
+        daemons.stop()
+
+# gpiozero calls these from its own threads, the knob state machine only ever runs on the input thread
 
 def button_held():
-    global isHeld
-    global q
-    global knobState
-    isHeld = True
-    if knobState != KnobState.DEFAULT:
-        knobState = KnobState.DEFAULT
-        q.put(StateChange(power=10, flash=True, fadeTime=COL_MOD_FADE_TIME))
-    else:
-        q.put(ChangePreset(fadeTime=0.25))
+    inputs.post(knob.held)
 
 def button_released():
-    global isHeld
-    global singlePress
-    global knobState
-    global knobTimeout
-
-    if not isHeld:
-        if singlePress:
-            # Double click has occurred
-            singlePress = False
-            if knobState == KnobState.DEFAULT:
-                knobState = KnobState.MOD_RED
-                q.put(StateChange(red=100, green=0, blue=0, white=0, flash=True, postDelay=COL_MOD_DELAY_TIME, fadeTime=COL_MOD_FADE_TIME))
-                knobTimeout = datetime.utcnow() + timedelta(seconds=KNOB_TIMEOUT_SECONDS)
-                Timer(KNOB_TIMEOUT_SECONDS, check_knob_timeout).start()
-            else:
-                knobState = KnobState.DEFAULT
-                q.put(StateChange(power=10, flash=True, fadeTime=COL_MOD_FADE_TIME))
-        else:
-            # Single click has occurred
-            singlePress = True
-            Timer(DOUBLE_CLICK_TIME, check_double_click).start()
-    isHeld = False
+    inputs.post(knob.released)
 
 def clockwise_rotation():
-    global q
-    global knobState
-    global knobTimeout
-
-    if knobState == KnobState.DEFAULT:
-        q.put(Adjustment(power=10))
-    else:
-        knobTimeout = datetime.utcnow() + timedelta(seconds=KNOB_TIMEOUT_SECONDS)
-        if knobState == KnobState.MOD_RED:
-            q.put(Adjustment(colour=Colour(red=5)))
-        elif knobState == KnobState.MOD_GREEN:
-            q.put(Adjustment(colour=Colour(green=5)))
-        elif knobState == KnobState.MOD_BLUE:
-            q.put(Adjustment(colour=Colour(blue=5)))
-        elif knobState == KnobState.MOD_WHITE:
-            q.put(Adjustment(colour=Colour(white=5)))
+    inputs.post(partial(knob.rotated, 1))
 
 def counter_clockwise_rotation():
-    global q
-    global knobState
-    global knobTimeout
-
-    if knobState == KnobState.DEFAULT:
-        q.put(Adjustment(power=-10))
-    else:
-        knobTimeout = datetime.utcnow() + timedelta(seconds=KNOB_TIMEOUT_SECONDS)
-        if knobState == KnobState.MOD_RED:
-            q.put(Adjustment(colour=Colour(red=-5)))
-        elif knobState == KnobState.MOD_GREEN:
-            q.put(Adjustment(colour=Colour(green=-5)))
-        elif knobState == KnobState.MOD_BLUE:
-            q.put(Adjustment(colour=Colour(blue=-5)))
-        elif knobState == KnobState.MOD_WHITE:
-            q.put(Adjustment(colour=Colour(white=-5)))
-
-q = Queue()
-fadeThread = Fade()
-fadeThread.start()
-button = Button(SW_GPIO)
-rotor = RotaryEncoder(CLK_GPIO, DT_GPIO)
-button.hold_time = HOLD_TIME
-button.when_held = button_held
-button.when_released = button_released
-rotor.when_rotated_clockwise = clockwise_rotation
-rotor.when_rotated_counter_clockwise = counter_clockwise_rotation
-
+    inputs.post(partial(knob.rotated, -1))
@@ -0,0 +1,138 @@
+import logging
+import math
+import random
+from functools import lru_cache
+from itertools import combinations, product
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+from metrics import COUNT_BUCKETS, REGISTRY, Histogram
+
+ColourVector = Tuple[float, float, float, float]
+
+# Colour grids up to this size are enumerated up front, anything larger is sampled in batches
+ENUMERATE_LIMIT = 2048
+SAMPLE_BATCH = 64
+MAX_SAMPLE_BATCHES = 64
+
+log = logging.getLogger(__name__)
+
+SAMPLE_ITERATIONS = REGISTRY.register(Histogram(
+    "rgbw_aurora_sample_iterations", "Candidate colours tried to pick each aurora colour", buckets=COUNT_BUCKETS)).labels()
+
+class AuroraInfeasible(ValueError):
+    pass
+
+def normalize(vector: Sequence[float]) -> Tuple[float, ...]:
+    magnitude = math.sqrt(sum(component * component for component in vector))
+    if magnitude == 0:
+        return tuple(vector)
+    return tuple(component / magnitude for component in vector)
+
+def dist(a: Sequence[float], b: Sequence[float]) -> float:
+    return math.sqrt(sum((x - y) ** 2 for x, y in zip(a, b)))
+
+UNIT_WHITE = normalize((1, 1, 1, 0))
+
+class AuroraSampler:
+    def __init__(self, minColour: ColourVector, maxColour: ColourVector, minColourDist: float, rng: Optional[random.Random] = None):
+        self.ranges = tuple((int(low), int(high)) for low, high in zip(minColour, maxColour))
+        self.minColourDist = minColourDist
+        self.rng = rng if rng is not None else random.Random()
+        self._prefetched: Optional[Tuple[Tuple[float, ...], Tuple[int, ...]]] = None
+        # Falling back to the furthest colour is only logged the first time
+        self._warned = False
+
+        if any(low > high for low, high in self.ranges):
+            raise AuroraInfeasible("minColour must not exceed maxColour")
+
+        # Every colour in the box points somewhere within the cone its corners span, so the two corners furthest
+        # apart give its diameter. If that is short of minColourDist no cycle could ever move far enough
+        directions = [normalize(corner) for corner in product(*self.ranges) if any(corner)]
+        diameter = max((dist(a, b) for a, b in combinations(directions, 2)), default=0.0)
+        if diameter < minColourDist:
+            raise AuroraInfeasible("Colours in range are at most {0:.2f} apart, less than minColourDist {1}".format(
+                diameter, minColourDist))
+
+        gridSize = math.prod(high - low + 1 for low, high in self.ranges)
+        self.candidates: Optional[List[Tuple[Tuple[int, ...], Tuple[float, ...]]]] = None
+        if gridSize <= ENUMERATE_LIMIT:
+            self.candidates = [
+                candidate for candidate in map(self._candidate, product(*(range(low, high + 1) for low, high in self.ranges)))
+                if candidate is not None
+            ]
+            found = self.candidates
+        else:
+            # Colours too close to white make up a convex cone around it, so if any colour in the box is far enough
+            # from white one of its corners is, checking those is exact where a random probe could miss
+            corners = map(self._candidate, product(*self.ranges))
+            found = [candidate for candidate in corners if candidate is not None]
+        if not found:
+            raise AuroraInfeasible("No colour in range is at least {0} away from white".format(minColourDist))
+        # Fallback for the unlikely case that sampling never finds a colour away from white again
+        self.fallback = found[0][0]
+
+    def _candidate(self, colour: Tuple[int, ...]) -> Optional[Tuple[Tuple[int, ...], Tuple[float, ...]]]:
+        # Applies the checks that don't depend on the previous target
+        if not any(colour):
+            return None
+        if dist(normalize((colour[0], colour[1], colour[2], 0)), UNIT_WHITE) < self.minColourDist:
+            return None
+        return colour, normalize(colour)
+
+    def _drawBatch(self) -> Iterator[Tuple[Tuple[int, ...], Tuple[float, ...]]]:
+        # Lazy, so a batch stops being drawn as soon as a caller finds what it needs
+        randint = self.rng.randint
+        batch = (tuple(randint(low, high) for low, high in self.ranges) for _ in range(SAMPLE_BATCH))
+        return (candidate for candidate in map(self._candidate, batch) if candidate is not None)
+
+    def sample(self, previous: Sequence[float]) -> Tuple[int, ...]:
+        previous = tuple(previous)
+        if self._prefetched is not None and self._prefetched[0] == previous:
+            colour = self._prefetched[1]
+            self._prefetched = None
+            return colour
+        return self._sample(previous)
+
+    def prefetch(self, previous: Sequence[float]):
+        # Picks the colour that will follow previous, so the next cycle doesn't have to wait on sampling
+        previous = tuple(previous)
+        self._prefetched = (previous, self._sample(previous))
+
+    def _sample(self, previous: Tuple[float, ...]) -> Tuple[int, ...]:
+        normPrevious = normalize(previous)
+        best = None
+        bestDist = -1.0
+        tried = 0
+        # An enumerated grid can be scanned exactly, so it only gets one batch of random tries first
+        batches = 1 if self.candidates is not None else MAX_SAMPLE_BATCHES
+        for _ in range(batches):
+            if self.candidates is not None:
+                batch = (self.rng.choice(self.candidates) for _ in range(SAMPLE_BATCH))
+            else:
+                batch = self._drawBatch()
+            for colour, normalized in batch:
+                tried += 1
+                distance = dist(normalized, normPrevious)
+                if distance >= self.minColourDist:
+                    SAMPLE_ITERATIONS.observe(tried)
+                    return colour
+                if distance > bestDist:
+                    best, bestDist = colour, distance
+
+        SAMPLE_ITERATIONS.observe(tried if self.candidates is None else tried + len(self.candidates))
+        if self.candidates is not None:
+            valid = [colour for colour, normalized in self.candidates if dist(normalized, normPrevious) >= self.minColourDist]
+            if valid:
+                return self.rng.choice(valid)
+            best = max(self.candidates, key=lambda candidate: dist(candidate[1], normPrevious))[0]
+        if best is None:
+            best = self.fallback
+        # Nothing in range is far enough from the previous target, move as far from it as we can
+        if not self._warned:
+            self._warned = True
+            log.warning("No aurora colour is %s away from the previous target, using the furthest found", self.minColourDist)
+        return best
+
+@lru_cache(maxsize=8)
+def getAuroraSampler(minColour: ColourVector, maxColour: ColourVector, minColourDist: float) -> AuroraSampler:
+    return AuroraSampler(minColour, maxColour, minColourDist)
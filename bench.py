@@ -0,0 +1,425 @@
+import argparse
+import json
+import random
+import time
+import timeit
+import tracemalloc
+from queue import Queue, Empty
+from threading import Thread
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from curve import FadeCurve, INTERVALS, R, lerp
+from fadebackends import FRAME_TIME
+from taskqueue import TaskQueue, LatencyStats
+from aurora import AuroraInfeasible, AuroraSampler, UNIT_WHITE, dist, normalize
+from reducer import Colour, State, Adjustment, ChangePreset, Switch, StateChange, Aurora, applyTask
+from metrics import Counter, Histogram, JITTER_BUCKETS
+from remote import CMD_PWM, RemotePi
+from sim import FakePigpioServer, MockPi, Simulation
+from calibration import MAX_PWM_RANGE, Calibration
+from channels import ChannelWriter
+from journal import JournalEntry, readEntries, readJournal, replay
+
+TICK_REPEATS = 5
+TICK_NUMBER = 20000
+LATENCY_TASKS = 40
+AURORA_SAMPLES = 200
+# The legacy loop has no way out of infeasible settings, so the benchmark gives up on it here
+LEGACY_AURORA_LIMIT = 100000
+AURORA_RANGES = {
+    "wide": ((0, 0, 0, 0), (100, 100, 100, 100)),
+    "rgb": ((0, 0, 0, 0), (100, 100, 100, 0)),
+    "narrow": ((40, 0, 60, 0), (45, 5, 65, 5)),
+    "pinned": ((60, 60, 60, 0), (61, 61, 61, 0)),
+}
+AURORA_DISTS = (0.2, 0.4, 0.8)
+APPLY_NUMBER = 5000
+REMOTE_FRAMES = 500
+METRICS_NUMBER = 100000
+CALIBRATE_NUMBER = 100000
+# The identity table the defaults give, and a corrected one at the largest range
+CALIBRATIONS = {
+    "identity": lambda: Calibration(4),
+    "gamma_high_range": lambda: Calibration(4, MAX_PWM_RANGE, 2.2, (1.0, 0.8, 0.9, 1.0)),
+}
+# One way delay of a wifi hop to another pi
+REMOTE_LATENCY = 0.001
+# Tasks are built inside the timed call, as the knob and HTTP handlers build one per input
+APPLY_TASKS = {
+    "adjustment": lambda: Adjustment(power=10),
+    "colour_adjustment": lambda: Adjustment(colour=Colour(red=5)),
+    "switch": lambda: Switch(fadeTime=0.75),
+    "state_change": lambda: StateChange(red=100, green=0, blue=0, white=0, flash=True),
+    "change_preset": lambda: ChangePreset(fadeTime=0.25),
+    "aurora": lambda: Aurora(maxColour=Colour(red=100, green=100, blue=100)),
+}
+# The longest fade still stepped every frame, longer ones step once per curve interval
+SCHEDULER_FADE_TIME = INTERVALS * FRAME_TIME
+# A quick spin of the knob, a detent every 5ms, each faded to over a short fade so later ones preempt it
+KNOB_DETENTS = 60
+KNOB_INTERVAL = 0.005
+KNOB_FADE_TIME = 0.1
+# Detents the encoder reports between two scheduler passes, taken as a single run
+KNOB_DETENTS_PER_PASS = 2
+# Bursts of concurrent requests, each landing within a single scheduler pass
+HTTP_FIXTURES = 4
+HTTP_BATCHES = 20
+HTTP_BATCH_SIZE = 10
+HTTP_INTERVAL = 0.005
+# The recorded session replayed when no --journal is given: a knob spin, a flash and a few aurora cycles
+JOURNAL_AURORA_CYCLES = 5
+# Changes beyond this are flagged by --compare
+REGRESSION_THRESHOLD = 0.1
+
+# Figures from this run, keyed benchmark.metric, for --save and --compare
+RESULTS: Dict[str, float] = {}
+
+def record(name: str, value: float) -> float:
+    RESULTS[name] = value
+    return value
+
+def legacyTick(start, target, currentInterval):
+    increasingC = (2.0 ** (currentInterval / R) - 1) / 255.0
+    decreasingC = 1.0 - ((2.0 ** ((INTERVALS - currentInterval) / R) - 1) / 255.0)
+    return tuple(
+        lerp(startVal, targetVal, increasingC if targetVal > startVal else decreasingC)
+        for startVal, targetVal in zip(start, target)
+    )
+
+def benchFadeTick():
+    start = (0, 64, 255, 10)
+    target = (255, 32, 0, 200)
+    # A 0.75s fade at a 10ms tick visits roughly every fourth interval
+    intervals = [(tick * 4) % (INTERVALS + 1) for tick in range(TICK_NUMBER)]
+
+    def legacy():
+        for interval in intervals:
+            legacyTick(start, target, interval)
+
+    def table():
+        curve = FadeCurve(start, target)
+        for interval in intervals:
+            curve.dutyCycles(interval)
+
+    legacyCost = min(timeit.repeat(legacy, repeat=TICK_REPEATS, number=1)) / TICK_NUMBER
+    tableCost = min(timeit.repeat(table, repeat=TICK_REPEATS, number=1)) / TICK_NUMBER
+    buildCost = min(timeit.repeat(lambda: FadeCurve(start, target).dutyCycles(INTERVALS), repeat=TICK_REPEATS, number=1000)) / 1000
+    print("fade tick: legacy {0:.2f}us, table {1:.2f}us ({2:.1f}x), curve setup {3:.2f}us".format(
+        legacyCost * 1e6, tableCost * 1e6, legacyCost / tableCost, buildCost * 1e6))
+    record("fade_tick.table_us", tableCost * 1e6)
+    record("fade_tick.curve_setup_us", buildCost * 1e6)
+
+    # A whole scheduler pass per frame, stepping the fixture and writing its channels
+    sim = Simulation()
+    sim.fixtures[0].queue.put(StateChange(red=100, green=0, blue=0, white=0, fadeTime=SCHEDULER_FADE_TIME))
+    writes = sim.writes
+    start = time.perf_counter()
+    sim.settle()
+    frameCost = (time.perf_counter() - start) / (SCHEDULER_FADE_TIME / FRAME_TIME)
+    print("fade tick: scheduler frame {0:.2f}us, {1} pwm writes".format(frameCost * 1e6, sim.writes - writes))
+    record("fade_tick.scheduler_frame_us", frameCost * 1e6)
+    record("fade_tick.pwm_writes", sim.writes - writes)
+    sim.close()
+
+def legacyConsumer(q, stats):
+    # The old idle loop, polling the queue every 50ms
+    handled = 0
+    while handled < LATENCY_TASKS:
+        try:
+            enqueuedAt = q.get_nowait()
+        except Empty:
+            time.sleep(0.05)
+            continue
+        stats.record(time.monotonic() - enqueuedAt)
+        handled += 1
+
+def eventConsumer(q, stats):
+    handled = 0
+    while handled < LATENCY_TASKS:
+        if not q.waitForTask():
+            continue
+        q.get_nowait()
+        stats.record(time.monotonic() - q.lastEnqueuedAt)
+        handled += 1
+
+def measureLatency(q, consumer, putTask):
+    stats = LatencyStats()
+    thread = Thread(target=consumer, args=(q, stats))
+    thread.start()
+    rng = random.Random(1)
+    for _ in range(LATENCY_TASKS):
+        time.sleep(rng.uniform(0.02, 0.08))
+        putTask(q)
+    thread.join()
+    return stats.summary()
+
+def benchTaskLatency():
+    legacy = measureLatency(Queue(), legacyConsumer, lambda q: q.put(time.monotonic()))
+    event = measureLatency(TaskQueue(), eventConsumer, lambda q: q.put(None))
+    for name, summary in (("legacy poll", legacy), ("event wait", event)):
+        print("enqueue to dequeue, {0}: p50 {1:.2f}ms, p99 {2:.2f}ms".format(name, summary["p50_ms"], summary["p99_ms"]))
+    record("task_latency.p50_ms", event["p50_ms"])
+    record("task_latency.p99_ms", event["p99_ms"])
+
+def legacyAuroraSample(minColour, maxColour, minColourDist, previous, rng):
+    # The applyTask rejection loop, minus the pydantic objects it used to build per draw
+    normPrevious = normalize(previous)
+    for iteration in range(1, LEGACY_AURORA_LIMIT + 1):
+        colour = tuple(rng.randint(int(low), int(high)) for low, high in zip(minColour, maxColour))
+        distToWhite = dist(normalize((colour[0], colour[1], colour[2], 0)), UNIT_WHITE)
+        distToOldTarget = dist(normalize(colour), normPrevious)
+        if distToWhite >= minColourDist and distToOldTarget >= minColourDist and any(colour):
+            return colour, iteration
+    return None, LEGACY_AURORA_LIMIT
+
+def benchAurora():
+    for rangeName, (minColour, maxColour) in AURORA_RANGES.items():
+        for minColourDist in AURORA_DISTS:
+            rng = random.Random(1)
+            previous = (50, 50, 50, 50)
+            legacyStart = time.perf_counter()
+            legacyIterations = 0
+            for _ in range(AURORA_SAMPLES):
+                colour, iterations = legacyAuroraSample(minColour, maxColour, minColourDist, previous, rng)
+                legacyIterations += iterations
+                if colour is None:
+                    break
+                previous = colour
+            legacyCost = (time.perf_counter() - legacyStart) / AURORA_SAMPLES
+            legacyResult = "{0:.1f}us ({1:.0f} draws/sample)".format(legacyCost * 1e6, legacyIterations / AURORA_SAMPLES)
+            if colour is None:
+                legacyResult = "stuck after {0} draws".format(LEGACY_AURORA_LIMIT)
+
+            samplerStart = time.perf_counter()
+            try:
+                sampler = AuroraSampler(minColour, maxColour, minColourDist, random.Random(1))
+            except AuroraInfeasible as e:
+                print("aurora {0} dist {1}: legacy {2}, sampler rejects settings in {3:.1f}us ({4})".format(
+                    rangeName, minColourDist, legacyResult, (time.perf_counter() - samplerStart) * 1e6, e))
+                continue
+            setupCost = time.perf_counter() - samplerStart
+            previous = (50, 50, 50, 50)
+            samplerStart = time.perf_counter()
+            for _ in range(AURORA_SAMPLES):
+                previous = sampler.sample(previous)
+            samplerCost = (time.perf_counter() - samplerStart) / AURORA_SAMPLES
+            print("aurora {0} dist {1}: legacy {2}, sampler {3:.1f}us (setup {4:.1f}us)".format(
+                rangeName, minColourDist, legacyResult, samplerCost * 1e6, setupCost * 1e6))
+            record("aurora.{0}_{1}_us".format(rangeName, minColourDist), samplerCost * 1e6)
+
+def benchApplyTask():
+    state = State(power=50)
+    for name, makeTask in APPLY_TASKS.items():
+        call = lambda: applyTask(makeTask(), state)
+        cost = min(timeit.repeat(call, repeat=TICK_REPEATS, number=APPLY_NUMBER)) / APPLY_NUMBER
+        tracemalloc.start()
+        call()
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        call()
+        peak = tracemalloc.get_traced_memory()[1] - baseline
+        tracemalloc.stop()
+        print("applyTask {0}: {1:.2f}us, {2} bytes peak".format(name, cost * 1e6, peak))
+        record("apply_task.{0}_us".format(name), cost * 1e6)
+        record("apply_task.{0}_bytes".format(name), peak)
+
+def benchRemoteWrites():
+    server = FakePigpioServer(latency=REMOTE_LATENCY).start()
+    pi = RemotePi(server.host, server.port)
+    pins = (26, 19, 13, 6)
+
+    def roundTripFrame(frame):
+        # What pigpio.pi does, every write waits for its reply
+        with pi.pool.connection() as connection:
+            for pin in pins:
+                connection.call(CMD_PWM, pin, frame % 256)
+
+    def pipelinedFrame(frame):
+        for pin in pins:
+            pi.set_PWM_dutycycle(pin, frame % 256)
+
+    def batchedFrame(frame):
+        # What ChannelWriter sends, every changed channel in one write
+        pi.set_PWM_dutycycles([(pin, frame % 256) for pin in pins])
+
+    for name, writeFrame in (("round trip", roundTripFrame), ("pipelined", pipelinedFrame), ("batched", batchedFrame)):
+        start = time.perf_counter()
+        for frame in range(REMOTE_FRAMES):
+            writeFrame(frame)
+        cost = (time.perf_counter() - start) / REMOTE_FRAMES
+        print("remote {0}: {1:.1f}us per 4 channel frame".format(name, cost * 1e6))
+        record("remote_writes.{0}_us".format(name.replace(" ", "_")), cost * 1e6)
+    print("remote metrics: {0}".format(pi.metrics.summary()))
+    pi.stop()
+    server.stop()
+
+def benchMetrics():
+    # What the fade loop pays per frame to stay instrumented
+    jitter = Histogram("bench_jitter_seconds", "", ("fixture",), JITTER_BUCKETS).labels("bench")
+    preempted = Counter("bench_preempted_total", "", ("fixture",)).labels("bench")
+    for name, call in (("histogram observe", lambda: jitter.observe(0.0007)), ("counter inc", preempted.inc)):
+        cost = min(timeit.repeat(call, repeat=TICK_REPEATS, number=METRICS_NUMBER)) / METRICS_NUMBER
+        print("metrics {0}: {1:.3f}us, {2:.4f}% of a {3:.0f}ms frame".format(name, cost * 1e6, cost / FRAME_TIME * 100, FRAME_TIME * 1000))
+        record("metrics.{0}_us".format(name.replace(" ", "_")), cost * 1e6)
+
+def runScenario(name: str, sim: Simulation, inputs: int, interval: float, putInput: Callable[[int], None],
+                delays: Optional[Sequence[float]] = None):
+    # Inputs arrive on the virtual clock, so everything but the cpu time is the same from run to run
+    # delays, when given, is the time after each input instead of a fixed interval
+    preempted = sum(fixture.preempted.value for fixture in sim.fixtures)
+    coalesced = sum(fixture.queue.coalesced for fixture in sim.fixtures)
+    writes = sim.writes
+    start = time.perf_counter()
+    for idx in range(inputs):
+        putInput(idx)
+        sim.run(interval if delays is None else delays[idx])
+    settle = sim.settle()
+    cost = (time.perf_counter() - start) / inputs
+    preempted = sum(fixture.preempted.value for fixture in sim.fixtures) - preempted
+    coalesced = sum(fixture.queue.coalesced for fixture in sim.fixtures) - coalesced
+    writes = sim.writes - writes
+    print("{0}: {1:.1f}us cpu per input, settled {2:.0f}ms after the last, {3} pwm writes, {4:.0f} fades preempted, {5} tasks coalesced".format(
+        name, cost * 1e6, settle * 1000, writes, preempted, coalesced))
+    record("{0}.cpu_per_input_us".format(name), cost * 1e6)
+    record("{0}.settle_ms".format(name), settle * 1000)
+    record("{0}.pwm_writes".format(name), writes)
+    record("{0}.preempted".format(name), preempted)
+    record("{0}.coalesced".format(name), coalesced)
+    sim.close()
+
+def benchKnobBurst():
+    # Turns the knob down then back up, the way the rotary encoder handlers queue adjustments
+    sim = Simulation()
+    fixture = sim.fixtures[0]
+    def putDetents(idx: int):
+        for detent in range(idx * KNOB_DETENTS_PER_PASS, (idx + 1) * KNOB_DETENTS_PER_PASS):
+            fixture.queue.put(Adjustment(power=-10 if detent < KNOB_DETENTS // 2 else 10, fadeTime=KNOB_FADE_TIME))
+
+    runScenario("knob_burst", sim, KNOB_DETENTS // KNOB_DETENTS_PER_PASS, KNOB_INTERVAL * KNOB_DETENTS_PER_PASS, putDetents)
+
+def benchHttpBurst():
+    # Batches of requests fading every fixture to a new colour, as submitted by the task ingest
+    sim = Simulation(HTTP_FIXTURES)
+    rng = random.Random(1)
+
+    def putBatch(idx):
+        for _ in range(HTTP_BATCH_SIZE):
+            task = StateChange(red=rng.randint(0, 100), green=rng.randint(0, 100), blue=rng.randint(0, 100), white=0, fadeTime=0.75)
+            sim.scheduler.submit((fixture, task) for fixture in sim.fixtures)
+
+    runScenario("http_burst", sim, HTTP_BATCHES, HTTP_INTERVAL, putBatch)
+
+def recordSession() -> Tuple[List[JournalEntry], List[Tuple[int, bytes]], int]:
+    # A journalled run of the fade engine, standing in for a production journal
+    sim = Simulation(journal=True)
+    fixture = sim.fixtures[0]
+    for idx in range(KNOB_DETENTS):
+        fixture.queue.put(Adjustment(power=-10 if idx < KNOB_DETENTS // 2 else 10))
+        sim.run(KNOB_INTERVAL)
+    fixture.queue.put(StateChange(red=100, green=0, blue=0, white=0, flash=True, fadeTime=0.15, postDelay=0.15))
+    sim.run(1)
+    fixture.queue.put(Aurora(maxColour=Colour(red=100, green=100, blue=100), fadeTime=1, postDelay=1))
+    sim.run(JOURNAL_AURORA_CYCLES * 2)
+    fixture.queue.put(ChangePreset(fadeTime=0.25))
+    sim.settle()
+    fixture.journal.stop()
+    entries = list(readEntries(fixture.journal.path))
+    records, length = readJournal(fixture.journal.path)
+    sim.close()
+    return entries, records, length
+
+def benchJournal(paths: Optional[List[str]] = None):
+    if paths:
+        entries = [entry for path in paths for entry in readEntries(path)]
+        records, length = readJournal(paths[-1])
+    else:
+        entries, records, length = recordSession()
+    if not entries:
+        print("journal: nothing to replay")
+        return
+
+    # The scheduler thread only queues a task to be journalled, encoding and syncing happen on the journal's thread
+    sim = Simulation(journal=True)
+    journal = sim.fixtures[0].journal
+    state = State()
+    cost = min(timeit.repeat(lambda: journal.append(Switch(), state), repeat=TICK_REPEATS, number=APPLY_NUMBER)) / APPLY_NUMBER
+    sim.close()
+    print("journal append: {0:.2f}us, {1:.1f} bytes per record".format(cost * 1e6, length / len(records)))
+    record("journal.append_us", cost * 1e6)
+    record("journal.bytes_per_record", length / len(records))
+
+    # Rebuilding a fixture's state after a crash
+    cost = min(timeit.repeat(lambda: replay(records), repeat=TICK_REPEATS, number=1)) / len(records)
+    print("journal recovery: {0:.2f}us per record, {1:.1f}ms for {2} records".format(cost * 1e6, cost * len(records) * 1000, len(records)))
+    record("journal.recover_us", cost * 1e6)
+
+    # The inputs fed back in at the times they were applied, the fixture queues its own flash returns and aurora cycles again
+    inputs = [entry for entry in entries if not entry.generated]
+    delays = [after.appliedAt - before.appliedAt for before, after in zip(inputs, inputs[1:])] + [0.0]
+    sim = Simulation()
+    fixture = sim.fixtures[0]
+    runScenario("journal_replay", sim, len(inputs), 0, lambda idx: fixture.queue.put(inputs[idx].task), delays)
+
+def compareResults(path: str):
+    with open(path, 'r') as f:
+        baseline = json.load(f)
+    for name, value in RESULTS.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]
+        change = (value - before) / before if before else (0.0 if value == before else float("inf"))
+        flag = "  <-- regressed" if change > REGRESSION_THRESHOLD else ""
+        print("{0}: {1:.2f} -> {2:.2f} ({3:+.1%}){4}".format(name, before, value, change, flag))
+
+def benchCalibration():
+    # What a frame pays to map levels through the tables, against the plain truncation it replaced
+    frame = (127.3, 64.8, 200.1, 12.6)
+    legacy = lambda: [int(value) for value in frame]
+    cost = min(timeit.repeat(legacy, repeat=TICK_REPEATS, number=CALIBRATE_NUMBER)) / CALIBRATE_NUMBER
+    print("calibration int: {0:.3f}us per 4 channel frame".format(cost * 1e6))
+    record("calibration.int_us", cost * 1e6)
+    for name, makeCalibration in CALIBRATIONS.items():
+        start = time.perf_counter()
+        writer = ChannelWriter(MockPi(), (26, 19, 13, 6), makeCalibration())
+        setup = time.perf_counter() - start
+        call = lambda: writer.calibrate(frame)
+        cost = min(timeit.repeat(call, repeat=TICK_REPEATS, number=CALIBRATE_NUMBER)) / CALIBRATE_NUMBER
+        print("calibration {0}: {1:.3f}us per 4 channel frame, {2:.1f}ms setup".format(name, cost * 1e6, setup * 1000))
+        record("calibration.{0}_us".format(name), cost * 1e6)
+        record("calibration.{0}_setup_ms".format(name), setup * 1000)
+
+BENCHMARKS = {
+    "fade_tick": benchFadeTick,
+    "task_latency": benchTaskLatency,
+    "aurora": benchAurora,
+    "apply_task": benchApplyTask,
+    "remote_writes": benchRemoteWrites,
+    "metrics": benchMetrics,
+    "calibration": benchCalibration,
+    "journal": benchJournal,
+    "knob_burst": benchKnobBurst,
+    "http_burst": benchHttpBurst,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Runs every benchmark, or just the ones named")
+    parser.add_argument("benchmarks", nargs="*", metavar="benchmark", help=", ".join(BENCHMARKS))
+    parser.add_argument("--save", metavar="PATH", help="write the results to a JSON file")
+    parser.add_argument("--compare", metavar="PATH", help="compare the results against a file written by --save")
+    parser.add_argument("--journal", metavar="PATH", action="append",
+                        help="replay a fixture's journal in the journal benchmark, oldest first if given more than once")
+    args = parser.parse_args()
+    unknown = [name for name in args.benchmarks if name not in BENCHMARKS]
+    if unknown:
+        parser.error("unknown benchmark {0}".format(", ".join(unknown)))
+
+    for name in args.benchmarks or list(BENCHMARKS):
+        if name == "journal":
+            benchJournal(args.journal)
+        else:
+            BENCHMARKS[name]()
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(RESULTS, f, indent=2, sort_keys=True)
+    if args.compare:
+        compareResults(args.compare)
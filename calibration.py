@@ -0,0 +1,35 @@
+from array import array
+from functools import lru_cache
+from typing import Optional, Sequence
+
+# The fade engine works in levels from 0 to this, the calibration maps them onto the PWM range
+MAX_LEVEL = 255
+# pigpio's own default range, with a linear table levels are written unchanged
+DEFAULT_PWM_RANGE = 255
+MIN_PWM_RANGE = 25
+MAX_PWM_RANGE = 40000
+
+@lru_cache(maxsize=None)
+def buildTable(pwmRange: int, gamma: float, gain: float) -> array:
+    # One entry per output step, so the hot path maps a level with a multiply and an index
+    return array('I', (round(pwmRange * gain * (step / pwmRange) ** gamma) for step in range(pwmRange + 1)))
+
+class Calibration:
+    __slots__ = ('pwmRange', 'pwmFrequency', 'gamma', 'whiteBalance', 'scale', 'tables')
+
+    def __init__(self, channels: int, pwmRange: int = DEFAULT_PWM_RANGE, gamma: float = 1.0,
+                 whiteBalance: Optional[Sequence[float]] = None, pwmFrequency: Optional[int] = None):
+        whiteBalance = (1.0,) * channels if whiteBalance is None else tuple(whiteBalance)
+        if not MIN_PWM_RANGE <= pwmRange <= MAX_PWM_RANGE:
+            raise ValueError("PWM range must be between {0} and {1}".format(MIN_PWM_RANGE, MAX_PWM_RANGE))
+        if gamma <= 0:
+            raise ValueError("Gamma must be positive")
+        if len(whiteBalance) != channels or not all(0 <= gain <= 1 for gain in whiteBalance):
+            raise ValueError("White balance needs a gain between 0 and 1 for each of the {0} channels".format(channels))
+        self.pwmRange = pwmRange
+        # Left at the daemon's setting when None, the range it can really resolve depends on it
+        self.pwmFrequency = pwmFrequency
+        self.gamma = gamma
+        self.whiteBalance = whiteBalance
+        self.scale = pwmRange / MAX_LEVEL
+        self.tables = tuple(buildTable(pwmRange, gamma, gain) for gain in whiteBalance)
@@ -0,0 +1,149 @@
+import time
+from bisect import bisect_left
+from threading import Lock
+from typing import Callable, List, Optional, Sequence, Tuple
+
+import pigpio
+
+from calibration import Calibration
+from remote import RemotePi
+
+SCRIPT_READY_TIMEOUT = 1.0
+
+def storeScript(pi: pigpio.pi, script: str) -> int:
+    # Stores a script and waits for the daemon to finish parsing it, which takes longer the larger it is
+    scriptId = pi.store_script(script.encode())
+    deadline = time.monotonic() + SCRIPT_READY_TIMEOUT
+    while pi.script_status(scriptId)[0] == pigpio.PI_SCRIPT_INITING:
+        if time.monotonic() > deadline:
+            pi.delete_script(scriptId)
+            raise pigpio.error("script did not become ready")
+        time.sleep(0.001)
+    return scriptId
+
+class DutyCycleShadow:
+    def __init__(self, channels: int):
+        self._lock = Lock()
+        self._current: Tuple[float, ...] = (0.0,) * channels
+        self._target: Tuple[float, ...] = (0.0,) * channels
+        # Called with the duty cycles after every write
+        self.onCurrent: Optional[Callable[[Tuple[float, ...]], None]] = None
+
+    def current(self) -> Tuple[float, ...]:
+        with self._lock:
+            return self._current
+
+    def target(self) -> Tuple[float, ...]:
+        with self._lock:
+            return self._target
+
+    def setCurrent(self, values: Sequence[float]):
+        current = tuple(values)
+        with self._lock:
+            self._current = current
+        if self.onCurrent is not None:
+            self.onCurrent(current)
+
+    def setTarget(self, values: Sequence[float]):
+        with self._lock:
+            self._target = tuple(values)
+
+class ChannelWriter:
+    # Takes duty cycles as fade engine levels, the daemon is sent them mapped through the calibration
+    def __init__(self, pi: pigpio.pi, pins: Sequence[int], calibration: Optional[Calibration] = None):
+        self.pi = pi
+        self.pins = tuple(pins)
+        self.calibration = calibration or Calibration(len(self.pins))
+        self.tables = self.calibration.tables
+        self.scale = self.calibration.scale
+        # As last sent to the daemon, after calibration
+        self.lastWritten: List[Optional[int]] = [None] * len(self.pins)
+        self.shadow = DutyCycleShadow(len(self.pins))
+        self._configurePwm()
+        # A remote connection sends a frame's writes together itself, and a script would hide them from its re-push
+        self.batchWrites = isinstance(pi, RemotePi)
+        self.scriptId = None if self.batchWrites else self._storeScript()
+
+    def _storeScript(self) -> Optional[int]:
+        # A stored script sets every channel from its parameters, so a full update is a single daemon round trip
+        script = " ".join("pwm {0} p{1}".format(pin, idx) for idx, pin in enumerate(self.pins))
+        try:
+            return storeScript(self.pi, script)
+        except pigpio.error as e:
+            print("Unable to store PWM script, writing channels individually: {0}".format(e))
+            return None
+
+    def _configurePwm(self):
+        # A daemon keeps the settings of whatever ran before, so they are always set
+        try:
+            for pin in self.pins:
+                if self.calibration.pwmFrequency is not None:
+                    self.pi.set_PWM_frequency(pin, self.calibration.pwmFrequency)
+                self.pi.set_PWM_range(pin, self.calibration.pwmRange)
+        except pigpio.error as e:
+            print("Unable to set PWM range: {0}".format(e))
+
+    def calibrate(self, dutyCycles: Sequence[float]) -> List[int]:
+        scale = self.scale
+        # Rounded, truncating would miss full scale wherever 255 * (pwmRange / 255) lands just under pwmRange
+        return [table[round(value * scale)] for value, table in zip(dutyCycles, self.tables)]
+
+    def write(self, dutyCycles: Sequence[float]):
+        values = self.calibrate(dutyCycles)
+        changed = [idx for idx, value in enumerate(values) if value != self.lastWritten[idx]]
+        if not changed:
+            # Nothing for the daemon, but the next fade starts from these levels
+            self.shadow.setCurrent(dutyCycles)
+            return
+
+        if len(changed) > 1 and self.batchWrites:
+            self.pi.set_PWM_dutycycles([(self.pins[idx], values[idx]) for idx in changed])
+            self.lastWritten = values
+            self.shadow.setCurrent(dutyCycles)
+            return
+
+        if len(changed) > 1 and self.scriptId is not None:
+            try:
+                self.pi.run_script(self.scriptId, values)
+                self.lastWritten = values
+                self.shadow.setCurrent(dutyCycles)
+                return
+            except pigpio.error as e:
+                print("PWM script failed, writing channels individually: {0}".format(e))
+
+        for idx in changed:
+            self.pi.set_PWM_dutycycle(self.pins[idx], values[idx])
+            self.lastWritten[idx] = values[idx]
+        self.shadow.setCurrent(dutyCycles)
+
+    def assume(self, dutyCycles: Sequence[float]):
+        # Records values that something else, such as a daemon side fade script, has already written
+        values = self.calibrate(dutyCycles)
+        self.lastWritten = values
+        self.shadow.setCurrent(dutyCycles)
+        if isinstance(self.pi, RemotePi):
+            self.pi.remember(zip(self.pins, values))
+
+    def readBack(self):
+        # Takes the channels as the daemon has them, levels are the lowest that calibrate to what it reports
+        values = [self.pi.get_PWM_dutycycle(pin) for pin in self.pins]
+        levels = [min(bisect_left(table, value), len(table) - 1) / self.scale for value, table in zip(values, self.tables)]
+        self.lastWritten = values
+        self.shadow.setCurrent(levels)
+        if isinstance(self.pi, RemotePi):
+            self.pi.remember(zip(self.pins, values))
+
+    def forget(self):
+        # The daemon's outputs aren't known, so the next write sends every channel
+        self.lastWritten = [None] * len(self.pins)
+
+    def read(self) -> Tuple[float, ...]:
+        return self.shadow.current()
+
+    def close(self):
+        if self.scriptId is not None:
+            try:
+                self.pi.delete_script(self.scriptId)
+            except pigpio.error as e:
+                print("Unable to delete PWM script: {0}".format(e))
+            self.scriptId = None
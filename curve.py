@@ -0,0 +1,68 @@
+import math
+from array import array
+from typing import List, Optional, Sequence, Tuple
+
+INTERVALS = 300
+R = max((INTERVALS * math.log(2,10)) / math.log(255,10), 0.1)
+
+def lerp(A: float, B: float, C: float) -> float:
+    return A + C * (B - A)
+
+# The perceptual curve only depends on R, so both directions are built once at import
+INCREASING_CURVE = array('d', ((2.0 ** (interval / R) - 1) / 255.0 for interval in range(INTERVALS + 1)))
+DECREASING_CURVE = array('d', (1.0 - ((2.0 ** ((INTERVALS - interval) / R) - 1) / 255.0) for interval in range(INTERVALS + 1)))
+
+def toPerceptual(dutyCycle: float) -> float:
+    # Position along the curve, in intervals, at which a full 0-255 fade passes this duty cycle
+    return R * math.log2(max(0.0, dutyCycle) + 1)
+
+def fromPerceptual(position: float) -> float:
+    return 2.0 ** (position / R) - 1
+
+class FadeCurve:
+    __slots__ = ('start', 'target', 'span', 'channelCurves', 'rows')
+
+    def __init__(self, start: Sequence[float], target: Sequence[float]):
+        self.start = tuple(start)
+        self.target = tuple(target)
+        # Perceptual distance of the channel that has furthest to travel
+        self.span = max(
+            abs(toPerceptual(targetVal) - toPerceptual(startVal))
+            for startVal, targetVal in zip(self.start, self.target)
+        )
+        self.channelCurves = tuple(
+            INCREASING_CURVE if targetVal > startVal else DECREASING_CURVE
+            for startVal, targetVal in zip(self.start, self.target)
+        )
+        # Rows are filled in the first time an interval is visited, a short fade only touches a handful of them
+        self.rows: List[Optional[Tuple[float, ...]]] = [None] * (INTERVALS + 1)
+
+    def dutyCycles(self, interval: int) -> Tuple[float, ...]:
+        row = self.rows[interval]
+        if row is None:
+            row = self._buildRow(interval)
+            self.rows[interval] = row
+        return row
+
+    def _buildRow(self, interval: int) -> Tuple[float, ...]:
+        return tuple(
+            lerp(startVal, targetVal, channelCurve[interval])
+            for startVal, targetVal, channelCurve in zip(self.start, self.target, self.channelCurves)
+        )
+
+class RetargetCurve(FadeCurve):
+    __slots__ = ('startPositions', 'targetPositions')
+
+    def __init__(self, start: Sequence[float], target: Sequence[float]):
+        FadeCurve.__init__(self, start, target)
+        # Starting a fresh curve mid-fade would stall on its flat end, so each channel
+        # moves at a constant rate through perceptual space from wherever it currently is
+        self.startPositions = tuple(toPerceptual(value) for value in self.start)
+        self.targetPositions = tuple(toPerceptual(value) for value in self.target)
+
+    def _buildRow(self, interval: int) -> Tuple[float, ...]:
+        fraction = interval / INTERVALS
+        return tuple(
+            fromPerceptual(lerp(startPos, targetPos, fraction))
+            for startPos, targetPos in zip(self.startPositions, self.targetPositions)
+        )
@@ -0,0 +1,248 @@
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+from functools import partial
+from threading import Lock
+from typing import Callable, List, Optional, Sequence, Tuple
+
+import pigpio
+
+from channels import ChannelWriter, storeScript
+from curve import FadeCurve, INTERVALS
+
+FRAME_TIME = 0.01
+# Keeps a compiled fade script well inside the daemon's command extension limit
+MAX_SCRIPT_FRAMES = 1000
+# How often a fade waiting on its script's upload or last frame is checked
+SCRIPT_POLL_TIME = 0.001
+# Longest delays a single mics or mils script command takes
+MAX_MICS_DELAY = 1000000
+MAX_MILS_DELAY = 60000
+
+# Fade scripts are compiled and stored here, a large one would otherwise hold up every fixture's frames
+SCRIPT_UPLOADS = ThreadPoolExecutor(max_workers=1, thread_name_prefix="fade-scripts")
+
+class ScriptPhase(Enum):
+    IDLE = 1
+    UPLOADING = 2
+    RUNNING = 3
+    FAILED = 4
+
+def getDelayCommands(seconds: float) -> List[str]:
+    # A long fade's frames are further apart than one command can wait, they are split into as many as it takes
+    micros = max(1, round(seconds * 1000000))
+    if micros <= MAX_MICS_DELAY:
+        return ["mics {0}".format(micros)]
+    millis = round(micros / 1000)
+    commands = ["mils {0}".format(MAX_MILS_DELAY)] * (millis // MAX_MILS_DELAY)
+    if millis % MAX_MILS_DELAY:
+        commands.append("mils {0}".format(millis % MAX_MILS_DELAY))
+    return commands
+
+def getInterval(elapsed: float, fadeTime: float) -> int:
+    return INTERVALS if fadeTime == 0 else math.floor(min(1.0, elapsed / fadeTime) * INTERVALS)
+
+class TickFadeBackend:
+    def __init__(self, writer: ChannelWriter):
+        self.writer = writer
+        self.curve: Optional[FadeCurve] = None
+        self.fadeTime = 0.0
+        # When the most recent fade started
+        self.startedAt = 0.0
+        self.frameTime = FRAME_TIME
+        self.nextFrame = 0.0
+        self.deadline = 0.0
+
+    def start(self, curve: FadeCurve, fadeTime: float, now: float):
+        self.curve = curve
+        self.fadeTime = fadeTime
+        self.startedAt = now
+        # No point waking more often than the curve moves to its next interval
+        self.frameTime = max(FRAME_TIME, fadeTime / INTERVALS)
+        self.nextFrame = now
+        self.deadline = now
+
+    def step(self, now: float) -> Optional[float]:
+        # Writes the frame due at now, returns when the next one is due or None once the fade is over
+        if now < self.deadline:
+            return self.deadline
+        dt = now - self.startedAt
+        self.writer.write(self.curve.dutyCycles(getInterval(dt, self.fadeTime)))
+        # A NaN fadeTime fails every comparison, written this way it ends the fade rather than pinning it
+        if not dt < self.fadeTime:
+            return None
+
+        self.nextFrame += self.frameTime
+        if self.nextFrame < now:
+            # Running behind, don't try to catch up on missed frames
+            self.nextFrame = now + self.frameTime
+        self.deadline = min(self.nextFrame, self.startedAt + self.fadeTime)
+        return self.deadline
+
+    def cancel(self, now: float):
+        pass
+
+class ScriptFadeBackend:
+    def __init__(self, pi: pigpio.pi, writer: ChannelWriter, clock: Callable[[], float] = time.monotonic,
+                 submit: Optional[Callable[[Callable[[], None]], object]] = None):
+        self.pi = pi
+        self.writer = writer
+        # The fixture's clock, so fades time the same on a virtual one
+        self.clock = clock
+        # Runs an upload job, off the fade thread unless told otherwise
+        self.submit = SCRIPT_UPLOADS.submit if submit is None else submit
+        self.fallback = TickFadeBackend(writer)
+        self.usingFallback = False
+        self.scriptId: Optional[int] = None
+        self.curve: Optional[FadeCurve] = None
+        self.fadeTime = 0.0
+        self.frames: List[Tuple[float, ...]] = []
+        self.frameTime = FRAME_TIME
+        self.startedAt = 0.0
+        self.endTime = 0.0
+        # Guards the fields an upload job sets once its script is running
+        self._lock = Lock()
+        self.phase = ScriptPhase.IDLE
+        # Identifies the current upload, a job that finds it replaced gives up and deletes its script
+        self._upload: Optional[object] = None
+
+    def compile(self, curve: FadeCurve, fadeTime: float) -> Tuple[float, List[Tuple[float, ...]]]:
+        # Duty cycles for every frame of the fade, the last frame is the end of the curve
+        frameCount = max(1, min(MAX_SCRIPT_FRAMES, math.ceil(fadeTime / FRAME_TIME)))
+        frameTime = fadeTime / frameCount
+        frames = [curve.dutyCycles(getInterval(frame * frameTime, fadeTime)) for frame in range(1, frameCount + 1)]
+        return frameTime, frames
+
+    def toScript(self, frameTime: float, frames: List[Tuple[float, ...]], previous: Sequence[Optional[int]]) -> str:
+        # The daemon writes the calibrated values, so the script holds them rather than levels
+        delay = getDelayCommands(frameTime)
+        commands = []
+        for frame in frames:
+            values = self.writer.calibrate(frame)
+            commands.extend(delay)
+            commands.extend(
+                "pwm {0} {1}".format(pin, value)
+                for pin, value, previousValue in zip(self.writer.pins, values, previous)
+                if value != previousValue
+            )
+            previous = values
+        return " ".join(commands)
+
+    def start(self, curve: FadeCurve, fadeTime: float, now: float):
+        self.curve = curve
+        self.fadeTime = fadeTime
+        self.usingFallback = fadeTime <= 0
+        if self.usingFallback:
+            # Instant fades are a single write, there's nothing for the daemon to time
+            self.fallback.start(curve, fadeTime, now)
+            self.startedAt = now
+            return
+        upload = object()
+        with self._lock:
+            self._upload = upload
+            self.phase = ScriptPhase.UPLOADING
+        # The light stays put until the script starts, so the channels it starts from are known now
+        self.submit(partial(self._uploadScript, upload, curve, fadeTime, list(self.writer.lastWritten)))
+
+    def _uploadScript(self, upload: object, curve: FadeCurve, fadeTime: float, previous: List[Optional[int]]):
+        # Runs on the upload thread, compiling and storing a long fade can take tens of milliseconds
+        frameTime, frames = self.compile(curve, fadeTime)
+        try:
+            scriptId = storeScript(self.pi, self.toScript(frameTime, frames, previous))
+        except pigpio.error as e:
+            print("Unable to store fade script, fading from python instead: {0}".format(e))
+            with self._lock:
+                if self._upload is upload:
+                    self.phase = ScriptPhase.FAILED
+            return
+        with self._lock:
+            if self._upload is upload:
+                try:
+                    self.pi.run_script(scriptId)
+                    self.scriptId = scriptId
+                    self.frameTime, self.frames = frameTime, frames
+                    self.startedAt = self.clock()
+                    self.endTime = self.startedAt + fadeTime
+                    self.phase = ScriptPhase.RUNNING
+                    return
+                except pigpio.error as e:
+                    print("Unable to run fade script, fading from python instead: {0}".format(e))
+                    self.phase = ScriptPhase.FAILED
+        # Cancelled while it was being uploaded, or it failed to start
+        self._deleteScript(scriptId)
+
+    def step(self, now: float) -> Optional[float]:
+        if self.usingFallback:
+            return self.fallback.step(now)
+        with self._lock:
+            phase = self.phase
+        if phase == ScriptPhase.UPLOADING:
+            return now + SCRIPT_POLL_TIME
+        if phase == ScriptPhase.FAILED:
+            # Nothing has moved yet, so python takes the whole fade from here
+            self.usingFallback = True
+            self.fallback.start(self.curve, self.fadeTime, now)
+            return self.fallback.step(now)
+        if now < self.endTime:
+            return self.endTime
+        status = self._getStatus()
+        if status == pigpio.PI_SCRIPT_RUNNING and now < self.endTime + self.frameTime:
+            # Let the daemon finish its last frame so it can't land on top of the final write
+            return now + SCRIPT_POLL_TIME
+        if status in (pigpio.PI_SCRIPT_HALTED, pigpio.PI_SCRIPT_RUNNING):
+            self._finish(len(self.frames))
+            return None
+        # Wherever the script stopped, the fixture's final write has to send every channel to the target
+        print("Fade script did not finish, writing the target instead")
+        self.writer.forget()
+        self._finish(0)
+        return None
+
+    def cancel(self, now: float):
+        if self.usingFallback:
+            self.fallback.cancel(now)
+            return
+        with self._lock:
+            # An upload still under way finds itself replaced and gives up
+            phase, self.phase = self.phase, ScriptPhase.IDLE
+            self._upload = None
+        if phase != ScriptPhase.RUNNING:
+            return
+        try:
+            self.pi.stop_script(self.scriptId)
+        except pigpio.error as e:
+            print("Unable to stop fade script: {0}".format(e))
+        try:
+            # The daemon's timing drifts from ours, so the next fade starts from what it really wrote
+            self.writer.readBack()
+            self._finish(0)
+        except pigpio.error as e:
+            print("Unable to read back fade script duty cycles: {0}".format(e))
+            self._finish(min(len(self.frames), int((now - self.startedAt) / self.frameTime)))
+
+    def _getStatus(self) -> Optional[int]:
+        try:
+            return self.pi.script_status(self.scriptId)[0]
+        except pigpio.error:
+            return None
+
+    def _finish(self, framesPlayed: int):
+        # The daemon wrote these itself, so bring the writer's view of the channels up to date
+        if framesPlayed > 0:
+            self.writer.assume(self.frames[framesPlayed - 1])
+        self.phase = ScriptPhase.IDLE
+        self._deleteScript(self.scriptId)
+        self.scriptId = None
+
+    def _deleteScript(self, scriptId: Optional[int]):
+        if scriptId is not None:
+            try:
+                self.pi.delete_script(scriptId)
+            except pigpio.error as e:
+                print("Unable to delete fade script: {0}".format(e))
+
+FADE_BACKENDS = {
+    "tick": lambda pi, writer, clock: TickFadeBackend(writer),
+    "script": ScriptFadeBackend,
+}
@@ -0,0 +1,421 @@
+import json
+import os
+import time
+from enum import Enum
+from functools import partial
+from threading import Event, Lock, Thread
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import pigpio
+
+from calibration import DEFAULT_PWM_RANGE, Calibration
+from channels import ChannelWriter
+from curve import FadeCurve, RetargetCurve
+from fadebackends import FADE_BACKENDS
+from journal import Journal
+from metrics import JITTER_BUCKETS, REGISTRY, Counter, Histogram
+from persistence import StateWriter, loadStateFile, stateToDict
+from reducer import State, Task, applyTask, getEffectivePower, getPwmColour, getStateChange, getTaskSampler, isFoldable
+from remote import RemotePi
+from snapshot import snapshotFixtures
+from store import StateStore
+from taskqueue import LatencyStats, TaskQueue
+from timeline import Timeline
+
+# Fixture name that addresses every fixture at once
+GROUP_ALL = "all"
+# How a waited on task ended
+TASK_REACHED = "reached"
+TASK_PREEMPTED = "preempted"
+TASK_CANCELLED = "cancelled"
+TASK_STOPPED = "stopped"
+# How long to leave a fixture whose daemon can't be reached before trying it again
+FAILED_STEP_RETRY = 0.5
+
+TASK_LATENCY = REGISTRY.register(Histogram(
+    "rgbw_task_latency_seconds", "Time from a task being queued until its first PWM write", ("fixture",)))
+FRAME_JITTER = REGISTRY.register(Histogram(
+    "rgbw_fade_frame_jitter_seconds", "How late a fade frame was written after it was due", ("fixture",), JITTER_BUCKETS))
+TASKS_PREEMPTED = REGISTRY.register(Counter(
+    "rgbw_tasks_preempted_total", "Fades cut short by a newer task", ("fixture",)))
+
+class FixturePhase(Enum):
+    IDLE = 1
+    FADING = 2
+    HOLDING = 3
+
+class Fixture:
+    def __init__(self, name: str, pi: pigpio.pi, pins: Sequence[int], statePath: str, fadeBackend: str = "tick",
+                 clock: Callable[[], float] = time.monotonic, calibration: Optional[Calibration] = None,
+                 journalPath: Optional[str] = None):
+        self.name = name
+        self.pi = pi
+        self.statePath = statePath
+        self.clock = clock
+        self.writer = ChannelWriter(pi, pins, calibration)
+        self.fadeBackend = FADE_BACKENDS[fadeBackend](pi, self.writer, clock)
+        self.queue = TaskQueue(clock)
+        # Latest target state, published for the HTTP handlers
+        self.stateStore = StateStore()
+        self.stateWriter = StateWriter(statePath)
+        self.journal = None if journalPath is None else Journal(journalPath)
+        # Time from a task being queued until its first PWM write
+        self.taskLatency = LatencyStats()
+        self.taskLatencyHistogram = TASK_LATENCY.labels(name)
+        self.frameJitter = FRAME_JITTER.labels(name)
+        self.preempted = TASKS_PREEMPTED.labels(name)
+        # When the current fade's next frame is due
+        self.frameDue: Optional[float] = None
+
+        self.phase = FixturePhase.IDLE
+        self.targetState = State()
+        self.initialState = State()
+        self.task = Task()
+        self.fadeTime = 0.0
+        self.curve: Optional[FadeCurve] = None
+        # Where the light was when the current run of fades began, kept across fades that interrupt each other
+        self.fadeOrigin: Tuple[float, ...] = ()
+        self.holdUntil = 0.0
+        self.enqueuedAt: Optional[float] = None
+        # Completion callbacks of the tasks making up the current fade
+        self.waiters: List[Callable[[str], None]] = []
+        self.timeline: Optional[Timeline] = None
+        self.timelineStart = 0.0
+        # Index of the next timeline step to start
+        self.timelineStep = 0
+        self.timelineWaiters: List[Callable[[str], None]] = []
+        # Called whenever a task's target has been reached and saved
+        self.onSettled: Optional[Callable[[], None]] = None
+        # The last task the fixture queued for itself rather than being sent, journalled as such
+        self.requeued: Optional[Task] = None
+
+    def getTargetDutyCycles(self) -> Tuple[float, ...]:
+        targetColour = self.targetState.presets[self.targetState.presetIdx]
+        maxColourVal = max(targetColour)
+        effectivePower = getEffectivePower(self.targetState)
+        return tuple(getPwmColour(maxColourVal, effectivePower, colourVal) for colourVal in targetColour)
+
+    def restore(self):
+        # Make sure PWM dutycycle is always set at least once
+        recovered = None if self.journal is None else self.journal.recover()
+        auroraTask = None
+        if recovered is not None:
+            # The journal has every task up to a crash, the state file only what had settled
+            self.targetState, auroraTask = recovered
+            print("Restored {0} from journal {1}".format(self.name, self.journal.path))
+        else:
+            try:
+                self.targetState = loadStateFile(self.statePath)
+                print("Restored {0} from {1}".format(self.name, self.statePath))
+            except FileNotFoundError:
+                print("No saved state for {0}, starting from defaults".format(self.name))
+                self.targetState = State()
+        if self.journal is not None:
+            self.journal.open(self.targetState, auroraTask)
+        self.stateStore.publish(self.targetState.duplicate())
+        initialDutyCycles = self.getTargetDutyCycles()
+        self.writer.shadow.setTarget(initialDutyCycles)
+        self.writer.write(initialDutyCycles)
+        if auroraTask is not None:
+            # Carry on with the aurora that was interrupted
+            self.task = auroraTask
+            self.requeue(auroraTask)
+
+    def requeue(self, task: Task):
+        self.requeued = task
+        self.queue.put(task)
+
+    def canStart(self) -> bool:
+        # A post delay always runs to completion, tasks queued during it wait their turn
+        return self.phase != FixturePhase.HOLDING and not self.queue.empty()
+
+    def takeTasks(self) -> Tuple[List[Task], Optional[float], List[Callable[[str], None]]]:
+        # A burst of queued tasks is applied one by one but faded to as a single target, a timeline is always taken alone
+        tasks = self.queue.getRun(lambda task: isinstance(task, Task) and isFoldable(task))
+        return tasks, self.queue.lastEnqueuedAt, self.queue.lastWaiters
+
+    def notifyWaiters(self, result: str):
+        waiters, self.waiters = self.waiters, []
+        for onDone in waiters:
+            onDone(result)
+
+    def endTimeline(self, result: str):
+        if self.timeline is None:
+            return
+        self.timeline = None
+        waiters, self.timelineWaiters = self.timelineWaiters, []
+        for onDone in waiters:
+            onDone(result)
+
+    def startTasks(self, tasks: List[Task], enqueuedAt: Optional[float], waiters: List[Callable[[str], None]], now: float):
+        # Anything queued takes over from a playing timeline
+        self.endTimeline(TASK_PREEMPTED)
+        if isinstance(tasks[0], Timeline):
+            self.startTimeline(tasks[0], enqueuedAt, waiters, now)
+        else:
+            self.beginFade(tasks, enqueuedAt, waiters, now)
+
+    def startTimeline(self, timeline: Timeline, enqueuedAt: Optional[float], waiters: List[Callable[[str], None]], now: float):
+        self.timeline = timeline
+        self.timelineStart = now
+        self.timelineStep = 0
+        self.timelineWaiters = waiters
+        self.playTimeline(now, enqueuedAt)
+
+    def playTimeline(self, now: float, enqueuedAt: Optional[float] = None) -> Optional[float]:
+        # Starts every step that has come due, returns when the next one is
+        if self.timeline.cancelled:
+            # A fade already under way is left to reach its target
+            self.endTimeline(TASK_CANCELLED)
+            return None
+        steps = self.timeline.steps
+        elapsed = now - self.timelineStart
+        due = []
+        while self.timelineStep < len(steps) and steps[self.timelineStep][0] <= elapsed:
+            due.append(steps[self.timelineStep][1])
+            self.timelineStep += 1
+        if due:
+            # Steps sharing an offset are applied together, as a single fade
+            self.beginFade(due, enqueuedAt, [], now)
+        if self.timelineStep < len(steps):
+            return self.timelineStart + steps[self.timelineStep][0]
+        return None
+
+    def beginFade(self, tasks: List[Task], enqueuedAt: Optional[float], waiters: List[Callable[[str], None]], now: float):
+        interrupted = self.phase == FixturePhase.FADING
+        if interrupted:
+            self.preempted.inc()
+            self.fadeBackend.cancel(now)
+            self.notifyWaiters(TASK_PREEMPTED)
+
+        self.task = tasks[-1]
+        self.enqueuedAt = enqueuedAt
+        self.waiters = waiters
+        startDutyCycles = self.writer.read()
+
+        self.initialState = self.targetState.duplicate()
+        for task in tasks:
+            self.targetState = applyTask(task, self.targetState)
+            if self.journal is not None:
+                self.journal.append(task, self.targetState, task is self.requeued)
+        if not self.task.flash:
+            # Flashes are transient indicators, readers keep seeing the state they return to
+            self.stateStore.publish(self.targetState.duplicate())
+        targetDutyCycles = self.getTargetDutyCycles()
+        self.writer.shadow.setTarget(targetDutyCycles)
+
+        self.fadeTime = self.task.fadeTime
+        if interrupted:
+            # Carry on from wherever the interrupted fade got to, without stalling on a fresh curve's flat start
+            self.curve = RetargetCurve(startDutyCycles, targetDutyCycles)
+            # The rest of the way takes its share of fadeTime, measured from where the run of fades began, so a stream
+            # of inputs keeps arriving on time rather than restarting the fade. Never longer than a fresh fade from here
+            fullSpan = max(FadeCurve(self.fadeOrigin, targetDutyCycles).span, self.curve.span)
+            if fullSpan > 0:
+                self.fadeTime = self.task.fadeTime * self.curve.span / fullSpan
+        else:
+            self.fadeOrigin = startDutyCycles
+            self.curve = FadeCurve(startDutyCycles, targetDutyCycles)
+
+        self.fadeBackend.start(self.curve, self.fadeTime, now)
+        self.phase = FixturePhase.FADING
+        self.frameDue = now
+
+    def step(self, now: float) -> Optional[float]:
+        # Advances the fixture to now, returns when it next needs attention or None when idle
+        nextStep = None if self.timeline is None else self.playTimeline(now)
+        deadline = self.stepFade(now)
+        if nextStep is None or deadline is None:
+            return deadline if nextStep is None else nextStep
+        return min(nextStep, deadline)
+
+    def stepFade(self, now: float) -> Optional[float]:
+        if self.phase == FixturePhase.FADING:
+            if now >= self.frameDue:
+                self.frameJitter.observe(now - self.frameDue)
+            deadline = self.fadeBackend.step(now)
+            if self.enqueuedAt is not None:
+                latency = self.clock() - self.enqueuedAt
+                self.taskLatency.record(latency)
+                self.taskLatencyHistogram.observe(latency)
+                self.enqueuedAt = None
+            if deadline is not None:
+                self.frameDue = deadline
+                return deadline
+            self.finishFade()
+
+        if self.phase == FixturePhase.HOLDING:
+            if now < self.holdUntil:
+                return self.holdUntil
+            self.finishTask()
+        return None
+
+    def finishFade(self):
+        # task.fadeTime has elapsed, ensure target is reached
+        self.writer.write(self.getTargetDutyCycles())
+        self.notifyWaiters(TASK_REACHED)
+        holdStart = self.clock()
+        if self.targetState.aurora is not None:
+            # Choose the next aurora colour while this one is held
+            getTaskSampler(self.task).prefetch(self.targetState.presets[self.targetState.presetIdx])
+        self.holdUntil = holdStart + self.task.postDelay
+        self.phase = FixturePhase.HOLDING
+
+    def finishTask(self):
+        self.phase = FixturePhase.IDLE
+        if self.timeline is not None and self.timelineStep == len(self.timeline.steps):
+            self.endTimeline(TASK_REACHED)
+        # Within a timeline an aurora step holds its colour until the next step
+        if self.targetState.aurora is not None and self.timeline is None and self.queue.empty():
+            # Aurora mode is enabled, do another aurora cycle
+            self.requeue(self.task)
+            return
+
+        if self.task.flash:
+            self.requeue(getStateChange(self.initialState, Task(fadeTime=self.task.fadeTime)))
+        else:
+            self.stateWriter.save(stateToDict(self.targetState))
+            if self.onSettled is not None:
+                self.onSettled()
+
+class FadeScheduler(Thread):
+    def __init__(self, fixtures: Iterable[Fixture], clock: Callable[[], float] = time.monotonic, snapshotPath: Optional[str] = None):
+        Thread.__init__(self)
+        self.fixtures = list(fixtures)
+        self.clock = clock
+        self._stop_event = Event()
+        self._work = Event()
+        # Held while tasks are put for several fixtures, so the scheduler picks them all up in the same frame
+        self._submitLock = Lock()
+        self.snapshotWriter = None if snapshotPath is None else StateWriter(snapshotPath)
+        for fixture in self.fixtures:
+            fixture.queue.onPut = self._work.set
+            if self.snapshotWriter is not None:
+                fixture.onSettled = self.saveSnapshot
+
+    def submit(self, tasks: Iterable[Tuple[Fixture, Task]], onDone: Optional[Callable[[Fixture, str], None]] = None):
+        # onDone is called once per fixture when its fade ends, from the scheduler thread
+        with self._submitLock:
+            for fixture, task in tasks:
+                fixture.queue.put(task, onDone=None if onDone is None else partial(onDone, fixture))
+
+    def wake(self):
+        self._work.set()
+
+    def stop(self):
+        print("Received stop")
+        self._stop_event.set()
+        self._work.set()
+
+    def stopped(self) -> bool:
+        return self._stop_event.is_set()
+
+    def stepFixture(self, fixture: Fixture, now: float) -> Optional[float]:
+        try:
+            return fixture.step(now)
+        except pigpio.error as e:
+            # The connection pushes the latest duty cycles again once the daemon is back
+            print("Unable to update {0}: {1}".format(fixture.name, e))
+            return now + FAILED_STEP_RETRY
+
+    def startFixture(self, fixture: Fixture, tasks: List[Task], enqueuedAt: Optional[float],
+                     waiters: List[Callable[[str], None]], now: float):
+        try:
+            fixture.startTasks(tasks, enqueuedAt, waiters, now)
+        except Exception as e:
+            # A task that can't be applied is dropped, rather than taking the fade thread and every fixture with it
+            print("Unable to start task on {0}: {1!r}".format(fixture.name, e))
+            if fixture.waiters is waiters:
+                fixture.waiters = []
+            for onDone in waiters:
+                onDone(TASK_CANCELLED)
+
+    def saveSnapshot(self):
+        self.snapshotWriter.save(snapshotFixtures(self.fixtures))
+
+    def restoreFixtures(self):
+        for fixture in self.fixtures:
+            fixture.stateWriter.start()
+            if fixture.journal is not None:
+                fixture.journal.start()
+            try:
+                fixture.restore()
+            except pigpio.error as e:
+                print("Unable to restore {0}: {1}".format(fixture.name, e))
+        if self.snapshotWriter is not None:
+            self.snapshotWriter.start()
+            self.saveSnapshot()
+
+    def runOnce(self, now: float) -> Optional[float]:
+        # Starts queued tasks and steps every fixture to now, returns when a fixture next needs attention
+        with self._submitLock:
+            started = [(fixture, fixture.takeTasks()) for fixture in self.fixtures if fixture.canStart()]
+        for fixture, (tasks, enqueuedAt, waiters) in started:
+            self.startFixture(fixture, tasks, enqueuedAt, waiters, now)
+
+        deadlines = [deadline for deadline in (self.stepFixture(fixture, now) for fixture in self.fixtures) if deadline is not None]
+        return min(deadlines) if deadlines else None
+
+    def run(self):
+        self.restoreFixtures()
+        while not self.stopped():
+            self._work.clear()
+            deadline = self.runOnce(self.clock())
+            # Sleeps until the next frame or post delay is due, waking straight away if a task is queued
+            self._work.wait(None if deadline is None else max(0.0, deadline - self.clock()))
+        for fixture in self.fixtures:
+            fixture.notifyWaiters(TASK_STOPPED)
+            fixture.endTimeline(TASK_STOPPED)
+        print("Stopping fade thread")
+
+    def close(self):
+        for fixture in self.fixtures:
+            fixture.writer.close()
+            fixture.stateWriter.stop()
+            if fixture.journal is not None:
+                fixture.journal.stop()
+        if self.snapshotWriter is not None:
+            self.snapshotWriter.stop()
+        for pi in {id(fixture.pi): fixture.pi for fixture in self.fixtures}.values():
+            pi.stop()
+
+def loadFixtures(path: str, defaultPins: Sequence[int], fadeBackend: str,
+                 connect: Callable[..., RemotePi] = RemotePi, dataDir: Optional[str] = None) -> Dict[str, Fixture]:
+    # connect is called with a daemon's host and port, or nothing for the local one
+    # dataDir, when given, holds every state file and journal in place of the paths configured
+    def place(dataPath: Optional[str]) -> Optional[str]:
+        return dataPath if dataDir is None or dataPath is None else os.path.join(dataDir, os.path.basename(dataPath))
+
+    # Without a fixtures file there is a single fixture on the local daemon
+    if not os.path.exists(path):
+        return {"default": Fixture("default", connect(), defaultPins, place('./state.json'), fadeBackend, journalPath=place('./journal.bin'))}
+
+    with open(path, 'r') as f:
+        fixturesJson = json.load(f)
+    connections: Dict[Tuple[str, int], RemotePi] = {}
+    fixtures: Dict[str, Fixture] = {}
+    for fixtureJson in fixturesJson:
+        name = fixtureJson["name"]
+        if name == GROUP_ALL or name in fixtures:
+            raise ValueError("Fixture name {0} is reserved or already used".format(name))
+        # Fixtures on the same daemon share one connection
+        address = (fixtureJson.get("host", "localhost"), fixtureJson.get("port", 8888))
+        if address not in connections:
+            connections[address] = connect(*address)
+        calibration = Calibration(
+            len(fixtureJson["pins"]),
+            fixtureJson.get("pwmRange", DEFAULT_PWM_RANGE),
+            fixtureJson.get("gamma", 1.0),
+            fixtureJson.get("whiteBalance"),
+            fixtureJson.get("pwmFrequency")
+        )
+        fixtures[name] = Fixture(
+            name,
+            connections[address],
+            fixtureJson["pins"],
+            place(fixtureJson.get("statePath", './state-{0}.json'.format(name))),
+            fixtureJson.get("fadeBackend", fadeBackend),
+            calibration=calibration,
+            journalPath=place(fixtureJson.get("journalPath", './journal-{0}.bin'.format(name)))
+        )
+    return fixtures
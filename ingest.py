@@ -0,0 +1,75 @@
+import asyncio
+from functools import partial
+from typing import Dict, Optional, Sequence, Tuple
+
+from fixtures import FadeScheduler, Fixture
+from reducer import Task
+
+# Requests beyond this many unforwarded submissions wait for room rather than growing the backlog
+INGEST_QUEUE_SIZE = 256
+# Submissions are only forwarded to a fixture with fewer tasks than this queued, the rest stay in the channel
+FIXTURE_QUEUE_LIMIT = 64
+# How often a forwarder held up by a full fixture queue checks for room
+FORWARD_RETRY_TIME = 0.01
+# A request that can't get into the channel in this long is turned away
+SUBMIT_TIMEOUT = 5.0
+COMPLETION_TIMEOUT = 30.0
+TASK_TIMED_OUT = "timed out"
+
+class IngestFull(Exception):
+    pass
+
+class TaskIngest:
+    # Async front end to the scheduler, handlers only ever await an asyncio queue
+    def __init__(self, scheduler: FadeScheduler, maxsize: int = INGEST_QUEUE_SIZE, fixtureLimit: int = FIXTURE_QUEUE_LIMIT,
+                 submitTimeout: float = SUBMIT_TIMEOUT):
+        self.scheduler = scheduler
+        self.maxsize = maxsize
+        self.fixtureLimit = fixtureLimit
+        self.submitTimeout = submitTimeout
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._channel: Optional[asyncio.Queue] = None
+        self._forwarder: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._channel = asyncio.Queue(self.maxsize)
+        self._forwarder = asyncio.create_task(self._forward())
+
+    def stop(self):
+        if self._forwarder is not None:
+            self._forwarder.cancel()
+
+    async def submit(self, tasks: Sequence[Tuple[Fixture, Task]], wait: bool = False) -> Optional[Dict[str, str]]:
+        # With wait, returns how each fixture's fade ended once they all have. Raises IngestFull if the
+        # scheduler is so far behind that there's no room in the channel within submitTimeout
+        futures = None if not wait else {fixture.name: self._loop.create_future() for fixture, _ in tasks}
+        try:
+            await asyncio.wait_for(self._channel.put((tasks, futures)), self.submitTimeout)
+        except asyncio.TimeoutError:
+            raise IngestFull("Too many tasks queued, try again later") from None
+        if futures is None:
+            return None
+        done, _ = await asyncio.wait(futures.values(), timeout=COMPLETION_TIMEOUT)
+        return {name: future.result() if future in done else TASK_TIMED_OUT for name, future in futures.items()}
+
+    def _resolve(self, futures: Dict[str, asyncio.Future], fixture: Fixture, result: str):
+        # Called from the scheduler thread
+        self._loop.call_soon_threadsafe(self._setResult, futures[fixture.name], result)
+
+    def _setResult(self, future: asyncio.Future, result: str):
+        if not future.done():
+            future.set_result(result)
+
+    def _hasRoom(self, tasks: Sequence[Tuple[Fixture, Task]]) -> bool:
+        return all(fixture.queue.qsize() < self.fixtureLimit for fixture, _ in tasks)
+
+    async def _forward(self):
+        while True:
+            tasks, futures = await self._channel.get()
+            # The fixture queues themselves are unbounded, so a backlog is held here where it pushes back on requests
+            while not self._hasRoom(tasks):
+                await asyncio.sleep(FORWARD_RETRY_TIME)
+            onDone = None if futures is None else partial(self._resolve, futures)
+            # Never blocks, the scheduler only holds its lock while taking tasks
+            self.scheduler.submit(tasks, onDone)
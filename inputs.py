@@ -0,0 +1,66 @@
+import heapq
+import time
+from threading import Event, Lock, Thread
+from typing import Callable, List, Optional, Tuple
+
+class InputTimer:
+    __slots__ = ('due', 'callback', 'cancelled')
+
+    def __init__(self, due: float, callback: Callable[[], None]):
+        self.due = due
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        # Left in the heap and skipped once due, there are only ever a handful pending
+        self.cancelled = True
+
+class InputScheduler(Thread):
+    # Runs input callbacks and their timers one at a time on a single thread, so handlers never race each other
+    def __init__(self, clock: Callable[[], float] = time.monotonic):
+        Thread.__init__(self, daemon=True)
+        self.clock = clock
+        self._lock = Lock()
+        # (due, sequence, timer), the sequence keeps callbacks due at the same time in the order they were added
+        self._timers: List[Tuple[float, int, InputTimer]] = []
+        self._sequence = 0
+        self._work = Event()
+        self._stop_event = Event()
+
+    def callAt(self, due: float, callback: Callable[[], None]) -> InputTimer:
+        timer = InputTimer(due, callback)
+        with self._lock:
+            heapq.heappush(self._timers, (due, self._sequence, timer))
+            self._sequence += 1
+        self._work.set()
+        return timer
+
+    def callLater(self, delay: float, callback: Callable[[], None]) -> InputTimer:
+        return self.callAt(self.clock() + delay, callback)
+
+    def post(self, callback: Callable[[], None]):
+        # Safe from any thread, gpiozero calls it from its own
+        self.callAt(self.clock(), callback)
+
+    def runDue(self, now: float) -> Optional[float]:
+        # Runs every callback due by now, returns when the next one is due
+        while True:
+            with self._lock:
+                if not self._timers:
+                    return None
+                due, _, timer = self._timers[0]
+                if due > now:
+                    return due
+                heapq.heappop(self._timers)
+            if not timer.cancelled:
+                timer.callback()
+
+    def stop(self):
+        self._stop_event.set()
+        self._work.set()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self._work.clear()
+            deadline = self.runDue(self.clock())
+            self._work.wait(None if deadline is None else max(0.0, deadline - self.clock()))
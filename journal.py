@@ -0,0 +1,334 @@
+import os
+import struct
+import tempfile
+import time
+import zlib
+from threading import Condition, Thread
+from typing import Iterator, List, NamedTuple, Optional, Tuple
+
+from metrics import REGISTRY, Histogram
+from persistence import SAVE_MAX_DELAY, SAVE_QUIET_PERIOD, getFileMode
+from reducer import Adjustment, Aurora, ChangePreset, Colour, State, StateChange, Switch, Task, applyTask, getStateChange
+
+JOURNAL_MAGIC = b"RGBWJ1"
+# Records appended after a snapshot before the journal is compacted into a new one
+JOURNAL_COMPACT_RECORDS = 5000
+# Records are written and synced together once none have been appended for a quiet period, or after a maximum delay,
+# the same as the state file so a stream of knob turns doesn't mean a write to the SD card for each
+JOURNAL_QUIET_PERIOD = SAVE_QUIET_PERIOD
+JOURNAL_MAX_DELAY = SAVE_MAX_DELAY
+
+KIND_SNAPSHOT = 0
+KIND_ADJUSTMENT = 1
+KIND_CHANGE_PRESET = 2
+KIND_SWITCH = 3
+KIND_STATE_CHANGE = 4
+KIND_AURORA = 5
+
+FLAG_FLASH = 1
+# Queued by the fixture itself, a flash returning or an aurora's next cycle, rather than by an input
+FLAG_GENERATED = 2
+
+# kind, payload length, crc32 of the payload, a torn or corrupt record marks the end of the journal
+HEADER = struct.Struct("<BHI")
+# time applied, fadeTime, postDelay, flags
+TIMING = struct.Struct("<dffB")
+COLOUR = struct.Struct("<4d")
+POWER = struct.Struct("<i")
+# which of red, green, blue, white, on and power are set, then their values
+STATE_CHANGE = struct.Struct("<B4dBi")
+MIN_COLOUR_DIST = struct.Struct("<d")
+# on, power, presetIdx, number of presets, whether an aurora is running
+STATE = struct.Struct("<BiBBB")
+
+JOURNAL_WRITE_TIME = REGISTRY.register(Histogram(
+    "rgbw_journal_write_seconds", "Time taken to write and sync a batch of journal records", ("path",)))
+
+class JournalEntry(NamedTuple):
+    appliedAt: float
+    task: Task
+    # The colour an aurora drew, None for every other task
+    auroraColour: Optional[Colour]
+    generated: bool
+
+def encodeRecord(kind: int, payload: bytes) -> bytes:
+    return HEADER.pack(kind, len(payload), zlib.crc32(payload)) + payload
+
+def encodeAurora(task: Aurora) -> bytes:
+    return COLOUR.pack(*task.minColour) + COLOUR.pack(*task.maxColour) + MIN_COLOUR_DIST.pack(task.minColourDist)
+
+def decodeAurora(payload: bytes, offset: int, **kwargs) -> Aurora:
+    return Aurora(
+        minColour=Colour(*COLOUR.unpack_from(payload, offset)),
+        maxColour=Colour(*COLOUR.unpack_from(payload, offset + COLOUR.size)),
+        minColourDist=MIN_COLOUR_DIST.unpack_from(payload, offset + 2 * COLOUR.size)[0],
+        **kwargs
+    )
+
+def encodeTask(appliedAt: float, task: Task, state: State, generated: bool = False) -> bytes:
+    # state is the one task produced, only an aurora needs anything from it
+    flags = (FLAG_FLASH if task.flash else 0) | (FLAG_GENERATED if generated else 0)
+    timing = TIMING.pack(appliedAt, task.fadeTime, task.postDelay, flags)
+    if isinstance(task, Adjustment):
+        return encodeRecord(KIND_ADJUSTMENT, timing + POWER.pack(int(task.power)) + COLOUR.pack(*task.colour))
+    if isinstance(task, ChangePreset):
+        return encodeRecord(KIND_CHANGE_PRESET, timing)
+    if isinstance(task, Switch):
+        return encodeRecord(KIND_SWITCH, timing)
+    if isinstance(task, StateChange):
+        values = (task.red, task.green, task.blue, task.white, task.on, task.power)
+        present = sum(1 << idx for idx, value in enumerate(values) if value is not None)
+        colour = (0 if value is None else value for value in values[:4])
+        return encodeRecord(KIND_STATE_CHANGE, timing + STATE_CHANGE.pack(present, *colour, bool(task.on), int(task.power or 0)))
+    if isinstance(task, Aurora):
+        # The colour it drew is kept, replaying it doesn't draw a different one
+        return encodeRecord(KIND_AURORA, timing + encodeAurora(task) + COLOUR.pack(*state.presets[state.presetIdx]))
+    raise ValueError("Unknown task type {0}".format(type(task).__name__))
+
+def decodeTask(kind: int, payload: bytes) -> JournalEntry:
+    appliedAt, fadeTime, postDelay, flags = TIMING.unpack_from(payload)
+    timing = {"fadeTime": fadeTime, "postDelay": postDelay, "flash": bool(flags & FLAG_FLASH)}
+    offset = TIMING.size
+    auroraColour = None
+    if kind == KIND_ADJUSTMENT:
+        power, = POWER.unpack_from(payload, offset)
+        task = Adjustment(power=power, colour=Colour(*COLOUR.unpack_from(payload, offset + POWER.size)), **timing)
+    elif kind == KIND_CHANGE_PRESET:
+        task = ChangePreset(**timing)
+    elif kind == KIND_SWITCH:
+        task = Switch(**timing)
+    elif kind == KIND_STATE_CHANGE:
+        present, red, green, blue, white, on, power = STATE_CHANGE.unpack_from(payload, offset)
+        values = [value if present & (1 << idx) else None for idx, value in enumerate((red, green, blue, white, bool(on), power))]
+        task = StateChange(*values, **timing)
+    elif kind == KIND_AURORA:
+        task = decodeAurora(payload, offset, **timing)
+        auroraColour = Colour(*COLOUR.unpack_from(payload, offset + 2 * COLOUR.size + MIN_COLOUR_DIST.size))
+    else:
+        raise ValueError("Unknown journal record kind {0}".format(kind))
+    return JournalEntry(appliedAt, task, auroraColour, bool(flags & FLAG_GENERATED))
+
+def encodeSnapshot(state: State, auroraTask: Optional[Aurora]) -> bytes:
+    parts = [STATE.pack(state.on, state.power, state.presetIdx, len(state.presets), state.aurora is not None)]
+    parts.extend(COLOUR.pack(*colour) for colour in state.presets)
+    if state.aurora is not None:
+        # Its task rather than just its settings, so a recovered fixture can carry on cycling
+        parts.append(COLOUR.pack(*state.aurora.storedColour))
+        parts.append(TIMING.pack(0, auroraTask.fadeTime, auroraTask.postDelay, 0) + encodeAurora(auroraTask))
+    return encodeRecord(KIND_SNAPSHOT, b"".join(parts))
+
+def decodeSnapshot(payload: bytes) -> Tuple[State, Optional[Aurora]]:
+    on, power, presetIdx, presetCount, hasAurora = STATE.unpack_from(payload)
+    offset = STATE.size
+    presets = []
+    for _ in range(presetCount):
+        presets.append(Colour(*COLOUR.unpack_from(payload, offset)))
+        offset += COLOUR.size
+    state = State(on=bool(on), power=power, presets=presets, presetIdx=presetIdx)
+    if not hasAurora:
+        return state, None
+    storedColour = Colour(*COLOUR.unpack_from(payload, offset))
+    shownColour = presets[presetIdx]
+    offset += COLOUR.size
+    _, fadeTime, postDelay, _ = TIMING.unpack_from(payload, offset)
+    auroraTask = decodeAurora(payload, offset + TIMING.size, fadeTime=fadeTime, postDelay=postDelay)
+    # Reapplying the aurora on top of its stored colour rebuilds its settings, keeping the colour it was showing
+    state.presets[presetIdx] = storedColour
+    state = applyTask(auroraTask, state, shownColour)
+    return state, auroraTask
+
+def readJournal(path: str) -> Tuple[List[Tuple[int, bytes]], int]:
+    # Returns every intact record and the length of the journal they make up
+    with open(path, 'rb') as f:
+        data = f.read()
+    if not data.startswith(JOURNAL_MAGIC):
+        raise ValueError("{0} is not a journal".format(path))
+    records = []
+    offset = len(JOURNAL_MAGIC)
+    while offset + HEADER.size <= len(data):
+        kind, length, checksum = HEADER.unpack_from(data, offset)
+        payload = data[offset + HEADER.size:offset + HEADER.size + length]
+        if len(payload) < length or zlib.crc32(payload) != checksum:
+            break
+        records.append((kind, payload))
+        offset += HEADER.size + length
+    return records, offset
+
+def readEntries(path: str) -> Iterator[JournalEntry]:
+    # Every task in a journal in the order it was applied, for replaying a trace of real inputs
+    records, _ = readJournal(path)
+    for kind, payload in records:
+        if kind != KIND_SNAPSHOT:
+            yield decodeTask(kind, payload)
+
+def replay(records: List[Tuple[int, bytes]]) -> Tuple[State, Optional[Aurora]]:
+    # Returns the state the records lead to, and the aurora to carry on with if one was running
+    state, auroraTask = State(), None
+    previous, last = state, None
+    for kind, payload in records:
+        if kind == KIND_SNAPSHOT:
+            state, auroraTask = decodeSnapshot(payload)
+            last = None
+            continue
+        entry = decodeTask(kind, payload)
+        previous, last = state, entry.task
+        state = applyTask(entry.task, state, entry.auroraColour)
+        if isinstance(entry.task, Aurora):
+            auroraTask = entry.task
+    if last is not None and last.flash:
+        # Stopped partway through a flash, return from it the way the fixture would have
+        state = applyTask(getStateChange(previous), state)
+    return state, auroraTask if state.aurora is not None else None
+
+class Journal(Thread):
+    # Appends every task a fixture applies, replaying them through applyTask rebuilds its exact state
+    def __init__(self, path: str, compactAfter: int = JOURNAL_COMPACT_RECORDS, quietPeriod: float = JOURNAL_QUIET_PERIOD,
+                 maxDelay: float = JOURNAL_MAX_DELAY, clock=time.time):
+        Thread.__init__(self, daemon=True)
+        self.path = path
+        # The journal before the last compaction, kept so there's always a trace of recent inputs
+        self.previousPath = path + ".1"
+        self.compactAfter = compactAfter
+        self.quietPeriod = quietPeriod
+        self.maxDelay = maxDelay
+        self.clock = clock
+        self._condition = Condition()
+        self._pending: List[Tuple[float, Task, State, bool]] = []
+        self._lastAppend = 0.0
+        # When the first pending record was appended
+        self._firstAppend = 0.0
+        self._stopping = False
+        self._file = None
+        # Length of the intact part of the journal, None when it couldn't be recovered
+        self._validLength: Optional[int] = None
+        self._records = 0
+        # Where the last record left the fixture, a compaction's snapshot
+        self._state: Optional[State] = None
+        self._auroraTask: Optional[Aurora] = None
+        self._lastFlash = False
+        self.writeTime = JOURNAL_WRITE_TIME.labels(path)
+
+    def recover(self) -> Optional[Tuple[State, Optional[Aurora]]]:
+        # A missing journal means a compaction was cut short after moving it aside, the previous one is still whole
+        for path in (self.path, self.previousPath):
+            try:
+                records, validLength = readJournal(path)
+            except FileNotFoundError:
+                continue
+            except (OSError, ValueError, struct.error) as e:
+                print("Unable to read journal {0}: {1}".format(path, e))
+                return None
+            if path == self.path:
+                self._validLength = validLength
+                self._records = len(records)
+            return replay(records)
+        return None
+
+    def open(self, state: State, auroraTask: Optional[Aurora] = None):
+        # Carries on from a recovered journal, anything else starts a new one from state
+        self._state = state
+        self._auroraTask = auroraTask
+        if self._validLength is None:
+            self._writeSnapshot(state, auroraTask)
+            self._records = 1
+        self._file = open(self.path, 'r+b')
+        if self._validLength is not None:
+            # Drops a record torn by a crash, so new ones follow the last intact one
+            self._file.truncate(self._validLength)
+        self._file.seek(0, os.SEEK_END)
+
+    def append(self, task: Task, state: State, generated: bool = False):
+        # Called from the scheduler thread, encoding and writing happen on the journal's
+        with self._condition:
+            if not self._pending:
+                self._firstAppend = time.monotonic()
+            self._pending.append((self.clock(), task, state, generated))
+            self._lastAppend = time.monotonic()
+            self._condition.notify()
+
+    def stop(self):
+        # Writes anything still pending before returning
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        if self.is_alive():
+            self.join()
+        if self._file is not None:
+            self._file.close()
+
+    def run(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._stopping:
+                    self._condition.wait()
+                if not self._pending:
+                    return
+                while not self._stopping:
+                    due = min(self._lastAppend + self.quietPeriod, self._firstAppend + self.maxDelay)
+                    remaining = due - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                pending, self._pending = self._pending, []
+            start = time.monotonic()
+            try:
+                self._write(pending)
+                self.writeTime.observe(time.monotonic() - start)
+                if self._records >= self.compactAfter and not self._lastFlash:
+                    self.compact()
+            except (OSError, ValueError, struct.error) as e:
+                print("Failed to write journal {0}: {1}".format(self.path, e))
+
+    def _write(self, pending: List[Tuple[float, Task, State, bool]]):
+        chunks = []
+        for appliedAt, task, state, generated in pending:
+            chunks.append(encodeTask(appliedAt, task, state, generated))
+            self._state = state
+            if isinstance(task, Aurora):
+                self._auroraTask = task
+            self._lastFlash = task.flash
+        self._file.write(b"".join(chunks))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._records += len(chunks)
+
+    def compact(self):
+        # Starts a new journal from a snapshot of the current state, the old one is kept as the previous journal.
+        # The snapshot is written in full before the old journal is moved aside, if anything fails appends carry on
+        # in the old one
+        tempPath = self._writeSnapshotFile(self._state, self._auroraTask if self._state.aurora is not None else None)
+        self._file.close()
+        try:
+            os.replace(self.path, self.previousPath)
+            os.replace(tempPath, self.path)
+            self._records = 1
+        finally:
+            if os.path.exists(tempPath):
+                os.unlink(tempPath)
+            if not os.path.exists(self.path):
+                os.replace(self.previousPath, self.path)
+            self._file = open(self.path, 'r+b')
+            self._file.seek(0, os.SEEK_END)
+
+    def _writeSnapshot(self, state: State, auroraTask: Optional[Aurora]):
+        tempPath = self._writeSnapshotFile(state, auroraTask)
+        try:
+            os.replace(tempPath, self.path)
+        except BaseException:
+            os.unlink(tempPath)
+            raise
+
+    def _writeSnapshotFile(self, state: State, auroraTask: Optional[Aurora]) -> str:
+        # Returns a synced temporary file holding a journal that starts from state, for moving into place
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tempPath = tempfile.mkstemp(dir=directory, prefix='.journal-', suffix='.tmp')
+        try:
+            os.fchmod(fd, getFileMode(self.path))
+            with os.fdopen(fd, 'wb') as f:
+                f.write(JOURNAL_MAGIC + encodeSnapshot(state, auroraTask))
+                f.flush()
+                os.fsync(f.fileno())
+        except BaseException:
+            os.unlink(tempPath)
+            raise
+        return tempPath
@@ -0,0 +1,109 @@
+from enum import Enum
+from typing import Callable, Optional
+
+from inputs import InputScheduler, InputTimer
+from reducer import Adjustment, ChangePreset, Colour, StateChange, Switch, Task
+
+HOLD_TIME = 0.5
+DOUBLE_CLICK_TIME = 0.4
+COL_MOD_FADE_TIME = 0.15
+COL_MOD_DELAY_TIME = 0.15
+KNOB_TIMEOUT_SECONDS = 10
+KNOB_POWER_STEP = 10
+KNOB_COLOUR_STEP = 5
+
+class KnobState(Enum):
+    DEFAULT = 1
+    MOD_RED = 2
+    MOD_GREEN = 3
+    MOD_BLUE = 4
+    MOD_WHITE = 5
+
+# The channel each colour mode adjusts, and the mode a single click moves on to
+MODE_CHANNELS = {
+    KnobState.MOD_RED: "red",
+    KnobState.MOD_GREEN: "green",
+    KnobState.MOD_BLUE: "blue",
+    KnobState.MOD_WHITE: "white",
+}
+NEXT_MODES = {
+    KnobState.MOD_RED: KnobState.MOD_GREEN,
+    KnobState.MOD_GREEN: KnobState.MOD_BLUE,
+    KnobState.MOD_BLUE: KnobState.MOD_WHITE,
+    KnobState.MOD_WHITE: KnobState.MOD_RED,
+}
+
+class KnobController:
+    # Turns button and knob events into tasks, every method runs on the input scheduler's thread
+    def __init__(self, inputs: InputScheduler, put: Callable[[Task], None], fadeTime: float):
+        self.inputs = inputs
+        self.put = put
+        self.fadeTime = fadeTime
+        self.state = KnobState.DEFAULT
+        self.isHeld = False
+        # Pending while a click might still become a double click
+        self.clickTimer: Optional[InputTimer] = None
+        # Drops back out of a colour mode once the knob has been left alone
+        self.timeoutTimer: Optional[InputTimer] = None
+
+    def held(self):
+        self.isHeld = True
+        if self.state != KnobState.DEFAULT:
+            self.leaveColourMode()
+        else:
+            self.put(ChangePreset(fadeTime=0.25))
+
+    def released(self):
+        if self.isHeld:
+            # The end of a hold, not a click
+            self.isHeld = False
+            return
+        if self.clickTimer is None:
+            self.clickTimer = self.inputs.callLater(DOUBLE_CLICK_TIME, self.clicked)
+            return
+
+        # Double click has occurred
+        self.clickTimer.cancel()
+        self.clickTimer = None
+        if self.state == KnobState.DEFAULT:
+            self.enterColourMode(KnobState.MOD_RED)
+        else:
+            self.leaveColourMode()
+
+    def clicked(self):
+        # Single click has occurred
+        self.clickTimer = None
+        if self.state == KnobState.DEFAULT:
+            self.put(Switch(fadeTime=self.fadeTime))
+        else:
+            self.enterColourMode(NEXT_MODES[self.state])
+
+    def rotated(self, direction: int):
+        if self.state == KnobState.DEFAULT:
+            self.put(Adjustment(power=KNOB_POWER_STEP * direction))
+        else:
+            self.extendTimeout()
+            self.put(Adjustment(colour=Colour(**{MODE_CHANNELS[self.state]: KNOB_COLOUR_STEP * direction})))
+
+    def enterColourMode(self, state: KnobState):
+        # Flashes the channel the knob now adjusts
+        self.state = state
+        flashColour = {channel: 100 if mode == state else 0 for mode, channel in MODE_CHANNELS.items()}
+        self.put(StateChange(**flashColour, flash=True, postDelay=COL_MOD_DELAY_TIME, fadeTime=COL_MOD_FADE_TIME))
+        self.extendTimeout()
+
+    def leaveColourMode(self):
+        self.state = KnobState.DEFAULT
+        if self.timeoutTimer is not None:
+            self.timeoutTimer.cancel()
+            self.timeoutTimer = None
+        self.put(StateChange(power=10, flash=True, fadeTime=COL_MOD_FADE_TIME))
+
+    def extendTimeout(self):
+        if self.timeoutTimer is not None:
+            self.timeoutTimer.cancel()
+        self.timeoutTimer = self.inputs.callLater(KNOB_TIMEOUT_SECONDS, self.timedOut)
+
+    def timedOut(self):
+        self.timeoutTimer = None
+        self.leaveColourMode()
@@ -0,0 +1,102 @@
+import asyncio
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from threading import Thread
+
+import uvicorn
+
+from sim import FakePigpioServer
+
+# Fires concurrent /tweak_state requests at the app running against a fake pigpio daemon
+# Usage: python loadtest.py [requests] [concurrency] [wait]
+
+REQUESTS = 5000
+CONCURRENCY = 1000
+HOST = "127.0.0.1"
+
+def percentile(samples, fraction: float) -> float:
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+async def readResponse(reader: asyncio.StreamReader) -> int:
+    head = await reader.readuntil(b"\r\n\r\n")
+    length = 0
+    for line in head.split(b"\r\n"):
+        if line.lower().startswith(b"content-length:"):
+            length = int(line.split(b":", 1)[1])
+    await reader.readexactly(length)
+    return int(head.split(b" ", 2)[1])
+
+async def client(port: int, path: str, body: bytes, count: int, latencies, rejected):
+    reader, writer = await asyncio.open_connection(HOST, port)
+    request = (
+        "POST {0} HTTP/1.1\r\nHost: {1}\r\nContent-Type: application/json\r\nContent-Length: {2}\r\n\r\n"
+        .format(path, HOST, len(body)).encode() + body
+    )
+    for _ in range(count):
+        start = time.perf_counter()
+        writer.write(request)
+        if await readResponse(reader) == 503:
+            # Turned away by the ingest's backpressure
+            rejected.append(1)
+        latencies.append(time.perf_counter() - start)
+    writer.close()
+
+async def fire(port: int, requests: int, concurrency: int, wait: bool):
+    path = "/tweak_state?wait=true" if wait else "/tweak_state"
+    body = json.dumps({"power": 1, "fadeTime": 0.05}).encode()
+    latencies = []
+    rejected = []
+    perClient, extra = divmod(requests, concurrency)
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        client(port, path, body, perClient + (1 if idx < extra else 0), latencies, rejected) for idx in range(concurrency)
+    ))
+    return time.perf_counter() - start, sorted(latencies), len(rejected)
+
+def main():
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else REQUESTS
+    concurrency = min(requests, int(sys.argv[2]) if len(sys.argv) > 2 else CONCURRENCY)
+    wait = len(sys.argv) > 3 and sys.argv[3] == "wait"
+
+    daemon = FakePigpioServer().start()
+    workDir = tempfile.mkdtemp(prefix="rgbw-load-")
+    cwd = os.getcwd()
+    try:
+        fixturesPath = os.path.join(workDir, "fixtures.json")
+        with open(fixturesPath, 'w') as f:
+            json.dump([{"name": "load", "pins": [26, 19, 13, 6], "host": daemon.host, "port": daemon.port}], f)
+        os.environ["RGBW_FIXTURES"] = fixturesPath
+        os.environ.setdefault("GPIOZERO_PIN_FACTORY", "mock")
+        os.chdir(workDir)
+
+        server = uvicorn.Server(uvicorn.Config("app:app", host=HOST, port=0, log_level="warning"))
+        thread = Thread(target=server.run, daemon=True)
+        thread.start()
+        while not server.started:
+            time.sleep(0.05)
+        port = server.servers[0].sockets[0].getsockname()[1]
+
+        elapsed, latencies, rejected = asyncio.run(fire(port, requests, concurrency, wait))
+        print("{0} requests, {1} connections{2}: {3:.0f} req/s".format(
+            len(latencies), concurrency, ", waiting for fades" if wait else "", len(latencies) / elapsed))
+        print("p50 {0:.2f}ms, p99 {1:.2f}ms, max {2:.2f}ms".format(
+            percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000, latencies[-1] * 1000))
+        print("rejected with 503: {0}".format(rejected))
+
+        import app
+        print("task latency: {0}".format(app.defaultFixture.taskLatency.summary()))
+        print("tasks coalesced: {0}".format(app.defaultFixture.queue.coalesced))
+        server.should_exit = True
+        thread.join()
+    finally:
+        # The app's state files and journals were written here
+        os.chdir(cwd)
+        shutil.rmtree(workDir, ignore_errors=True)
+        daemon.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+import math
+from bisect import bisect_left
+from threading import Lock
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+
+# Minimal Prometheus text format metrics, recording is a lock and a couple of additions so it can stay on in the fade loop
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+JITTER_BUCKETS = (0.0001, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1)
+COUNT_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 4096)
+
+Sample = Tuple[Tuple[str, ...], float]
+
+def escapeLabel(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def formatLabels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join('{0}="{1}"'.format(name, escapeLabel(value)) for name, value in zip(names, values)) + "}"
+
+def formatValue(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return str(value) if isinstance(value, int) else repr(float(value))
+
+class CounterChild:
+    __slots__ = ('_lock', 'value')
+
+    def __init__(self):
+        self._lock = Lock()
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0):
+        with self._lock:
+            self.value += amount
+
+class HistogramChild:
+    __slots__ = ('_lock', 'upperBounds', 'counts', 'sum', 'count')
+
+    def __init__(self, upperBounds: Sequence[float]):
+        self._lock = Lock()
+        self.upperBounds = upperBounds
+        # The last slot is the +Inf bucket
+        self.counts = [0] * (len(upperBounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        idx = bisect_left(self.upperBounds, value)
+        with self._lock:
+            self.counts[idx] += 1
+            self.sum += value
+            self.count += 1
+
+class Metric:
+    metricType = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelNames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelNames = tuple(labelNames)
+        self._lock = Lock()
+        self._children: Dict[Tuple[str, ...], object] = {}
+
+    def _newChild(self):
+        raise NotImplementedError
+
+    def labels(self, *values: str):
+        # Hot paths should keep the child rather than looking it up on every call
+        key = tuple(str(value) for value in values)
+        if len(key) != len(self.labelNames):
+            raise ValueError("{0} expects labels {1}".format(self.name, self.labelNames))
+        with self._lock:
+            child = self._children.get(key)
+            if child is None:
+                child = self._children[key] = self._newChild()
+        return child
+
+    def renderSamples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        return [
+            "# HELP {0} {1}".format(self.name, self.documentation),
+            "# TYPE {0} {1}".format(self.name, self.metricType),
+        ] + self.renderSamples()
+
+class Counter(Metric):
+    metricType = "counter"
+
+    def _newChild(self) -> CounterChild:
+        return CounterChild()
+
+    def renderSamples(self) -> List[str]:
+        with self._lock:
+            children = list(self._children.items())
+        return ["{0}{1} {2}".format(self.name, formatLabels(self.labelNames, key), formatValue(child.value)) for key, child in children]
+
+class Histogram(Metric):
+    metricType = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelNames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        Metric.__init__(self, name, documentation, labelNames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _newChild(self) -> HistogramChild:
+        return HistogramChild(self.buckets)
+
+    def renderSamples(self) -> List[str]:
+        with self._lock:
+            children = list(self._children.items())
+        lines = []
+        bucketLabels = self.labelNames + ("le",)
+        for key, child in children:
+            with child._lock:
+                counts = list(child.counts)
+                total, count = child.sum, child.count
+            cumulative = 0
+            for upperBound, bucketCount in zip(self.buckets + (math.inf,), counts):
+                cumulative += bucketCount
+                lines.append("{0}_bucket{1} {2}".format(self.name, formatLabels(bucketLabels, key + (formatValue(upperBound),)), cumulative))
+            labels = formatLabels(self.labelNames, key)
+            lines.append("{0}_sum{1} {2}".format(self.name, labels, formatValue(total)))
+            lines.append("{0}_count{1} {2}".format(self.name, labels, count))
+        return lines
+
+class CollectedMetric(Metric):
+    # Values read when scraped from state that is already kept elsewhere, so there's nothing to record
+    def __init__(self, name: str, documentation: str, metricType: str, labelNames: Sequence[str], collect: Callable[[], Iterable[Sample]]):
+        Metric.__init__(self, name, documentation, labelNames)
+        self.metricType = metricType
+        self.collect = collect
+
+    def renderSamples(self) -> List[str]:
+        return ["{0}{1} {2}".format(self.name, formatLabels(self.labelNames, key), formatValue(value)) for key, value in self.collect()]
+
+class Registry:
+    def __init__(self):
+        self._lock = Lock()
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError("Metric {0} is already registered".format(metric.name))
+            self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(line for metric in metrics for line in metric.render()) + "\n"
+
+REGISTRY = Registry()
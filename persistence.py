@@ -0,0 +1,120 @@
+import json
+import os
+import stat
+import tempfile
+import time
+from threading import Condition, Thread
+from typing import Optional
+
+from metrics import REGISTRY, Histogram
+from reducer import Colour, State
+
+SAVE_QUIET_PERIOD = 2.0
+# A steady stream of changes is still written at least this often
+SAVE_MAX_DELAY = 10.0
+
+STATE_WRITE_TIME = REGISTRY.register(Histogram(
+    "rgbw_state_write_seconds", "Time taken to write and sync a state file", ("path",)))
+
+def loadStateFile(path: str) -> State:
+    with open(path, 'r') as f:
+        stateJson = json.load(f)
+        presets = [Colour(**preset) for preset in stateJson["presets"]]
+        state = State(
+            presets=presets,
+            presetIdx=stateJson["presetIdx"],
+            on=stateJson["on"],
+            power=stateJson["power"]
+        )
+        return state
+
+def stateToDict(state: State) -> dict:
+    # Aurora settings are deliberately left out, a restart always comes back to a plain preset
+    return {
+        "on": state.on,
+        "power": state.power,
+        "presets": [colour._asdict() for colour in state.presets],
+        "presetIdx": state.presetIdx,
+    }
+
+def getFileMode(path: str) -> int:
+    # What a replacement for path should be created with, mkstemp's own files are owner only
+    try:
+        return stat.S_IMODE(os.stat(path).st_mode)
+    except FileNotFoundError:
+        umask = os.umask(0)
+        os.umask(umask)
+        return 0o666 & ~umask
+
+def writeAtomically(path: str, stateDict: dict):
+    # Write a sibling temp file and rename it over the old one, so a power cut leaves either the old or new state
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tempPath = tempfile.mkstemp(dir=directory, prefix='.state-', suffix='.tmp')
+    try:
+        os.fchmod(fd, getFileMode(path))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(stateDict, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tempPath, path)
+    except BaseException:
+        os.unlink(tempPath)
+        raise
+    dirFd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dirFd)
+    finally:
+        os.close(dirFd)
+
+class StateWriter(Thread):
+    def __init__(self, path: str, quietPeriod: float = SAVE_QUIET_PERIOD, maxDelay: float = SAVE_MAX_DELAY):
+        Thread.__init__(self, daemon=True)
+        self.path = path
+        self.quietPeriod = quietPeriod
+        self.maxDelay = maxDelay
+        self._condition = Condition()
+        self._pending: Optional[dict] = None
+        self._lastChange = 0.0
+        # When the pending state first became pending
+        self._firstChange = 0.0
+        self._stopping = False
+        self.writeTime = STATE_WRITE_TIME.labels(path)
+
+    def save(self, stateDict: dict):
+        # Only the latest state matters, earlier unwritten ones are dropped
+        with self._condition:
+            if self._pending is None:
+                self._firstChange = time.monotonic()
+            self._pending = stateDict
+            self._lastChange = time.monotonic()
+            self._condition.notify()
+
+    def stop(self):
+        # Writes anything still pending before returning
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        self.join()
+
+    def run(self):
+        while True:
+            with self._condition:
+                while self._pending is None and not self._stopping:
+                    self._condition.wait()
+                if self._pending is None:
+                    return
+                # Hold off until there have been no changes for a quiet period, or for too long
+                while not self._stopping:
+                    due = min(self._lastChange + self.quietPeriod, self._firstChange + self.maxDelay)
+                    remaining = due - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                stateDict = self._pending
+                self._pending = None
+            start = time.monotonic()
+            try:
+                writeAtomically(self.path, stateDict)
+                self.writeTime.observe(time.monotonic() - start)
+            except OSError as e:
+                print("Failed to save state: {0}".format(e))
@@ -0,0 +1,199 @@
+from typing import List, NamedTuple, Optional
+
+from aurora import AuroraSampler, getAuroraSampler
+
+MINIMUM_DIM_POWER = 2
+NUM_PRESETS = 3
+
+# Internal state and task types used by the fade engine, the pydantic models are only for HTTP bodies
+
+class Colour(NamedTuple):
+    red: float = 0
+    green: float = 0
+    blue: float = 0
+    white: float = 0
+
+class AuroraSettings:
+    __slots__ = ('storedColour', 'minColour', 'maxColour', 'minColourDist')
+
+    def __init__(self, storedColour: Colour = Colour(), minColour: Colour = Colour(), maxColour: Colour = Colour(), minColourDist: float = 0.4):
+        self.storedColour = storedColour
+        self.minColour = minColour
+        self.maxColour = maxColour
+        self.minColourDist = minColourDist
+
+class State:
+    __slots__ = ('on', 'power', 'presets', 'presetIdx', 'aurora')
+
+    def __init__(self, on: bool = True, power: int = 100, presets: Optional[List[Colour]] = None, presetIdx: int = 0, aurora: Optional[AuroraSettings] = None):
+        self.on = on
+        self.power = power
+        self.presets = [Colour(white=100)] * NUM_PRESETS if presets is None else presets
+        self.presetIdx = presetIdx
+        self.aurora = aurora
+
+    def duplicate(self) -> 'State':
+        # Colours and aurora settings are never mutated, so sharing them is safe
+        return State(self.on, self.power, self.presets.copy(), self.presetIdx, self.aurora)
+
+class Task:
+    __slots__ = ('fadeTime', 'postDelay', 'flash')
+
+    def __init__(self, fadeTime: float = 0, postDelay: float = 0, flash: bool = False):
+        self.fadeTime = fadeTime
+        self.postDelay = postDelay
+        self.flash = flash
+
+class Adjustment(Task):
+    __slots__ = ('power', 'colour')
+
+    def __init__(self, power: int = 0, colour: Colour = Colour(), **kwargs):
+        Task.__init__(self, **kwargs)
+        self.power = power
+        self.colour = colour
+
+class ChangePreset(Task):
+    __slots__ = ()
+
+class Switch(Task):
+    __slots__ = ()
+
+class StateChange(Task):
+    __slots__ = ('red', 'green', 'blue', 'white', 'on', 'power')
+
+    def __init__(self, red: Optional[float] = None, green: Optional[float] = None, blue: Optional[float] = None, white: Optional[float] = None,
+                 on: Optional[bool] = None, power: Optional[int] = None, **kwargs):
+        Task.__init__(self, **kwargs)
+        self.red = red
+        self.green = green
+        self.blue = blue
+        self.white = white
+        self.on = on
+        self.power = power
+
+class Aurora(Task):
+    __slots__ = ('minColour', 'maxColour', 'minColourDist')
+
+    def __init__(self, minColour: Colour = Colour(), maxColour: Colour = Colour(), minColourDist: float = 0.4, **kwargs):
+        Task.__init__(self, **kwargs)
+        self.minColour = minColour
+        self.maxColour = maxColour
+        self.minColourDist = minColourDist
+
+def bound(low: int, high: int, value: float) -> int:
+    return int(max(low, min(high, value)))
+
+def getEffectivePower(state: State) -> int:
+    return state.power if state.on else 0
+
+def getPwmColour(maxColourVal: float, effectivePower: int, colourVal: float) -> float:
+    # Kept fractional, the calibration resolves a level as finely as the PWM range allows
+    effectiveColour = 0 if maxColourVal == 0 else colourVal / maxColourVal * 100
+    return max(0.0, min(255.0, (effectiveColour * effectivePower * 255) / 10000))
+
+def getTaskSampler(task: Aurora) -> AuroraSampler:
+    return getAuroraSampler(task.minColour, task.maxColour, task.minColourDist)
+
+def applyTask(task: Task, currentTarget: State, auroraColour: Optional[Colour] = None) -> State:
+    # auroraColour stands in for a newly sampled one, so a journal can replay an aurora exactly
+    targetState = currentTarget.duplicate()
+
+    # If we are exiting the Aurora mode then make sure to return the preset to its original value
+    if not isinstance(task, Aurora) and targetState.aurora is not None:
+        targetState.presets[targetState.presetIdx] = targetState.aurora.storedColour
+        targetState.aurora = None
+
+    if isinstance(task, Adjustment):
+        newColour = targetState.presets[targetState.presetIdx]
+        if currentTarget.on or all(value <= 0 for value in task.colour):
+            newColour = Colour(
+                red=bound(0, 100, newColour.red + task.colour.red),
+                green=bound(0, 100, newColour.green + task.colour.green),
+                blue=bound(0, 100, newColour.blue + task.colour.blue),
+                white=bound(0, 100, newColour.white + task.colour.white),
+            )
+        else:
+            # Set target to the adjustment if we are currently off and have increased a colour
+            newColour = task.colour
+        targetState.presets[targetState.presetIdx] = newColour
+        targetState.on = True
+        if currentTarget.on:
+            targetState.power = bound(0, 100, currentTarget.power + task.power)
+            # Have a final minimum power level before going to zero or up from zero
+            if currentTarget.power > MINIMUM_DIM_POWER and targetState.power == 0:
+                # Started above the minimum dim and went to zero
+                targetState.power = MINIMUM_DIM_POWER
+            elif currentTarget.power == 0 and targetState.power > 0:
+                # Started at zero and went up
+                targetState.power = MINIMUM_DIM_POWER
+        elif task.power > 0:
+            # Light was off and went up
+            targetState.power = MINIMUM_DIM_POWER
+        else:
+            targetState.power = bound(0, 100, task.power)
+
+    elif isinstance(task, Switch):
+        if targetState.power == 0:
+            # Default to full power when pressing the switch after dimming to zero
+            targetState.power = 100
+            targetState.on = True
+        else:
+            targetState.on = not targetState.on
+
+    elif isinstance(task, StateChange):
+        # StateChange
+        activeColour = currentTarget.presets[currentTarget.presetIdx]
+        newColour = Colour(
+            red=activeColour.red if task.red is None else bound(0, 100, task.red),
+            green=activeColour.green if task.green is None else bound(0, 100, task.green),
+            blue=activeColour.blue if task.blue is None else bound(0, 100, task.blue),
+            white=activeColour.white if task.white is None else bound(0, 100, task.white),
+        )
+        targetState.presets[targetState.presetIdx] = newColour
+        targetState.power = currentTarget.power if task.power is None else bound(0, 100, task.power)
+        targetState.on = currentTarget.on if task.on is None else task.on
+        if task.on and task.power is None and targetState.power == 0:
+            # Switching on after dimming to zero comes back at full power, as the switch does
+            targetState.power = 100
+    elif isinstance(task, ChangePreset):
+        targetState.presetIdx = (targetState.presetIdx + 1) % NUM_PRESETS
+    elif isinstance(task, Aurora):
+        # If a new aurora is pushed to the queue, make sure to keep the storedColour from the first one
+        if currentTarget.aurora is None:
+            storedColour = currentTarget.presets[currentTarget.presetIdx]
+        else:
+            storedColour = currentTarget.aurora.storedColour
+        targetState.aurora = AuroraSettings(
+            storedColour=storedColour,
+            minColour=task.minColour,
+            maxColour=task.maxColour,
+            minColourDist=task.minColourDist
+        )
+
+        if auroraColour is None:
+            newColour = Colour(*getTaskSampler(task).sample(currentTarget.presets[currentTarget.presetIdx]))
+        else:
+            newColour = auroraColour
+
+        targetState.presets[targetState.presetIdx] = newColour
+    else:
+        print("Unknown task type")
+    return targetState
+
+def isFoldable(task: Task) -> bool:
+    # Flashes revert to their initial state and Aurora requeues itself, so neither can share a fade
+    return not task.flash and not isinstance(task, Aurora)
+
+def getStateChange(state: State = State(), task: Task = Task()) -> StateChange:
+    activeColour = state.presets[state.presetIdx]
+    return StateChange(
+        red=activeColour.red,
+        green=activeColour.green,
+        blue=activeColour.blue,
+        white=activeColour.white,
+        on=state.on,
+        power=state.power,
+        flash=task.flash,
+        fadeTime=task.fadeTime,
+        postDelay=task.postDelay
+    )
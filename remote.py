@@ -0,0 +1,436 @@
+import os
+import select
+import socket
+import struct
+import time
+from contextlib import contextmanager
+from threading import Condition, Event, RLock, Thread
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, TypeVar
+
+import pigpio
+
+from metrics import REGISTRY, Histogram
+from taskqueue import LatencyStats
+
+# pigpio socket protocol command numbers
+CMD_PWM = 5
+CMD_PRS = 6
+CMD_PFS = 7
+CMD_PIGPV = 26
+CMD_PROC = 38
+CMD_PROCD = 39
+CMD_PROCR = 40
+CMD_PROCS = 41
+CMD_PROCP = 45
+CMD_GDC = 83
+
+RESPONSE_SIZE = 16
+CONNECT_TIMEOUT = 2.0
+# Longest the fade thread waits on the write connection's replies before giving the daemon up as lost
+WRITE_TIMEOUT = 0.25
+POOL_SIZE = 2
+# Longest a query waits for a pooled connection to come free
+ACQUIRE_TIMEOUT = 2.0
+# Writes are sent without waiting for their replies, which are read back once this many are outstanding
+PIPELINE_DEPTH = 32
+HEALTH_INTERVAL = 5.0
+MIN_RECONNECT_DELAY = 0.1
+MAX_RECONNECT_DELAY = 5.0
+
+T = TypeVar('T')
+
+CALL_LATENCY = REGISTRY.register(Histogram(
+    "rgbw_pigpio_call_seconds", "Round trip time of pigpio daemon calls", ("host",)))
+
+class PigpioConnection:
+    def __init__(self, host: str, port: int, epoch: int = 0):
+        self.sock = socket.create_connection((host, port), CONNECT_TIMEOUT)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.epoch = epoch
+        self.pending = 0
+        self._buffer = bytearray()
+
+    def _send(self, cmd: int, p1: int, p2: int, ext: bytes):
+        self.sock.sendall(struct.pack('IIII', cmd, p1, p2, len(ext)) + ext)
+
+    def _fill(self):
+        chunk = self.sock.recv(4096)
+        if not chunk:
+            raise ConnectionError("pigpio daemon closed the connection")
+        self._buffer.extend(chunk)
+
+    def receive(self, size: int) -> bytes:
+        while len(self._buffer) < size:
+            self._fill()
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def _receiveResult(self) -> int:
+        return pigpio.u2i(struct.unpack('12sI', self.receive(RESPONSE_SIZE))[1])
+
+    def _takeReply(self):
+        self.pending -= 1
+        result = self._receiveResult()
+        if result < 0:
+            print("Pipelined pigpio command failed: {0}".format(pigpio.error_text(result)))
+
+    def collect(self):
+        # Reads whichever pipelined replies have already arrived, without waiting for the rest
+        while self.pending:
+            if len(self._buffer) < RESPONSE_SIZE:
+                if not select.select([self.sock], [], [], 0)[0]:
+                    return
+                self._fill()
+                continue
+            self._takeReply()
+
+    def drain(self):
+        while self.pending:
+            self._takeReply()
+
+    def post(self, cmd: int, p1: int = 0, p2: int = 0, ext: bytes = b""):
+        self._send(cmd, p1, p2, ext)
+        self.pending += 1
+        self.collect()
+        if self.pending >= PIPELINE_DEPTH:
+            self.drain()
+
+    def postMany(self, commands: Sequence[Tuple[int, int, int]]):
+        # Extension-free commands packed into a single send, a frame's writes cost one syscall rather than one each
+        self.sock.sendall(b"".join(struct.pack('IIII', cmd, p1, p2, 0) for cmd, p1, p2 in commands))
+        self.pending += len(commands)
+        self.collect()
+        if self.pending >= PIPELINE_DEPTH:
+            self.drain()
+
+    def call(self, cmd: int, p1: int = 0, p2: int = 0, ext: bytes = b"") -> int:
+        self.drain()
+        self._send(cmd, p1, p2, ext)
+        return self._receiveResult()
+
+    def status(self, scriptId: int) -> Tuple[int, Tuple[int, ...]]:
+        size = self.call(CMD_PROCP, scriptId)
+        if size <= 0:
+            return size, ()
+        pars = struct.unpack('11i', self.receive(size))
+        return pars[0], pars[1:]
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+class ConnectionPool:
+    def __init__(self, host: str, port: int, size: int = POOL_SIZE):
+        self.host = host
+        self.port = port
+        self.size = size
+        self._condition = Condition()
+        self._idle: List[PigpioConnection] = []
+        self._open = 0
+        # Bumped when the daemon is lost, connections from an older epoch are closed rather than reused
+        self.epoch = 0
+
+    @contextmanager
+    def connection(self) -> Iterator[PigpioConnection]:
+        connection = self._acquire()
+        broken = True
+        try:
+            yield connection
+            broken = False
+        finally:
+            # Any error can leave replies unread on the connection, so it's never handed out again
+            self._release(connection, broken)
+
+    def _acquire(self) -> PigpioConnection:
+        deadline = time.monotonic() + ACQUIRE_TIMEOUT
+        with self._condition:
+            while not self._idle and self._open >= self.size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise pigpio.error("no pigpio connection free after {0}s".format(ACQUIRE_TIMEOUT))
+                self._condition.wait(remaining)
+            if self._idle:
+                return self._idle.pop()
+            self._open += 1
+            epoch = self.epoch
+        try:
+            return PigpioConnection(self.host, self.port, epoch)
+        except OSError:
+            with self._condition:
+                self._open -= 1
+                self._condition.notify()
+            raise
+
+    def _release(self, connection: PigpioConnection, broken: bool = False):
+        with self._condition:
+            if broken or connection.epoch != self.epoch:
+                connection.close()
+                self._open -= 1
+            else:
+                self._idle.append(connection)
+            self._condition.notify()
+
+    def reset(self):
+        # Connections in use are closed when they are released
+        with self._condition:
+            self.epoch += 1
+            for connection in self._idle:
+                connection.close()
+            self._open -= len(self._idle)
+            self._idle = []
+            self._condition.notify_all()
+
+class HostMetrics:
+    def __init__(self, address: str):
+        self.roundTrips = LatencyStats()
+        self.callLatency = CALL_LATENCY.labels(address)
+        self.writes = 0
+        self.errors = 0
+        self.reconnects = 0
+
+    def summary(self) -> dict:
+        return {
+            "round_trip": self.roundTrips.summary(),
+            "writes": self.writes,
+            "errors": self.errors,
+            "reconnects": self.reconnects,
+        }
+
+class RemotePi:
+    # The subset of pigpio.pi used by the fade engine, spoken directly over the daemon's socket protocol
+    def __init__(self, host: Optional[str] = None, port: Optional[int] = None, poolSize: int = POOL_SIZE):
+        self.host = host or os.environ.get("PIGPIO_ADDR", "localhost")
+        self.port = port or int(os.environ.get("PIGPIO_PORT", 8888))
+        self.address = "{0}:{1}".format(self.host, self.port)
+        # Queries share a small pool, writes go down one connection so the daemon applies them in order
+        self.pool = ConnectionPool(self.host, self.port, poolSize)
+        self.metrics = HostMetrics(self.address)
+        self.connected = False
+        self._everConnected = False
+        self._stateLock = RLock()
+        self._writeConnection: Optional[PigpioConnection] = None
+        # Everything a daemon restart loses, pushed again after reconnecting
+        self._dutyCycles: Dict[int, int] = {}
+        self._ranges: Dict[int, int] = {}
+        self._frequencies: Dict[int, int] = {}
+        self._scripts: Dict[int, bytes] = {}
+        self._scriptIds: Dict[int, int] = {}
+        self._nextScriptId = 0
+        self._stop_event = Event()
+        self._reconnect = Event()
+
+        try:
+            self._restore()
+        except (OSError, pigpio.error) as e:
+            print("Unable to connect to pigpio daemon at {0}, retrying in the background: {1}".format(self.address, e))
+        self._monitor = Thread(target=self._watch, daemon=True)
+        self._monitor.start()
+
+    def _lost(self, e: Exception):
+        with self._stateLock:
+            self.metrics.errors += 1
+            if not self.connected:
+                return
+            print("Lost connection to pigpio daemon at {0}: {1}".format(self.address, e))
+            self.connected = False
+            if self._writeConnection is not None:
+                self._writeConnection.close()
+                self._writeConnection = None
+            self.pool.reset()
+        self._reconnect.set()
+
+    def _checkConnected(self):
+        if not self.connected:
+            raise pigpio.error("pigpio daemon at {0} is not connected".format(self.address))
+
+    def _query(self, action: Callable[[PigpioConnection], T]) -> T:
+        self._checkConnected()
+        start = time.monotonic()
+        try:
+            with self.pool.connection() as connection:
+                result = action(connection)
+        except (OSError, struct.error) as e:
+            # A reply that doesn't parse leaves the stream out of step, as bad as losing the connection
+            self._lost(e)
+            raise pigpio.error(str(e)) from e
+        roundTrip = time.monotonic() - start
+        self.metrics.roundTrips.record(roundTrip)
+        self.metrics.callLatency.observe(roundTrip)
+        return result
+
+    def _write(self, action: Callable[[PigpioConnection], T]) -> T:
+        # Callers hold the state lock
+        self._checkConnected()
+        try:
+            return action(self._writeConnection)
+        except OSError as e:
+            self._lost(e)
+            raise pigpio.error(str(e)) from e
+
+    def _checked(self, result: int) -> int:
+        if result < 0:
+            self.metrics.errors += 1
+            raise pigpio.error(pigpio.error_text(result))
+        return result
+
+    def _restore(self):
+        # The daemon may have restarted and forgotten every script and duty cycle. Everything is pushed on a fresh
+        # connection without the state lock, so the fade thread's writes never wait on a slow or silent daemon
+        self.pool.reset()
+        connection = PigpioConnection(self.host, self.port)
+        try:
+            with self._stateLock:
+                scripts = [(scriptId, remoteId, self._scripts[scriptId]) for scriptId, remoteId in self._scriptIds.items()]
+                settings = self._settings()
+            stored = {}
+            for scriptId, remoteId, script in scripts:
+                if connection.status(remoteId)[0] < 0:
+                    stored[scriptId] = self._checked(connection.call(CMD_PROC, 0, 0, script))
+            connection.postMany(settings)
+            connection.drain()
+            connection.sock.settimeout(WRITE_TIMEOUT)
+            with self._stateLock:
+                if self._stop_event.is_set():
+                    raise pigpio.error("stopped while restoring")
+                for scriptId, remoteId in stored.items():
+                    if scriptId in self._scriptIds:
+                        self._scriptIds[scriptId] = remoteId
+                # Writes made while the push was under way go out ahead of anything written after the swap
+                pushed = set(settings)
+                missed = [command for command in self._settings() if command not in pushed]
+                if missed:
+                    connection.postMany(missed)
+                self._writeConnection = connection
+                self.connected = True
+                if self._everConnected:
+                    self.metrics.reconnects += 1
+                self._everConnected = True
+        except (OSError, pigpio.error):
+            connection.close()
+            raise
+        print("Connected to pigpio daemon at {0}".format(self.address))
+
+    def _settings(self) -> List[Tuple[int, int, int]]:
+        # Callers hold the state lock
+        return ([(CMD_PFS, gpio, frequency) for gpio, frequency in self._frequencies.items()] +
+                [(CMD_PRS, gpio, pwmRange) for gpio, pwmRange in self._ranges.items()] +
+                [(CMD_PWM, gpio, dutyCycle) for gpio, dutyCycle in self._dutyCycles.items()])
+
+    def _watch(self):
+        delay = MIN_RECONNECT_DELAY
+        while not self._stop_event.is_set():
+            if self.connected:
+                self._reconnect.wait(HEALTH_INTERVAL)
+                self._reconnect.clear()
+                try:
+                    # Also keeps round trip samples coming in while the fixture is idle
+                    self._query(lambda connection: connection.call(CMD_PIGPV))
+                except pigpio.error:
+                    pass
+                continue
+            try:
+                self._restore()
+                delay = MIN_RECONNECT_DELAY
+            except (OSError, pigpio.error):
+                self._stop_event.wait(delay)
+                delay = min(MAX_RECONNECT_DELAY, delay * 2)
+
+    def set_PWM_dutycycle(self, user_gpio: int, dutycycle: float) -> int:
+        with self._stateLock:
+            # While the daemon is away the latest value is only remembered, the restore pushes it once it's back
+            self._dutyCycles[user_gpio] = int(dutycycle)
+            if not self.connected:
+                return 0
+            self._write(lambda connection: connection.post(CMD_PWM, user_gpio, int(dutycycle)))
+            self.metrics.writes += 1
+        return 0
+
+    def set_PWM_dutycycles(self, pairs: Sequence[Tuple[int, int]]) -> int:
+        # (gpio, duty cycle) pairs written together
+        commands = [(CMD_PWM, gpio, int(dutycycle)) for gpio, dutycycle in pairs]
+        with self._stateLock:
+            for _, gpio, dutycycle in commands:
+                self._dutyCycles[gpio] = dutycycle
+            if not self.connected:
+                return 0
+            self._write(lambda connection: connection.postMany(commands))
+            self.metrics.writes += len(commands)
+        return 0
+
+    def set_PWM_range(self, user_gpio: int, range_: int) -> int:
+        with self._stateLock:
+            # A restarted daemon is back to its default range, so it is pushed again like the duty cycles
+            self._ranges[user_gpio] = int(range_)
+            if not self.connected:
+                return 0
+            self._write(lambda connection: connection.post(CMD_PRS, user_gpio, int(range_)))
+        return 0
+
+    def set_PWM_frequency(self, user_gpio: int, frequency: int) -> int:
+        with self._stateLock:
+            self._frequencies[user_gpio] = int(frequency)
+            if not self.connected:
+                return 0
+            self._write(lambda connection: connection.post(CMD_PFS, user_gpio, int(frequency)))
+        return 0
+
+    def remember(self, dutyCycles: Iterable[Tuple[int, int]]):
+        # Duty cycles written by a daemon side script, so a re-push doesn't bring back older values
+        with self._stateLock:
+            self._dutyCycles.update(dutyCycles)
+
+    def get_PWM_dutycycle(self, user_gpio: int) -> int:
+        return self._checked(self._query(lambda connection: connection.call(CMD_GDC, user_gpio)))
+
+    def store_script(self, script: bytes) -> int:
+        with self._stateLock:
+            remoteId = self._checked(self._query(lambda connection: connection.call(CMD_PROC, 0, 0, script)))
+            scriptId = self._nextScriptId
+            self._nextScriptId += 1
+            self._scripts[scriptId] = script
+            self._scriptIds[scriptId] = remoteId
+        return scriptId
+
+    def _remoteId(self, scriptId: int) -> int:
+        if scriptId not in self._scriptIds:
+            raise pigpio.error("unknown script id {0}".format(scriptId))
+        return self._scriptIds[scriptId]
+
+    def run_script(self, script_id: int, params: Optional[Sequence[int]] = None) -> int:
+        params = list(params or [])
+        ext = struct.pack('{0}I'.format(len(params)), *params)
+        with self._stateLock:
+            remoteId = self._remoteId(script_id)
+            self._write(lambda connection: connection.post(CMD_PROCR, remoteId, 0, ext))
+            self.metrics.writes += 1
+        return 0
+
+    def script_status(self, script_id: int) -> Tuple[int, Tuple[int, ...]]:
+        remoteId = self._remoteId(script_id)
+        status, params = self._query(lambda connection: connection.status(remoteId))
+        return self._checked(status), params
+
+    def stop_script(self, script_id: int) -> int:
+        with self._stateLock:
+            remoteId = self._remoteId(script_id)
+            return self._checked(self._write(lambda connection: connection.call(CMD_PROCS, remoteId)))
+
+    def delete_script(self, script_id: int) -> int:
+        with self._stateLock:
+            remoteId = self._remoteId(script_id)
+            del self._scripts[script_id]
+            del self._scriptIds[script_id]
+        return self._checked(self._query(lambda connection: connection.call(CMD_PROCD, remoteId)))
+
+    def stop(self):
+        self._stop_event.set()
+        self._reconnect.set()
+        with self._stateLock:
+            self.connected = False
+            if self._writeConnection is not None:
+                self._writeConnection.close()
+                self._writeConnection = None
+            self.pool.reset()
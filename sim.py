@@ -0,0 +1,331 @@
+import os
+import shutil
+import socket
+import socketserver
+import struct
+import tempfile
+import time
+from queue import Queue
+from threading import Lock, Thread
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import pigpio
+
+import remote
+from fixtures import FadeScheduler, Fixture
+from persistence import stateToDict, writeAtomically
+from reducer import State
+
+# A write made at a time by either a direct call (source None) or a running script
+Write = Tuple[float, int, int, Optional[int]]
+
+SIM_PINS = (26, 19, 13, 6)
+# Writes kept by a simulated daemon, plenty to answer duty cycle queries without growing forever
+SIM_HISTORY = 10000
+# Virtual time a pass of the scheduler takes at the least, as the clock always moves on a real pi
+SIM_RESOLUTION = 0.000001
+
+class MockPi:
+    def __init__(self, clock: Callable[[], float] = time.monotonic, historyLimit: Optional[int] = None):
+        self.clock = clock
+        self.historyLimit = historyLimit
+        self.writes: List[Write] = []
+        self.scripts: Dict[int, List[Tuple[str, ...]]] = {}
+        self.scriptEnds: Dict[int, float] = {}
+        self.ranges: Dict[int, int] = {}
+        self.frequencies: Dict[int, int] = {}
+        self._nextScriptId = 0
+
+    @property
+    def timeline(self) -> List[Tuple[float, int, int]]:
+        return [(at, gpio, value) for at, gpio, value, _ in sorted(self.writes, key=lambda write: write[0])]
+
+    def _record(self, write: Write):
+        self.writes.append(write)
+        if self.historyLimit is not None and len(self.writes) > 2 * self.historyLimit:
+            del self.writes[:-self.historyLimit]
+
+    def set_PWM_dutycycle(self, user_gpio: int, dutycycle: float) -> int:
+        self._record((self.clock(), user_gpio, int(dutycycle), None))
+        return 0
+
+    def set_PWM_range(self, user_gpio: int, range_: int) -> int:
+        self.ranges[user_gpio] = int(range_)
+        return 0
+
+    def set_PWM_frequency(self, user_gpio: int, frequency: int) -> int:
+        self.frequencies[user_gpio] = int(frequency)
+        return int(frequency)
+
+    def get_PWM_dutycycle(self, user_gpio: int) -> int:
+        now = self.clock()
+        value = 0
+        for at, gpio, written, _ in sorted(self.writes, key=lambda write: write[0]):
+            if at > now:
+                break
+            if gpio == user_gpio:
+                value = written
+        return value
+
+    def store_script(self, script: bytes) -> int:
+        tokens = script.decode().split()
+        commands = []
+        idx = 0
+        while idx < len(tokens):
+            command = tokens[idx]
+            if command == "pwm":
+                commands.append((command, tokens[idx + 1], tokens[idx + 2]))
+                idx += 3
+            elif command in ("mics", "mils"):
+                # The daemon refuses a delay longer than a single command can wait
+                if int(tokens[idx + 1]) > (1000000 if command == "mics" else 60000):
+                    raise pigpio.error("{0} delay {1} is too long".format(command, tokens[idx + 1]))
+                commands.append((command, tokens[idx + 1]))
+                idx += 2
+            else:
+                raise pigpio.error("MockPi does not support script command {0}".format(command))
+        scriptId = self._nextScriptId
+        self._nextScriptId += 1
+        self.scripts[scriptId] = commands
+        return scriptId
+
+    def script_status(self, script_id: int) -> Tuple[int, Tuple[int, ...]]:
+        if self.scriptEnds.get(script_id, 0) > self.clock():
+            return pigpio.PI_SCRIPT_RUNNING, ()
+        return pigpio.PI_SCRIPT_HALTED, ()
+
+    def run_script(self, script_id: int, params: Optional[Sequence[int]] = None) -> int:
+        # Lays out every write the daemon would make, stop_script drops the ones it never reaches
+        params = list(params or [])
+        at = self.clock()
+        for command in self.scripts[script_id]:
+            if command[0] == "mics":
+                at += int(command[1]) / 1000000
+            elif command[0] == "mils":
+                at += int(command[1]) / 1000
+            else:
+                gpio, value = (self._resolve(arg, params) for arg in command[1:])
+                self._record((at, gpio, value, script_id))
+        self.scriptEnds[script_id] = at
+        return 0
+
+    def _resolve(self, arg: str, params: List[int]) -> int:
+        return params[int(arg[1:])] if arg.startswith("p") else int(arg)
+
+    def stop_script(self, script_id: int) -> int:
+        now = self.clock()
+        self.writes = [write for write in self.writes if write[3] != script_id or write[0] <= now]
+        self.scriptEnds[script_id] = now
+        return 0
+
+    def delete_script(self, script_id: int) -> int:
+        self.scripts.pop(script_id, None)
+        self.scriptEnds.pop(script_id, None)
+        return 0
+
+    def stop(self):
+        pass
+
+class FakePigpioServer:
+    # Speaks enough of the pigpio socket protocol to stand in for pigpiod, backed by a MockPi
+    def __init__(self, pi: Optional[MockPi] = None, host: str = "127.0.0.1", port: int = 0, latency: float = 0.0):
+        self.pi = pi or MockPi()
+        # Delay added to every reply, as a stand in for the network between here and a remote daemon
+        self.latency = latency
+        self.restarts = 0
+        self._clients: List[socket.socket] = []
+        self._lock = Lock()
+        server = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                with server._lock:
+                    server._clients.append(self.request)
+                try:
+                    server._serve(self.request)
+                except OSError:
+                    pass
+                finally:
+                    with server._lock:
+                        if self.request in server._clients:
+                            server._clients.remove(self.request)
+
+        self._server = socketserver.ThreadingTCPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self.host, self.port = self._server.server_address[:2]
+        self._thread = Thread(target=self._server.serve_forever, daemon=True)
+
+    def start(self) -> 'FakePigpioServer':
+        self._thread.start()
+        return self
+
+    def _receive(self, sock: socket.socket, size: int) -> Optional[bytes]:
+        data = bytearray()
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+            if not chunk:
+                return None
+            data.extend(chunk)
+        return bytes(data)
+
+    def _serve(self, sock: socket.socket):
+        replies: Queue = Queue()
+        sender = Thread(target=self._sendReplies, args=(sock, replies), daemon=True)
+        sender.start()
+        try:
+            while True:
+                request = self._receive(sock, 16)
+                if request is None:
+                    return
+                cmd, p1, p2, p3 = struct.unpack('IIII', request)
+                ext = self._receive(sock, p3) if p3 else b""
+                with self._lock:
+                    result, data = self._execute(cmd, p1, p2, ext)
+                replies.put((time.monotonic() + self.latency, struct.pack('IIIi', cmd, p1, p2, result) + data))
+        finally:
+            replies.put(None)
+
+    def _sendReplies(self, sock: socket.socket, replies: Queue):
+        # Replies keep their order but each is held back by the latency, without holding up the requests behind it
+        while True:
+            reply = replies.get()
+            if reply is None:
+                return
+            due, data = reply
+            time.sleep(max(0.0, due - time.monotonic()))
+            try:
+                sock.sendall(data)
+            except OSError:
+                return
+
+    def _execute(self, cmd: int, p1: int, p2: int, ext: bytes) -> Tuple[int, bytes]:
+        try:
+            if cmd == remote.CMD_PWM:
+                return self.pi.set_PWM_dutycycle(p1, p2), b""
+            if cmd == remote.CMD_PRS:
+                return self.pi.set_PWM_range(p1, p2), b""
+            if cmd == remote.CMD_PFS:
+                return self.pi.set_PWM_frequency(p1, p2), b""
+            if cmd == remote.CMD_GDC:
+                return self.pi.get_PWM_dutycycle(p1), b""
+            if cmd == remote.CMD_PIGPV:
+                return 79, b""
+            if cmd == remote.CMD_PROC:
+                return self.pi.store_script(ext), b""
+            if cmd == remote.CMD_PROCR:
+                return self.pi.run_script(p1, struct.unpack('{0}I'.format(len(ext) // 4), ext)), b""
+            if cmd == remote.CMD_PROCS:
+                return self.pi.stop_script(p1), b""
+            if cmd == remote.CMD_PROCD:
+                return self.pi.delete_script(p1), b""
+            if cmd == remote.CMD_PROCP:
+                if p1 not in self.pi.scripts:
+                    return pigpio.PI_BAD_SCRIPT_ID, b""
+                status, params = self.pi.script_status(p1)
+                return 44, struct.pack('11i', status, *(list(params) + [0] * 10)[:10])
+        except pigpio.error:
+            return pigpio.PI_BAD_SCRIPT_CMD, b""
+        return pigpio.PI_UNKNOWN_COMMAND, b""
+
+    def restart(self):
+        # Drops every client and forgets stored scripts, like pigpiod being restarted
+        with self._lock:
+            for sock in self._clients:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            self._clients = []
+            # Outputs come back up switched off
+            for gpio in {write[1] for write in self.pi.writes}:
+                self.pi.set_PWM_dutycycle(gpio, 0)
+            self.pi.scripts = {}
+            self.pi.scriptEnds = {}
+            self.pi.ranges = {}
+            self.pi.frequencies = {}
+            self.pi._nextScriptId = 0
+            self.restarts += 1
+
+    def stop(self):
+        self.restart()
+        self._server.shutdown()
+        self._server.server_close()
+
+class SimulatedDaemons:
+    # Stands a fake daemon in for each one the fixtures connect to, so the app runs without any hardware
+    def __init__(self):
+        self.servers: Dict[Tuple[Optional[str], Optional[int]], FakePigpioServer] = {}
+        # State files and journals go here, a simulated run must never touch the real fixtures' ones
+        self.workDir = tempfile.mkdtemp(prefix="rgbw-sim-")
+
+    def __call__(self, host: Optional[str] = None, port: Optional[int] = None) -> remote.RemotePi:
+        if (host, port) not in self.servers:
+            self.servers[(host, port)] = FakePigpioServer(MockPi(historyLimit=SIM_HISTORY)).start()
+        server = self.servers[(host, port)]
+        return remote.RemotePi(server.host, server.port)
+
+    def stop(self):
+        for server in self.servers.values():
+            server.stop()
+        shutil.rmtree(self.workDir, ignore_errors=True)
+
+class VirtualClock:
+    def __init__(self, start: float = 0.0):
+        self.now = start
+
+    def __call__(self) -> float:
+        return self.now
+
+class Simulation:
+    # Steps fixtures from the calling thread on a virtual clock, so a run is repeatable and never waits in real time
+    def __init__(self, fixtureCount: int = 1, initialState: Optional[State] = None, journal: bool = False,
+                 fadeBackend: str = "tick"):
+        self.clock = VirtualClock()
+        self.workDir = tempfile.mkdtemp(prefix="rgbw-sim-")
+        self.fixtures: List[Fixture] = []
+        for idx in range(fixtureCount):
+            name = "sim{0}".format(idx)
+            statePath = os.path.join(self.workDir, "state-{0}.json".format(name))
+            writeAtomically(statePath, stateToDict(initialState or State()))
+            journalPath = os.path.join(self.workDir, "journal-{0}.bin".format(name)) if journal else None
+            fixture = Fixture(name, MockPi(self.clock), SIM_PINS, statePath, fadeBackend, self.clock, journalPath=journalPath)
+            if fadeBackend == "script":
+                # Uploaded as soon as a fade starts rather than on a thread, so runs stay repeatable
+                fixture.fadeBackend.submit = lambda job: job()
+            if fixture.journal is not None:
+                # Recorded on the virtual clock, so a journalled run replays with the same timing
+                fixture.journal.clock = self.clock
+            self.fixtures.append(fixture)
+        self.scheduler = FadeScheduler(self.fixtures, self.clock)
+        self.scheduler.restoreFixtures()
+
+    @property
+    def writes(self) -> int:
+        return sum(len(fixture.pi.writes) for fixture in self.fixtures)
+
+    def run(self, seconds: float):
+        # Advances the clock by seconds, stepping the fixtures at every frame and post delay due on the way
+        end = self.clock.now + seconds
+        self._runUntil(end)
+        self.clock.now = end
+
+    def settle(self, limit: float = 60.0) -> float:
+        # Runs until every fixture is idle, returns the virtual time that took
+        start = self.clock.now
+        self._runUntil(start + limit)
+        return self.clock.now - start
+
+    def _runUntil(self, end: float):
+        while True:
+            deadline = self.scheduler.runOnce(self.clock.now)
+            if any(fixture.canStart() for fixture in self.fixtures):
+                # Tasks queued while stepping, like an aurora's next cycle, start at the same time
+                continue
+            if deadline is None or deadline > end:
+                return
+            self.clock.now = max(deadline, self.clock.now + SIM_RESOLUTION)
+
+    def close(self):
+        self.scheduler.close()
+        shutil.rmtree(self.workDir, ignore_errors=True)
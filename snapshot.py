@@ -0,0 +1,59 @@
+import json
+import os
+from typing import Dict, Iterable, List, Tuple
+
+from calibration import DEFAULT_PWM_RANGE
+from remote import CMD_PFS, CMD_PRS, CMD_PWM, PigpioConnection
+
+# Every fixture's settled duty cycles, cheap enough to read and push before the app has even been imported
+SNAPSHOT_PATH = os.environ.get("RGBW_SNAPSHOT", "./snapshot.json")
+
+def snapshotFixture(fixture) -> dict:
+    # Already calibrated, so restoring needs nothing but the raw values and the range they are in
+    calibration = fixture.writer.calibration
+    return {
+        "host": fixture.pi.host,
+        "port": fixture.pi.port,
+        "pins": list(fixture.writer.pins),
+        "pwmRange": calibration.pwmRange,
+        "pwmFrequency": calibration.pwmFrequency,
+        "dutyCycles": fixture.writer.calibrate(fixture.writer.shadow.target()),
+    }
+
+def snapshotFixtures(fixtures: Iterable) -> dict:
+    return {"fixtures": [snapshotFixture(fixture) for fixture in fixtures]}
+
+def restoreSnapshot(path: str = SNAPSHOT_PATH):
+    # Puts the lights back as they were straight away, the app writes the same values again once it's up
+    try:
+        with open(path, 'r') as f:
+            snapshot = json.load(f)
+    except FileNotFoundError:
+        return
+    except ValueError as e:
+        print("Ignoring unreadable snapshot {0}: {1}".format(path, e))
+        return
+
+    # (command, pin, value) for each daemon, the range has to be in place before the duty cycles mean anything
+    writes: Dict[Tuple[str, int], List[Tuple[int, int, int]]] = {}
+    for fixture in snapshot["fixtures"]:
+        commands = writes.setdefault((fixture["host"], fixture["port"]), [])
+        for pin, dutyCycle in zip(fixture["pins"], fixture["dutyCycles"]):
+            if fixture.get("pwmFrequency") is not None:
+                commands.append((CMD_PFS, pin, fixture["pwmFrequency"]))
+            commands.append((CMD_PRS, pin, fixture.get("pwmRange", DEFAULT_PWM_RANGE)))
+            commands.append((CMD_PWM, pin, dutyCycle))
+    for (host, port), commands in writes.items():
+        try:
+            connection = PigpioConnection(host, port)
+        except OSError as e:
+            print("Unable to restore duty cycles on {0}:{1}: {2}".format(host, port, e))
+            continue
+        try:
+            for command, pin, value in commands:
+                connection.post(command, pin, value)
+            connection.drain()
+        except OSError as e:
+            print("Unable to restore duty cycles on {0}:{1}: {2}".format(host, port, e))
+        finally:
+            connection.close()
@@ -1,4 +1,13 @@
-import uvicorn
+import os
+
+from snapshot import restoreSnapshot
+
+# State streams never finish on their own, so give up waiting on them after this long when shutting down
+SHUTDOWN_TIMEOUT = 2
 
 if __name__ == '__main__':
-    uvicorn.run("app:app", host="0.0.0.0", port=5000, log_level="info")
+    # Bring the lights back before the web stack is imported, that takes seconds on a pi
+    if os.environ.get("RGBW_SIMULATE") != "1":
+        restoreSnapshot()
+    import uvicorn
+    uvicorn.run("app:app", host="0.0.0.0", port=5000, log_level="info", timeout_graceful_shutdown=SHUTDOWN_TIMEOUT)
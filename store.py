@@ -0,0 +1,22 @@
+from threading import Lock
+from typing import Any, Callable, Optional, Tuple
+
+class StateStore:
+    def __init__(self):
+        # Only publishers take the lock, readers just grab the current snapshot reference
+        self._lock = Lock()
+        self._snapshot: Tuple[int, Optional[Any]] = (0, None)
+        # Called with each newly published version and state
+        self.onPublish: Optional[Callable[[int, Any], None]] = None
+
+    def publish(self, state: Any) -> int:
+        # The published state must not be mutated afterwards
+        with self._lock:
+            version = self._snapshot[0] + 1
+            self._snapshot = (version, state)
+        if self.onPublish is not None:
+            self.onPublish(version, state)
+        return version
+
+    def snapshot(self) -> Tuple[int, Optional[Any]]:
+        return self._snapshot
@@ -0,0 +1,106 @@
+import asyncio
+import json
+from functools import partial
+from threading import Lock
+from typing import Any, AsyncIterator, Collection, Dict, Optional, Sequence, Tuple
+
+from fixtures import Fixture
+from persistence import stateToDict
+from reducer import State
+
+STATE_EVENT = "state"
+DUTY_EVENT = "duty"
+# Live duty cycles change every fade frame, subscribers get them at most this often
+DUTY_STREAM_INTERVAL = 0.1
+KEEPALIVE_INTERVAL = 15.0
+KEEPALIVE = b": keepalive\n\n"
+
+FrameKey = Tuple[str, str]
+
+def encodeFrame(kind: str, data: Any) -> bytes:
+    return "event: {0}\ndata: {1}\n\n".format(kind, json.dumps(data, separators=(',', ':'))).encode()
+
+class StateBroadcaster:
+    # Server-sent events fed from the scheduler thread, which only ever records the latest value of each stream
+    def __init__(self, dutyInterval: float = DUTY_STREAM_INTERVAL):
+        self.dutyInterval = dutyInterval
+        self._lock = Lock()
+        # Values waiting to be encoded, a newer value replaces one that hasn't been sent yet
+        self._pending: Dict[FrameKey, Any] = {}
+        self._flushScheduled = False
+        self._lastDutyFlush = 0.0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        # Encoded once and shared by every subscriber, only touched on the event loop
+        self.frames: Dict[FrameKey, Tuple[int, bytes]] = {}
+        self._sequence = 0
+        self._changed: Optional[asyncio.Event] = None
+        self.subscribers = 0
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._changed = asyncio.Event()
+        with self._lock:
+            self._flushScheduled = True
+        self._flush()
+
+    def publish(self, kind: str, fixtureName: str, data: Any):
+        with self._lock:
+            self._pending[(kind, fixtureName)] = data
+            if self._flushScheduled or self._loop is None:
+                return
+            self._flushScheduled = True
+        self._loop.call_soon_threadsafe(self._flush)
+
+    def _flush(self):
+        now = self._loop.time()
+        dutyDue = now - self._lastDutyFlush >= self.dutyInterval
+        with self._lock:
+            ready = [(key, data) for key, data in self._pending.items() if dutyDue or key[0] != DUTY_EVENT]
+            for key, _ in ready:
+                del self._pending[key]
+            # Duty cycles held back by the rate limit go out once it allows, so the final frame of a fade is never lost
+            self._flushScheduled = bool(self._pending)
+        if self._flushScheduled:
+            self._loop.call_later(self._lastDutyFlush + self.dutyInterval - now, self._flush)
+        if not ready:
+            return
+
+        for key, data in ready:
+            self._sequence += 1
+            self.frames[key] = (self._sequence, encodeFrame(key[0], data))
+            if key[0] == DUTY_EVENT:
+                self._lastDutyFlush = now
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def subscribe(self, fixtureNames: Collection[str], kinds: Collection[str]) -> AsyncIterator[bytes]:
+        # Sends the latest frame of every stream it hasn't seen yet, a client too slow to keep up skips straight to the newest
+        seen: Dict[FrameKey, int] = {}
+        self.subscribers += 1
+        try:
+            while True:
+                changed = self._changed
+                for key, (sequence, frame) in list(self.frames.items()):
+                    if key[0] in kinds and key[1] in fixtureNames and seen.get(key) != sequence:
+                        seen[key] = sequence
+                        yield frame
+                try:
+                    await asyncio.wait_for(changed.wait(), KEEPALIVE_INTERVAL)
+                except asyncio.TimeoutError:
+                    yield KEEPALIVE
+        finally:
+            self.subscribers -= 1
+
+def publishState(broadcaster: StateBroadcaster, fixtureName: str, version: int, state: State):
+    data = stateToDict(state)
+    data["version"] = version
+    data["aurora"] = state.aurora is not None
+    broadcaster.publish(STATE_EVENT, fixtureName, data)
+
+def publishDutyCycles(broadcaster: StateBroadcaster, fixtureName: str, dutyCycles: Sequence[float]):
+    # Levels rather than calibrated values, whole ones are plenty for a display
+    broadcaster.publish(DUTY_EVENT, fixtureName, [int(value) for value in dutyCycles])
+
+def watchFixture(broadcaster: StateBroadcaster, fixture: Fixture):
+    fixture.stateStore.onPublish = partial(publishState, broadcaster, fixture.name)
+    fixture.writer.shadow.onCurrent = partial(publishDutyCycles, broadcaster, fixture.name)
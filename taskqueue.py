@@ -0,0 +1,85 @@
+import time
+from collections import deque
+from queue import Queue
+from threading import Lock
+from typing import Any, Callable, Deque, Dict, List, Optional
+
+LATENCY_SAMPLES = 500
+
+class TaskQueue(Queue):
+    def __init__(self, clock: Callable[[], float] = time.monotonic):
+        Queue.__init__(self)
+        self.clock = clock
+        # Enqueue time of the task most recently taken off the queue
+        self.lastEnqueuedAt: Optional[float] = None
+        self.coalesced = 0
+        # Called after every put, lets a scheduler watching several queues wake up
+        self.onPut: Optional[Callable[[], None]] = None
+        # Completion callbacks of the tasks in the most recent run
+        self.lastWaiters: List[Callable[[str], None]] = []
+
+    def put(self, task, block: bool = True, timeout: Optional[float] = None, onDone: Optional[Callable[[str], None]] = None):
+        # onDone is called with how the task's fade ended, once it has
+        Queue.put(self, (task, onDone), block, timeout)
+        if self.onPut is not None:
+            self.onPut()
+
+    def _put(self, item):
+        task, onDone = item
+        self.queue.append((self.clock(), task, onDone))
+
+    def _get(self):
+        enqueuedAt, task, onDone = self.queue.popleft()
+        self.lastEnqueuedAt = enqueuedAt
+        if onDone is not None:
+            self.lastWaiters.append(onDone)
+        return task
+
+    def getRun(self, canFold: Callable[[Any], bool]) -> List[Any]:
+        # Takes the next task plus every foldable task queued straight after it
+        self.lastWaiters = []
+        tasks = [self.get_nowait()]
+        enqueuedAt = self.lastEnqueuedAt
+        if canFold(tasks[0]):
+            with self.mutex:
+                while self.queue and canFold(self.queue[0][1]):
+                    tasks.append(self._get())
+                self.coalesced += len(tasks) - 1
+        # Latency of a run is measured from its oldest task
+        self.lastEnqueuedAt = enqueuedAt
+        return tasks
+
+    def waitForTask(self, timeout: Optional[float] = None) -> bool:
+        # Blocks until a task is queued, the timeout passes or wake() is called
+        with self.not_empty:
+            if not self._qsize():
+                self.not_empty.wait(timeout)
+            return self._qsize() > 0
+
+    def wake(self):
+        with self.not_empty:
+            self.not_empty.notify_all()
+
+class LatencyStats:
+    def __init__(self, maxSamples: int = LATENCY_SAMPLES):
+        self._lock = Lock()
+        self._samples: Deque[float] = deque(maxlen=maxSamples)
+        self.count = 0
+
+    def record(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+            self.count += 1
+
+    def summary(self) -> Dict[str, float]:
+        with self._lock:
+            samples = sorted(self._samples)
+            count = self.count
+        if not samples:
+            return {"count": count}
+        return {
+            "count": count,
+            "p50_ms": samples[len(samples) // 2] * 1000,
+            "p99_ms": samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1000,
+            "max_ms": samples[-1] * 1000,
+        }
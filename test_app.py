@@ -0,0 +1,10 @@
+import pytest
+from pydantic import ValidationError
+
+from app import AdjustmentModel
+
+@pytest.mark.parametrize("field", ["fadeTime", "postDelay"])
+@pytest.mark.parametrize("value", ["NaN", "Infinity", -0.5])
+def test_request_rejects_a_bad_fade_time_or_post_delay(field, value):
+    with pytest.raises(ValidationError):
+        AdjustmentModel.parse_obj({field: value})
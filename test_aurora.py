@@ -0,0 +1,29 @@
+import logging
+import random
+
+import pytest
+
+from aurora import AuroraInfeasible, AuroraSampler, dist, normalize
+
+def test_range_too_narrow_for_the_colour_distance_is_rejected_up_front():
+    with pytest.raises(AuroraInfeasible, match="apart"):
+        AuroraSampler((90, 0, 0, 0), (100, 10, 0, 0), 0.4)
+    # A single colour can never move at all
+    with pytest.raises(AuroraInfeasible):
+        AuroraSampler((100, 0, 50, 0), (100, 0, 50, 0), 0.1)
+
+def test_wide_range_samples_colours_far_enough_apart():
+    sampler = AuroraSampler((0, 0, 0, 0), (100, 100, 100, 0), 0.4, random.Random(1))
+    previous = (50, 50, 50, 50)
+    for _ in range(200):
+        colour = sampler.sample(previous)
+        assert dist(normalize(colour), normalize(previous)) >= 0.4
+        previous = colour
+
+def test_falling_back_to_the_furthest_colour_is_logged_once(caplog):
+    # Red with any amount of white, wide enough overall but nothing is 0.5 away from the middle of the range
+    sampler = AuroraSampler((100, 0, 0, 0), (100, 0, 0, 100), 0.5, random.Random(1))
+    with caplog.at_level(logging.WARNING, logger="aurora"):
+        colours = [sampler.sample((100, 0, 0, 41)) for _ in range(3)]
+    assert all(colour in ((100, 0, 0, 0), (100, 0, 0, 100)) for colour in colours)
+    assert len(caplog.records) == 1
@@ -0,0 +1,38 @@
+import pytest
+
+from calibration import MAX_PWM_RANGE, MIN_PWM_RANGE, Calibration
+from channels import ChannelWriter
+from reducer import getPwmColour
+from sim import SIM_PINS, MockPi
+
+def makeWriter(**settings) -> ChannelWriter:
+    return ChannelWriter(MockPi(), SIM_PINS, Calibration(len(SIM_PINS), **settings))
+
+def test_full_level_reaches_full_scale_on_every_range():
+    # Ranges where 255 * (pwmRange / 255) falls just short of pwmRange
+    awkward = [pwmRange for pwmRange in range(MIN_PWM_RANGE, MAX_PWM_RANGE + 1) if int(255 * (pwmRange / 255)) != pwmRange]
+    assert 16325 in awkward
+    for pwmRange in awkward[:5] + [MIN_PWM_RANGE, 255, MAX_PWM_RANGE]:
+        writer = makeWriter(pwmRange=pwmRange)
+        assert writer.calibrate((255.0, 0.0, 127.5, 0.0)) == [pwmRange, 0, round(pwmRange / 2), 0]
+
+def test_dim_colours_keep_their_balance_on_a_fine_range():
+    colour = (100, 30, 0, 40)
+    levels = [getPwmColour(max(colour), 2, value) for value in colour]
+    assert levels == pytest.approx([5.1, 1.53, 0, 2.04])
+    written = makeWriter(pwmRange=40000).calibrate(levels)
+    assert written == [800, 240, 0, 320]
+    # Each power step below it is still a distinct output
+    steps = [makeWriter(pwmRange=40000, gamma=2.2).calibrate([getPwmColour(100, power, 100)])[0] for power in range(1, 6)]
+    assert steps == sorted(set(steps)) and steps[0] > 0
+
+def test_default_range_writes_levels_unchanged():
+    writer = makeWriter()
+    assert writer.calibrate((0.0, 1.0, 128.0, 255.0)) == [0, 1, 128, 255]
+
+def test_write_that_changes_no_output_still_moves_the_shadow():
+    writer = makeWriter()
+    writer.write((0.0, 0.0, 0.0, 0.0))
+    writer.write((0.2, 0.0, 0.0, 0.0))
+    assert writer.read() == (0.2, 0.0, 0.0, 0.0)
+    assert writer.lastWritten == [0, 0, 0, 0]
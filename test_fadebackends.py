@@ -0,0 +1,114 @@
+import math
+
+import pigpio
+import pytest
+
+from channels import ChannelWriter
+from curve import FadeCurve, INTERVALS
+from fadebackends import ScriptFadeBackend, TickFadeBackend, getDelayCommands
+from sim import SIM_PINS, MockPi, VirtualClock
+
+START = (0.0, 0.0, 0.0, 0.0)
+TARGET = (255.0, 128.0, 0.0, 64.0)
+
+def makeBackend():
+    clock = VirtualClock()
+    pi = MockPi(clock)
+    writer = ChannelWriter(pi, SIM_PINS)
+    writer.write(START)
+    # Uploaded in line, so the script is running as soon as start returns
+    backend = ScriptFadeBackend(pi, writer, clock, submit=lambda job: job())
+    return clock, pi, writer, backend
+
+def fadeWrites(pi: MockPi, after: float):
+    return [write for write in pi.timeline if write[0] > after]
+
+def test_script_fade_is_laid_out_over_the_fade_time():
+    clock, pi, writer, backend = makeBackend()
+    curve = FadeCurve(START, TARGET)
+    end = curve.dutyCycles(INTERVALS)
+    backend.start(curve, 1.0, clock.now)
+    writes = fadeWrites(pi, 0.0)
+    assert writes
+    assert writes[0][0] < 0.5 and len({at for at, _, _ in writes}) > 10
+    assert abs(writes[-1][0] - 1.0) < 0.001
+    # Each channel ends on the end of the curve, and the channel that doesn't move is never written
+    final = {gpio: value for _, gpio, value in writes}
+    assert [final.get(pin) for pin in SIM_PINS] == [value if value else None for value in writer.calibrate(end)]
+    times = [at for at, _, _ in writes]
+    assert times == sorted(times)
+    assert backend.step(clock.now) == backend.endTime
+    clock.now = backend.endTime + backend.frameTime
+    assert backend.step(clock.now) is None
+    assert writer.read() == end
+    assert writer.lastWritten == writer.calibrate(end)
+    assert [pi.get_PWM_dutycycle(pin) for pin in SIM_PINS] == writer.lastWritten
+
+def test_cancelled_script_fade_stops_where_the_daemon_got_to():
+    clock, pi, writer, backend = makeBackend()
+    backend.start(FadeCurve(START, TARGET), 1.0, clock.now)
+    clock.now = 0.405
+    backend.cancel(clock.now)
+    assert fadeWrites(pi, 0.0)[-1][0] <= clock.now
+    # The writer's view of the channels matches what the daemon last wrote
+    assert writer.lastWritten == [pi.get_PWM_dutycycle(pin) for pin in SIM_PINS]
+    assert 0 < writer.lastWritten[0] < writer.calibrate(TARGET)[0]
+
+@pytest.mark.parametrize("fadeTime", [math.nan, 0.0])
+def test_tick_fade_without_a_usable_fade_time_ends_on_its_first_frame(fadeTime):
+    clock, pi, writer, _ = makeBackend()
+    backend = TickFadeBackend(writer)
+    curve = FadeCurve(START, TARGET)
+    backend.start(curve, fadeTime, clock.now)
+    assert backend.step(clock.now) is None
+    assert writer.read() == curve.dutyCycles(INTERVALS)
+
+def test_tick_fade_ends_once_its_fade_time_is_up():
+    clock, pi, writer, _ = makeBackend()
+    backend = TickFadeBackend(writer)
+    backend.start(FadeCurve(START, TARGET), 0.5, clock.now)
+    steps = 0
+    deadline = backend.step(clock.now)
+    while deadline is not None:
+        clock.now = deadline
+        deadline = backend.step(clock.now)
+        steps += 1
+    assert clock.now == 0.5 and steps > 1
+
+def test_long_frame_delays_are_split_to_fit_the_daemon():
+    assert getDelayCommands(0.01) == ["mics 10000"]
+    assert getDelayCommands(1.0) == ["mics 1000000"]
+    assert getDelayCommands(86.4) == ["mils 60000", "mils 26400"]
+    assert getDelayCommands(120.0) == ["mils 60000", "mils 60000"]
+
+def test_day_long_script_fade_is_stored_and_timed_by_the_daemon():
+    clock, pi, writer, backend = makeBackend()
+    backend.start(FadeCurve(START, TARGET), 24 * 60 * 60, clock.now)
+    assert not backend.usingFallback
+    assert fadeWrites(pi, 0.0)[-1][0] == pytest.approx(24 * 60 * 60)
+
+def test_failed_script_leaves_the_target_to_be_written():
+    clock, pi, writer, backend = makeBackend()
+    curve = FadeCurve(START, TARGET)
+    end = curve.dutyCycles(INTERVALS)
+    backend.start(curve, 1.0, clock.now)
+    # The script dies partway and the daemon reports it as failed
+    clock.now = 0.4
+    pi.stop_script(backend.scriptId)
+    pi.script_status = lambda scriptId: (pigpio.PI_SCRIPT_FAILED, ())
+    clock.now = backend.endTime + backend.frameTime
+    assert backend.step(clock.now) is None
+    # As the fixture does once its fade is over
+    writer.write(end)
+    assert [pi.get_PWM_dutycycle(pin) for pin in SIM_PINS] == writer.calibrate(end)
+
+def test_cancel_reads_back_where_a_lagging_daemon_got_to():
+    clock, pi, writer, backend = makeBackend()
+    backend.start(FadeCurve(START, TARGET), 1.0, clock.now)
+    # The daemon started the script a tenth of a second after python thinks it did
+    pi.writes = [(at + 0.1, gpio, value, source) if source is not None else (at, gpio, value, source)
+                 for at, gpio, value, source in pi.writes]
+    clock.now = 0.405
+    backend.cancel(clock.now)
+    assert writer.lastWritten == [pi.get_PWM_dutycycle(pin) for pin in SIM_PINS]
+    assert writer.calibrate(writer.read()) == writer.lastWritten
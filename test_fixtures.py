@@ -0,0 +1,52 @@
+import pytest
+
+from curve import toPerceptual
+from reducer import State, StateChange
+from sim import Simulation
+
+WHITE = 3
+
+@pytest.fixture
+def sim():
+    sim = Simulation(initialState=State(on=False))
+    yield sim
+    sim.close()
+
+def position(sim: Simulation) -> float:
+    return toPerceptual(sim.fixtures[0].writer.read()[WHITE])
+
+def test_interrupting_fade_takes_only_the_remaining_share_of_its_fade_time(sim):
+    fixture = sim.fixtures[0]
+    fixture.queue.put(StateChange(on=True, fadeTime=1.0))
+    sim.run(0.89)
+    before = position(sim)
+    sim.run(0.01)
+    speed = (position(sim) - before) / 0.01
+
+    # The same target again, as a knob detent that doesn't change white would send
+    fixture.queue.put(StateChange(on=True, fadeTime=1.0))
+    sim.run(0)
+    assert fixture.fadeTime == pytest.approx(0.1, abs=0.02)
+    start = position(sim)
+    sim.run(0.02)
+    # Carries on at the speed it had rather than slowing to cover a tenth of the way in a whole fadeTime
+    assert (position(sim) - start) / 0.02 == pytest.approx(speed, rel=0.2)
+    assert sim.settle() == pytest.approx(fixture.fadeTime - 0.02, abs=0.001)
+    assert fixture.writer.read()[WHITE] == pytest.approx(255, abs=1)
+
+def test_interrupting_fade_never_takes_longer_than_its_fade_time(sim):
+    fixture = sim.fixtures[0]
+    fixture.queue.put(StateChange(on=True, fadeTime=1.0))
+    sim.run(0.5)
+    # Heading back past where it started is further than the fade's own span
+    fixture.queue.put(StateChange(on=False, fadeTime=2.0))
+    sim.run(0)
+    assert fixture.fadeTime == pytest.approx(2.0)
+    assert sim.settle() == pytest.approx(2.0, abs=0.02)
+    assert fixture.writer.lastWritten[WHITE] == 0
+
+def test_uninterrupted_fade_takes_its_whole_fade_time(sim):
+    fixture = sim.fixtures[0]
+    fixture.queue.put(StateChange(on=True, fadeTime=0.5))
+    assert sim.settle() == pytest.approx(0.5, abs=0.02)
+    assert fixture.fadeTime == 0.5
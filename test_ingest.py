@@ -0,0 +1,62 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+import app
+from ingest import IngestFull, TaskIngest
+from reducer import Adjustment
+from sim import Simulation
+
+@pytest.fixture
+def sim():
+    sim = Simulation()
+    yield sim
+    sim.close()
+
+def test_backlog_is_held_in_the_channel_and_pushes_back_once_full(sim):
+    fixture = sim.fixtures[0]
+
+    async def flood():
+        ingest = TaskIngest(sim.scheduler, maxsize=4, fixtureLimit=2, submitTimeout=0.1)
+        await ingest.start()
+        try:
+            # Two fill the fixture's queue, one waits in the forwarder and four in the channel
+            for _ in range(7):
+                await ingest.submit([(fixture, Adjustment(power=-1))])
+                await asyncio.sleep(0)
+            await asyncio.sleep(0.05)
+            # Only the fixture's limit reaches its queue while the scheduler isn't taking anything
+            assert fixture.queue.qsize() == 2
+            with pytest.raises(IngestFull):
+                await ingest.submit([(fixture, Adjustment(power=-1))])
+
+            # Once the scheduler catches up the rest are forwarded and there's room again
+            sim.run(0)
+            await asyncio.sleep(0.05)
+            assert fixture.queue.qsize() == 2
+            await ingest.submit([(fixture, Adjustment(power=-1))])
+        finally:
+            ingest.stop()
+
+    asyncio.run(flood())
+
+def test_route_answers_503_when_the_ingest_is_full(sim, monkeypatch):
+    fixture = sim.fixtures[0]
+
+    async def flood():
+        ingest = TaskIngest(sim.scheduler, maxsize=1, fixtureLimit=1, submitTimeout=0.05)
+        monkeypatch.setattr(app, "ingest", ingest)
+        monkeypatch.setattr(app, "fixtures", {fixture.name: fixture})
+        await ingest.start()
+        try:
+            for _ in range(3):
+                await app.submitToAll(fixture.name, Adjustment(power=-1))
+                await asyncio.sleep(0.02)
+            with pytest.raises(HTTPException) as raised:
+                await app.submitToAll(fixture.name, Adjustment(power=-1))
+            assert raised.value.status_code == 503
+        finally:
+            ingest.stop()
+
+    asyncio.run(flood())
@@ -0,0 +1,173 @@
+import os
+import time
+
+import pytest
+
+import journal
+from journal import HEADER, Journal, decodeSnapshot, decodeTask, encodeSnapshot, encodeTask, readJournal, replay
+from reducer import Adjustment, Aurora, ChangePreset, Colour, State, StateChange, Switch, applyTask
+
+AURORA = Aurora(minColour=Colour(0, 0, 0, 0), maxColour=Colour(100, 100, 100, 0), minColourDist=0.4, fadeTime=1, postDelay=2)
+
+# Times that float32 holds exactly, as the journal stores them
+TASKS = [
+    Adjustment(power=-10, colour=Colour(5, 0, -5, 0), fadeTime=0.25),
+    ChangePreset(fadeTime=0.5),
+    Switch(fadeTime=0.75),
+    StateChange(red=100, green=0, blue=0, white=0, flash=True, fadeTime=0.125, postDelay=0.125),
+    StateChange(on=False),
+    StateChange(power=40, white=25.5),
+]
+
+def fields(value):
+    # States, settings and tasks are slotted classes without equality, compared by what they hold
+    if isinstance(value, tuple) and not hasattr(value, "_fields"):
+        return tuple(fields(item) for item in value)
+    if isinstance(value, list):
+        return [fields(item) for item in value]
+    slots = [slot for cls in type(value).__mro__ for slot in getattr(cls, "__slots__", ())]
+    if not slots:
+        return value
+    return type(value).__name__, {slot: fields(getattr(value, slot)) for slot in slots}
+
+def applyAll(tasks, state: State = None) -> State:
+    state = State() if state is None else state
+    for task in tasks:
+        state = applyTask(task, state)
+    return state
+
+def decodeRecord(data: bytes):
+    kind, length, _ = HEADER.unpack_from(data)
+    return kind, data[HEADER.size:HEADER.size + length]
+
+def writeJournal(tmp_path, tasks, **kwargs) -> Journal:
+    # Quiet periods long enough that nothing is written until the journal is stopped
+    log = Journal(str(tmp_path / "journal.bin"), quietPeriod=60, maxDelay=60, **kwargs)
+    log.recover()
+    state = State()
+    log.open(state)
+    log.start()
+    for task in tasks:
+        state = applyTask(task, state)
+        log.append(task, state)
+    log.stop()
+    return log
+
+@pytest.mark.parametrize("task", TASKS)
+def test_tasks_decode_to_what_was_encoded(task):
+    entry = decodeTask(*decodeRecord(encodeTask(12.5, task, applyTask(task, State()), generated=True)))
+    assert fields(entry.task) == fields(task)
+    assert entry.appliedAt == 12.5 and entry.generated and entry.auroraColour is None
+
+def test_aurora_keeps_the_colour_it_drew():
+    state = applyTask(AURORA, State())
+    entry = decodeTask(*decodeRecord(encodeTask(0, AURORA, state)))
+    assert fields(entry.task) == fields(AURORA)
+    assert entry.auroraColour == state.presets[state.presetIdx]
+    assert fields(applyTask(entry.task, State(), entry.auroraColour)) == fields(state)
+
+def test_snapshot_decodes_to_the_state_and_aurora_it_was_taken_of():
+    state = applyAll([ChangePreset(), Adjustment(power=-30)])
+    assert fields(decodeSnapshot(decodeRecord(encodeSnapshot(state, None))[1])) == fields((state, None))
+    state = applyTask(AURORA, state)
+    assert fields(decodeSnapshot(decodeRecord(encodeSnapshot(state, AURORA))[1])) == fields((state, AURORA))
+
+def test_replay_rebuilds_the_state_the_tasks_led_to(tmp_path):
+    log = writeJournal(tmp_path, TASKS[:3] + TASKS[4:])
+    records, length = readJournal(log.path)
+    assert length == os.path.getsize(log.path)
+    assert fields(replay(records)) == fields((applyAll(TASKS[:3] + TASKS[4:]), None))
+
+def test_replay_stops_at_a_corrupt_record(tmp_path):
+    log = writeJournal(tmp_path, TASKS[:3])
+    records, _ = readJournal(log.path)
+    with open(log.path, 'r+b') as f:
+        # The last byte of the last record's payload
+        f.seek(-1, os.SEEK_END)
+        last = f.read(1)
+        f.seek(-1, os.SEEK_END)
+        f.write(bytes([last[0] ^ 0xff]))
+    corrupt, length = readJournal(log.path)
+    assert corrupt == records[:-1]
+    assert length == os.path.getsize(log.path) - HEADER.size - len(records[-1][1])
+    assert fields(replay(corrupt)) == fields((applyAll(TASKS[:2]), None))
+
+def test_torn_tail_is_dropped_and_appends_follow_the_last_intact_record(tmp_path):
+    log = writeJournal(tmp_path, TASKS[:3])
+    with open(log.path, 'r+b') as f:
+        f.truncate(os.path.getsize(log.path) - 3)
+    records, length = readJournal(log.path)
+    assert fields(replay(records)) == fields((applyAll(TASKS[:2]), None))
+
+    reopened = Journal(log.path, quietPeriod=60, maxDelay=60)
+    state, _ = reopened.recover()
+    reopened.open(state)
+    reopened.start()
+    reopened.append(TASKS[4], applyTask(TASKS[4], state))
+    reopened.stop()
+    records, length = readJournal(reopened.path)
+    assert length == os.path.getsize(reopened.path)
+    assert fields(replay(records)) == fields((applyAll(TASKS[:2] + TASKS[4:5]), None))
+
+def test_records_are_held_back_until_appends_go_quiet(tmp_path):
+    log = Journal(str(tmp_path / "journal.bin"), quietPeriod=0.2, maxDelay=60)
+    log.recover()
+    log.open(State())
+    log.start()
+    try:
+        size = os.path.getsize(log.path)
+        for task in TASKS[:3]:
+            log.append(task, State())
+            time.sleep(0.05)
+        assert os.path.getsize(log.path) == size
+        time.sleep(0.4)
+        assert len(readJournal(log.path)[0]) == 4
+    finally:
+        log.stop()
+
+def test_compaction_starts_from_a_snapshot_and_keeps_the_old_journal(tmp_path):
+    tasks = [Adjustment(power=-5)] * 8 + [AURORA]
+    log = writeJournal(tmp_path, tasks, compactAfter=5)
+    records, _ = readJournal(log.path)
+    assert [kind for kind, _ in records] == [journal.KIND_SNAPSHOT]
+    assert len(readJournal(log.previousPath)[0]) == 1 + len(tasks)
+    # The snapshot carries the aurora on, recovering from either journal leads to the same place
+    expected = replay(readJournal(log.previousPath)[0])
+    assert fields(expected[1]) == fields(AURORA)
+    assert fields(Journal(log.path).recover()) == fields(expected)
+
+def waitForWrite(log: Journal, records: int):
+    deadline = time.monotonic() + 5.0
+    while len(readJournal(log.path)[0]) < records and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+@pytest.mark.parametrize("failing", ["_writeSnapshotFile", "replace"])
+def test_failed_compaction_keeps_appending_to_the_old_journal(tmp_path, monkeypatch, failing):
+    log = Journal(str(tmp_path / "journal.bin"), compactAfter=3, quietPeriod=0.01, maxDelay=0.01)
+    log.recover()
+    log.open(State())
+    if failing == "replace":
+        # Moving the new journal into place fails after the old one has been moved aside
+        replace = os.replace
+        def failReplace(source, destination):
+            if source.endswith(".tmp"):
+                raise OSError("Input/output error")
+            replace(source, destination)
+        monkeypatch.setattr(journal.os, "replace", failReplace)
+    else:
+        def failSnapshot(*args):
+            raise OSError("No space left on device")
+        monkeypatch.setattr(log, failing, failSnapshot)
+    log.start()
+    state = State()
+    try:
+        for idx, task in enumerate(TASKS[:3] + TASKS[4:]):
+            state = applyTask(task, state)
+            log.append(task, state)
+            # Each append is written on its own, every one after the second tries and fails to compact
+            waitForWrite(log, idx + 2)
+    finally:
+        log.stop()
+    assert len(readJournal(log.path)[0]) == 6
+    assert fields(Journal(log.path).recover()) == fields((state, None))
+    assert [name for name in os.listdir(tmp_path) if name.endswith(".tmp")] == []
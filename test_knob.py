@@ -0,0 +1,76 @@
+from inputs import InputScheduler
+from knob import DOUBLE_CLICK_TIME, HOLD_TIME, KNOB_COLOUR_STEP, KNOB_POWER_STEP, KNOB_TIMEOUT_SECONDS, KnobController, KnobState
+from reducer import Adjustment, ChangePreset, StateChange, Switch
+from sim import VirtualClock
+
+class Knob:
+    # Drives a KnobController the way the gpiozero callbacks do, with time only moving when told to
+    def __init__(self):
+        self.clock = VirtualClock()
+        self.inputs = InputScheduler(self.clock)
+        self.tasks = []
+        self.controller = KnobController(self.inputs, self.tasks.append, 0.75)
+
+    def advance(self, seconds: float):
+        self.clock.now += seconds
+        self.inputs.runDue(self.clock.now)
+
+    def post(self, callback):
+        self.inputs.post(callback)
+        self.inputs.runDue(self.clock.now)
+
+    def click(self):
+        self.post(self.controller.released)
+
+def test_click_switches_once_the_double_click_window_has_passed():
+    knob = Knob()
+    knob.click()
+    knob.advance(DOUBLE_CLICK_TIME - 0.01)
+    assert knob.tasks == []
+    knob.advance(0.02)
+    assert [type(task) for task in knob.tasks] == [Switch]
+    assert knob.tasks[0].fadeTime == 0.75
+
+def test_double_click_enters_red_mode_without_switching():
+    knob = Knob()
+    knob.click()
+    knob.advance(DOUBLE_CLICK_TIME / 2)
+    knob.click()
+    knob.advance(DOUBLE_CLICK_TIME)
+    assert knob.controller.state == KnobState.MOD_RED
+    assert [type(task) for task in knob.tasks] == [StateChange]
+    flash = knob.tasks[0]
+    assert flash.flash and (flash.red, flash.green, flash.blue, flash.white) == (100, 0, 0, 0)
+
+def test_hold_after_a_click_changes_preset_and_its_release_is_not_a_click():
+    knob = Knob()
+    knob.click()
+    # The press that starts the hold comes shortly after, gpiozero reports the hold once HOLD_TIME has passed
+    knob.advance(0.05 + HOLD_TIME)
+    knob.post(knob.controller.held)
+    knob.advance(0.2)
+    knob.click()
+    knob.advance(DOUBLE_CLICK_TIME * 2)
+    assert [type(task) for task in knob.tasks] == [Switch, ChangePreset]
+    assert not knob.controller.isHeld
+
+def test_rotation_adjusts_power_in_default_mode():
+    knob = Knob()
+    knob.post(lambda: knob.controller.rotated(-1))
+    assert isinstance(knob.tasks[0], Adjustment)
+    assert knob.tasks[0].power == -KNOB_POWER_STEP
+
+def test_colour_mode_times_out_after_the_knob_is_left_alone():
+    knob = Knob()
+    knob.click()
+    knob.click()
+    knob.advance(KNOB_TIMEOUT_SECONDS - 1)
+    # Turning the knob restarts the timeout
+    knob.post(lambda: knob.controller.rotated(1))
+    assert knob.tasks[-1].colour.red == KNOB_COLOUR_STEP
+    knob.advance(KNOB_TIMEOUT_SECONDS - 0.5)
+    assert knob.controller.state == KnobState.MOD_RED
+    knob.advance(1)
+    assert knob.controller.state == KnobState.DEFAULT
+    leave = knob.tasks[-1]
+    assert isinstance(leave, StateChange) and leave.flash and leave.power == 10
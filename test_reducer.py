@@ -0,0 +1,28 @@
+from reducer import State, StateChange, Switch, applyTask
+from sim import Simulation
+
+def test_switching_on_twice_leaves_the_light_on():
+    state = State(on=False, power=60)
+    for _ in range(2):
+        state = applyTask(StateChange(on=True), state)
+    assert state.on and state.power == 60
+
+def test_switching_on_after_dimming_to_zero_comes_back_at_full_power():
+    for task in (Switch(), StateChange(on=True)):
+        state = applyTask(task, State(on=True, power=0))
+        assert state.on and state.power == 100
+    # An explicit power is kept
+    assert applyTask(StateChange(on=True, power=0), State(power=0)).power == 0
+
+def test_quick_presses_queued_together_end_with_the_light_on():
+    sim = Simulation(initialState=State(on=False))
+    try:
+        fixture = sim.fixtures[0]
+        # Both presses see the light as off before the scheduler takes either of them
+        fixture.queue.put(StateChange(on=True, fadeTime=0.75))
+        fixture.queue.put(StateChange(on=True, fadeTime=0.75))
+        sim.settle()
+        assert fixture.targetState.on
+        assert any(fixture.writer.read())
+    finally:
+        sim.close()
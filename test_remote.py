@@ -0,0 +1,100 @@
+import time
+
+import pigpio
+import pytest
+
+import remote
+from remote import RemotePi
+from sim import FakePigpioServer
+
+RECONNECT_WAIT = 5.0
+
+def waitFor(condition, timeout: float = RECONNECT_WAIT) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return condition()
+
+def test_restarted_daemon_gets_settings_and_duty_cycles_pushed_again():
+    server = FakePigpioServer().start()
+    pi = RemotePi(server.host, server.port)
+    try:
+        assert pi.connected
+        pi.set_PWM_frequency(26, 800)
+        pi.set_PWM_range(26, 1000)
+        pi.set_PWM_dutycycles([(26, 400), (19, 200)])
+        scriptId = pi.store_script(b"pwm 26 p0")
+        assert waitFor(lambda: server.pi.get_PWM_dutycycle(19) == 200)
+
+        server.restart()
+        assert server.pi.get_PWM_dutycycle(26) == 0 and server.pi.ranges == {}
+        # Writes made while the daemon is away are the ones pushed once it's back
+        try:
+            pi.set_PWM_dutycycle(19, 150)
+        except pigpio.error:
+            pass
+        assert waitFor(lambda: pi.connected and pi.metrics.reconnects >= 1)
+
+        assert waitFor(lambda: server.pi.get_PWM_dutycycle(19) == 150)
+        assert server.pi.get_PWM_dutycycle(26) == 400
+        assert server.pi.ranges == {26: 1000}
+        assert server.pi.frequencies == {26: 800}
+        # The script is stored again under the same local id, so a caller holding it can still run it
+        pi.run_script(scriptId, [300])
+        assert waitFor(lambda: server.pi.get_PWM_dutycycle(26) == 300)
+    finally:
+        pi.stop()
+        server.stop()
+
+def test_writes_never_wait_on_a_daemon_that_stops_answering(monkeypatch):
+    monkeypatch.setattr(remote, "CONNECT_TIMEOUT", 0.5)
+    server = FakePigpioServer().start()
+    pi = RemotePi(server.host, server.port)
+    try:
+        # Replies held back far longer than any timeout, the daemon still accepts connections but never answers
+        server.latency = 60.0
+        server.restart()
+        slowest = 0.0
+        deadline = time.monotonic() + 2.0
+        value = 0
+        while time.monotonic() < deadline:
+            value = (value + 1) % 256
+            start = time.monotonic()
+            try:
+                pi.set_PWM_dutycycles([(26, value), (19, 255 - value)])
+            except pigpio.error:
+                pass
+            slowest = max(slowest, time.monotonic() - start)
+            time.sleep(0.005)
+        assert slowest <= remote.WRITE_TIMEOUT + 0.1
+        assert not pi.connected
+
+        server.latency = 0.0
+        assert waitFor(lambda: pi.connected, 10.0)
+        assert waitFor(lambda: (server.pi.get_PWM_dutycycle(26), server.pi.get_PWM_dutycycle(19)) == (value, 255 - value))
+    finally:
+        pi.stop()
+        server.stop()
+
+def test_pool_connection_is_discarded_after_any_error_and_waits_are_bounded(monkeypatch):
+    monkeypatch.setattr(remote, "ACQUIRE_TIMEOUT", 0.1)
+    server = FakePigpioServer().start()
+    pool = remote.ConnectionPool(server.host, server.port, size=1)
+    try:
+        with pytest.raises(ValueError):
+            with pool.connection():
+                raise ValueError("malformed reply")
+        # The slot was given back, so the next caller gets a fresh connection rather than waiting forever
+        with pool.connection() as connection:
+            assert connection.call(remote.CMD_PIGPV) == 79
+            # With the only connection in use another caller gives up rather than waiting forever
+            start = time.monotonic()
+            with pytest.raises(pigpio.error):
+                with pool.connection():
+                    pass
+            assert time.monotonic() - start < 1.0
+    finally:
+        pool.reset()
+        server.stop()
@@ -0,0 +1,111 @@
+import random
+
+import pytest
+
+from reducer import MINIMUM_DIM_POWER, NUM_PRESETS, Adjustment, Aurora, ChangePreset, Colour, State, StateChange, Switch, applyTask, isFoldable
+from sim import Simulation
+from taskqueue import TaskQueue
+
+SEEDS = range(40)
+# Steps around the minimum dim power and zero, where each task depends on the power the one before left
+POWER_STEPS = [-100, -10, -3, -MINIMUM_DIM_POWER, -1, 1, MINIMUM_DIM_POWER, 3, 10]
+POWERS = [0, 1, MINIMUM_DIM_POWER, MINIMUM_DIM_POWER + 1, 50, 100]
+
+def describe(state: State):
+    return state.on, state.power, state.presets, state.presetIdx
+
+def applyAll(tasks, state: State) -> State:
+    for task in tasks:
+        state = applyTask(task, state)
+    return state
+
+def randomColour(rng: random.Random, low: int, high: int) -> Colour:
+    return Colour(*(rng.choice([0, low, high, rng.randint(low, high)]) for _ in range(4)))
+
+def randomState(rng: random.Random) -> State:
+    presets = [randomColour(rng, 0, 100) for _ in range(NUM_PRESETS)]
+    return State(on=rng.random() < 0.7, power=rng.choice(POWERS), presets=presets, presetIdx=rng.randrange(NUM_PRESETS))
+
+def randomTask(rng: random.Random):
+    fadeTime = rng.choice([0, 0.1, 0.25])
+    kind = rng.random()
+    if kind < 0.5:
+        return Adjustment(power=rng.choice(POWER_STEPS), colour=randomColour(rng, -10, 10) if rng.random() < 0.3 else Colour(),
+                          fadeTime=fadeTime)
+    if kind < 0.75:
+        values = [rng.choice([None, 0, 50, 100]) for _ in range(4)]
+        return StateChange(*values, on=rng.choice([None, True, False]), power=rng.choice([None, 0, 1, MINIMUM_DIM_POWER, 60]),
+                           fadeTime=fadeTime)
+    if kind < 0.95:
+        return Switch(fadeTime=fadeTime)
+    return ChangePreset(fadeTime=fadeTime)
+
+def runFolded(initialState: State, tasks):
+    # Every task queued before the scheduler looks, so they are taken as one run
+    sim = Simulation(initialState=initialState)
+    try:
+        fixture = sim.fixtures[0]
+        for task in tasks:
+            fixture.queue.put(task)
+        sim.settle()
+        assert fixture.queue.coalesced == len(tasks) - 1
+        return describe(fixture.targetState), fixture.writer.read()
+    finally:
+        sim.close()
+
+def runOneByOne(initialState: State, tasks):
+    sim = Simulation(initialState=initialState)
+    try:
+        fixture = sim.fixtures[0]
+        for task in tasks:
+            fixture.queue.put(task)
+            sim.settle()
+        assert fixture.queue.coalesced == 0
+        return describe(fixture.targetState), fixture.writer.read()
+    finally:
+        sim.close()
+
+def test_run_stops_at_the_first_task_that_cannot_fold():
+    queue = TaskQueue()
+    flash = StateChange(red=100, flash=True)
+    aurora = Aurora(maxColour=Colour(100, 100, 100))
+    for task in (Switch(), Adjustment(power=-10), flash, Switch(), aurora, Switch()):
+        queue.put(task)
+    assert [type(task) for task in queue.getRun(isFoldable)] == [Switch, Adjustment]
+    assert queue.getRun(isFoldable) == [flash]
+    assert [type(task) for task in queue.getRun(isFoldable)] == [Switch]
+    assert queue.getRun(isFoldable) == [aurora]
+    assert queue.coalesced == 1
+
+@pytest.mark.parametrize("seed", SEEDS)
+def test_folded_run_reaches_the_state_of_applying_each_task_in_turn(seed):
+    rng = random.Random(seed)
+    initialState = randomState(rng)
+    tasks = [randomTask(rng) for _ in range(rng.randint(2, 10))]
+    expected = describe(applyAll(tasks, initialState.duplicate()))
+    state, dutyCycles = runFolded(initialState, tasks)
+    assert state == expected
+    assert (state, dutyCycles) == runOneByOne(initialState, tasks)
+
+@pytest.mark.parametrize("power, steps, expected", [
+    # Dimming past the minimum stops there first, only the next step down reaches zero
+    (10, [-5, -5], MINIMUM_DIM_POWER),
+    (10, [-5, -5, -5], 0),
+    (10, [-10, -10], 0),
+    (MINIMUM_DIM_POWER + 1, [-MINIMUM_DIM_POWER, -MINIMUM_DIM_POWER], 0),
+    (10, [-10], MINIMUM_DIM_POWER),
+    # Coming up from zero goes to the minimum first, however big the step
+    (0, [10, 10], MINIMUM_DIM_POWER + 10),
+    (0, [1, -1], MINIMUM_DIM_POWER - 1),
+    (1, [-1, 5], MINIMUM_DIM_POWER),
+])
+def test_folded_dimming_keeps_the_minimum_power_edges(power, steps, expected):
+    initialState = State(power=power)
+    tasks = [Adjustment(power=step, fadeTime=0.1) for step in steps]
+    assert describe(applyAll(tasks, initialState.duplicate()))[1] == expected
+    assert runFolded(initialState, tasks)[0][1] == expected
+
+def test_folded_switch_after_dimming_to_zero_comes_back_at_full_power():
+    tasks = [Adjustment(power=-100), Adjustment(power=-100), Switch(), Adjustment(power=-10)]
+    state, _ = runFolded(State(power=50), tasks)
+    assert state[:2] == (True, 90)
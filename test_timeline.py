@@ -0,0 +1,27 @@
+import math
+
+import pytest
+from pydantic import ValidationError
+
+from app import TimelineModel
+from reducer import StateChange
+from timeline import InvalidTimeline, compileTimeline
+
+@pytest.mark.parametrize("value", [math.nan, math.inf, -math.inf, -1.0])
+def test_offsets_and_durations_must_be_finite_and_not_negative(value):
+    with pytest.raises(InvalidTimeline):
+        compileTimeline([(value, StateChange(power=50))])
+    with pytest.raises(InvalidTimeline):
+        compileTimeline([(None, StateChange(power=50, fadeTime=value))])
+    with pytest.raises(InvalidTimeline):
+        compileTimeline([(None, StateChange(power=50, postDelay=value))])
+
+def test_steps_without_an_offset_follow_the_previous_step():
+    timeline = compileTimeline([(None, StateChange(power=50, fadeTime=1, postDelay=0.5)), (None, StateChange(power=10))])
+    assert [at for at, _ in timeline.steps] == [0.0, 1.5]
+    assert timeline.duration == 1.5
+
+@pytest.mark.parametrize("at", ["NaN", "Infinity", -1])
+def test_request_rejects_a_bad_offset(at):
+    with pytest.raises(ValidationError):
+        TimelineModel.parse_obj({"steps": [{"type": "switch", "at": at}]})
@@ -0,0 +1,57 @@
+import math
+from typing import List, Optional, Sequence, Tuple
+from uuid import uuid4
+
+from reducer import Aurora, Task, getTaskSampler
+
+MAX_TIMELINE_STEPS = 256
+MAX_TIMELINE_DURATION = 24 * 60 * 60
+
+class InvalidTimeline(ValueError):
+    pass
+
+class Timeline:
+    def __init__(self, steps: List[Tuple[float, Task]], duration: float):
+        self.id = uuid4().hex
+        # (offset from the start of the timeline, task), in the order they are played
+        self.steps = steps
+        self.duration = duration
+        # Shared by every fixture playing the timeline, so a group is cancelled as a unit
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+def isTime(value: float) -> bool:
+    return math.isfinite(value) and value >= 0
+
+def compileTimeline(steps: Sequence[Tuple[Optional[float], Task]]) -> Timeline:
+    # A step without an offset starts once the previous step's fade and post delay are over
+    if not steps:
+        raise InvalidTimeline("A timeline needs at least one step")
+    if len(steps) > MAX_TIMELINE_STEPS:
+        raise InvalidTimeline("A timeline can have at most {0} steps".format(MAX_TIMELINE_STEPS))
+
+    compiled = []
+    nextAt = 0.0
+    for idx, (at, task) in enumerate(steps):
+        if task.flash:
+            raise InvalidTimeline("Step {0}: flashes can't be part of a timeline".format(idx))
+        # NaN slips through every comparison, so it's caught along with infinity rather than left to the bounds below
+        if not (isTime(task.fadeTime) and isTime(task.postDelay)):
+            raise InvalidTimeline("Step {0}: fadeTime and postDelay must be finite and not negative".format(idx))
+        at = nextAt if at is None else at
+        if not isTime(at):
+            raise InvalidTimeline("Step {0}: offset must be finite and not negative".format(idx))
+        if isinstance(task, Aurora):
+            # Raises AuroraInfeasible up front rather than partway through playing
+            getTaskSampler(task)
+        compiled.append((at, task))
+        nextAt = at + task.fadeTime + task.postDelay
+
+    # Stable, so steps sharing an offset are applied in the order they were given
+    compiled.sort(key=lambda step: step[0])
+    duration = max(at + task.fadeTime + task.postDelay for at, task in compiled)
+    if duration > MAX_TIMELINE_DURATION:
+        raise InvalidTimeline("A timeline can last at most {0} seconds".format(MAX_TIMELINE_DURATION))
+    return Timeline(compiled, duration)